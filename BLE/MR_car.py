@@ -14,142 +14,75 @@ from spike import (PrimeHub, LightMatrix, Button, StatusLight, ForceSensor,
                    MotionSensor, Speaker, ColorSensor, App, DistanceSensor, 
                    Motor, MotorPair)
 from spike.control import wait_for_seconds, wait_until, Timer
-import bluetooth, utime, struct, random
-from micropython import const
+import utime
+from mr_frames import FrameWriter, HostClock, SCHEMA_CAR
 
-# Set up Bluetooth structure data, provided to us by the Mind Render folks and 
-# then modified.
-# This takes up a lot of the code, to skip to the main content jump to line 
-# 138. Remember to change the name of your SPIKE (if you want) on line 96.
-_ADV_TYPE_FLAGS = const(0x01)
-_ADV_TYPE_NAME = const(0x09)
-_ADV_TYPE_UUID16_COMPLETE = const(0x3)
-_ADV_TYPE_UUID32_COMPLETE = const(0x5)
-_ADV_TYPE_UUID128_COMPLETE = const(0x7)
-_ADV_TYPE_UUID16_MORE = const(0x2)
-_ADV_TYPE_UUID32_MORE = const(0x4)
-_ADV_TYPE_UUID128_MORE = const(0x6)
-_ADV_TYPE_APPEARANCE = const(0x19)
-_ADV_TYPE_SPECIFIC_DATA = const(0xFF)
-_ADV_DATA_COMPANY_ID = const(0xFFFF)
+# The Bluetooth setup (advertising, the UART service MR talks to and the 
+# BLEPeripheral class) lives in mr_ble.py, save it onto the SPIKE along with 
+# mr_frames.py
+from mr_ble import (BLEPeripheral, SendRate, DeltaFilter, Downlink, 
+                    EVENT_CONNECT, EVENT_SUBSCRIBE, EVENT_DISCONNECT, 
+                    EVENT_WRITE)
 
-def advertising_payload(limited_disc=False, br_edr=False, name=None, 
-                        services=None, appearance=0, free=None):
-    payload = bytearray()
-    
-    def _append(adv_type, value):
-        nonlocal payload
-        payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-    _append(
-        _ADV_TYPE_FLAGS,
-        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr 
-                                                             else 0x04)),
-    )
-
-    if name:
-        _append(_ADV_TYPE_NAME, name)
-
-    if services:
-        for uuid in services:
-            b = bytes(uuid)
-            if len(b) == 2:
-                _append(_ADV_TYPE_UUID16_COMPLETE, b)
-            elif len(b) == 4:
-                _append(_ADV_TYPE_UUID32_COMPLETE, b)
-            elif len(b) == 16:
-                _append(_ADV_TYPE_UUID128_COMPLETE, b)
+# Initialize hub
+hub = PrimeHub()
 
-    if appearance:
-        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
+# Indicate that hub is advertising
+hub.light_matrix.show_image('HAPPY')
 
-    return payload
+# Change "car" if you want the hub to be called something else
+ble = BLEPeripheral("car", SCHEMA_CAR)
 
-_IRQ_CENTRAL_CONNECT = const(1)
-_IRQ_CENTRAL_DISCONNECT = const(2)
-_IRQ_GATTS_WRITE = const(3)
-_IRQ_MTU_EXCHANGED = const(21)
+# Set by the computer (see mr_sync.py) so frames can be stamped in its time
+clock = HostClock()
 
-_UART_UUID = bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")
-_UART_RX = (
-    bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE,
-)
-_UART_TX = (
-    bluetooth.UUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_NOTIFY,
-)
-_UART_SERVICE = (
-    _UART_UUID,
-    (_UART_TX, _UART_RX),
-)
+# Frame buffer is made once here and reused, see mr_frames.py for layout. 
+# Every frame says when it was sampled, in the computer's time once the clock 
+# is synced (hub time until then), so MR can tell jitter from real tilting.
+frame = FrameWriter(SCHEMA_CAR, timestamp=True, clock=clock)
 
-class BLEPeripheral:
-    def __init__(self):
-        self._ble = bluetooth.BLE()
-        self._ble.active(True)
-        self._ble.irq(self._irq)
-        ((self._handle_tx, self._handle_rx),) = \
-            self._ble.gatts_register_services((_UART_SERVICE,))
-        self._connections = set()
-        rand = random.randint(1, 100)
-        car = "car" + str(rand)
-        self._payload = advertising_payload(name=car, services=[_UART_UUID])
-        self._advertise()
+# Picks how long to wait between samples: short while the hub is tilting, 
+# longer while it's still or MR can't keep up
+rate = SendRate()
 
-    def is_connected(self):
-        return len(self._connections) > 0
+# Only samples where the hub tilted are sent, plus a keyframe every half 
+# second in case MR missed one
+delta = DeltaFilter()
 
-    def send(self, data):
-        if self.is_connected():
-            for handle in self._connections:
-                self._ble.gatts_notify(handle, self._handle_rx, data)
-                self._ble.gatts_notify(handle, self._handle_tx, data)
+# The car doesn't take any commands, this is here to answer pings and sync 
+# the clock
+downlink = Downlink(ble, clock)
 
-    def _irq(self, event, data):
-        if event == _IRQ_CENTRAL_CONNECT:
-            conn_handle, _, _ = data
-            self._connections.add(conn_handle)
+def handle_events():
+    """Prints what the BLE IRQ recorded since the last call"""
+    # Gives a central that couldn't keep up another go at what's queued
+    ble.pump()
+    while ble.any():
+        kind, conn_handle, data = ble.read()
+        if kind == EVENT_CONNECT:
             print("Connection", conn_handle)
-
-        elif event == _IRQ_CENTRAL_DISCONNECT:
-            print("Disconnected")
-            conn_handle, _, _ = data
-            if conn_handle in self._connections:
-                self._connections.remove(conn_handle)
-                
-            # self._advertise()
+        elif kind == EVENT_SUBSCRIBE:
+            # Only now does it get what's sent, so send it where things are
+            delta.keyframe()
+        elif kind == EVENT_DISCONNECT:
             print("Disconnected", conn_handle)
-
-        elif event == _IRQ_GATTS_WRITE:
-            print('Read')
-            conn_handle, value_handle = data
-
-            value = self._ble.gatts_read(value_handle)
-            if value_handle == self._handle_rx:
-                msg = value.decode()
-                print("Rx", msg)
-
-    def _advertise(self):
-        self._ble.gap_advertise(500000, adv_data=self._payload)
-        # self._ble.gap_advertise(500, "MindRender")
-        print("Advertising")
-
-# Initialize hub
-hub = PrimeHub()
-
-# Indicate that hub is advertising
-hub.light_matrix.show_image('HAPPY')
-
-ble = BLEPeripheral()
-
-# Constantly send pitch (controlling turning) and roll (controlling speed)
+            downlink.forget(conn_handle)
+        elif kind == EVENT_WRITE:
+            cmd = downlink.read(conn_handle, data)
+            if cmd is not None:
+                print("Rx", cmd)
+
+# Constantly send pitch (controlling turning) and roll (controlling speed).
+# The raw angles are sent, MR does the scaling (pitch/30 and roll/10 + 9)
 while True:
     pitch = hub.motion_sensor.get_pitch_angle()
     roll = hub.motion_sensor.get_roll_angle()
-    tosend = str(pitch/30) + ", " + str(roll/10+9)
-    
-    # Uncomment if you want to see what data is being sent
-    # print("sent:", tosend)
-    ble.send(tosend)
-    utime.sleep(0.1)
\ No newline at end of file
+    flags = delta.check(pitch, roll)
+    if flags >= 0:
+        tosend = frame.pack(pitch, roll, flags=flags)
+        
+        # Uncomment if you want to see what data is being sent
+        # print("sent:", tosend)
+        ble.send(tosend)
+    handle_events()
+    utime.sleep_ms(rate.update(ble, pitch, roll))
\ No newline at end of file
@@ -12,144 +12,76 @@ from spike import (PrimeHub, LightMatrix, Button, StatusLight, ForceSensor,
                    MotionSensor, Speaker, ColorSensor, Motor, MotorPair)
 from spike.control import wait_for_seconds, wait_until, Timer
 from hub import motion
-import math, bluetooth, time, struct, random
-from micropython import const
-
-# Set up Bluetooth structure data, provided to us by the Mind Render folks and 
-# then modified.
-# This takes up a lot of the code, to skip to the main content jump to line 
-# 146. Remember to change the name of your SPIKE (if you want) on line 99.
-_ADV_TYPE_FLAGS = const(0x01)
-_ADV_TYPE_NAME = const(0x09)
-_ADV_TYPE_UUID16_COMPLETE = const(0x3)
-_ADV_TYPE_UUID32_COMPLETE = const(0x5)
-_ADV_TYPE_UUID128_COMPLETE = const(0x7)
-_ADV_TYPE_UUID16_MORE = const(0x2)
-_ADV_TYPE_UUID32_MORE = const(0x4)
-_ADV_TYPE_UUID128_MORE = const(0x6)
-_ADV_TYPE_APPEARANCE = const(0x19)
-_ADV_TYPE_SPECIFIC_DATA = const(0xFF)
-_ADV_DATA_COMPANY_ID = const(0xFFFF)
-
-def advertising_payload(limited_disc=False, br_edr=False, name=None, 
-                        services=None, appearance=0, free=None):
-    payload = bytearray()
-    
-    def _append(adv_type, value):
-        nonlocal payload
-        payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-    _append(
-        _ADV_TYPE_FLAGS,
-        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr 
-                                                             else 0x04)),
-    )
-
-    if name:
-        _append(_ADV_TYPE_NAME, name)
-
-    if services:
-        for uuid in services:
-            b = bytes(uuid)
-            if len(b) == 2:
-                _append(_ADV_TYPE_UUID16_COMPLETE, b)
-            elif len(b) == 4:
-                _append(_ADV_TYPE_UUID32_COMPLETE, b)
-            elif len(b) == 16:
-                _append(_ADV_TYPE_UUID128_COMPLETE, b)
-
-    if appearance:
-        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
-
-    return payload
-
-_IRQ_CENTRAL_CONNECT = const(1)
-_IRQ_CENTRAL_DISCONNECT = const(2)
-_IRQ_GATTS_WRITE = const(3)
-_IRQ_MTU_EXCHANGED = const(21)
-
-_UART_UUID = bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")
-_UART_RX = (
-    bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE,
-)
-_UART_TX = (
-    bluetooth.UUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_NOTIFY,
-)
-_UART_SERVICE = (
-    _UART_UUID,
-    (_UART_TX, _UART_RX),
-)
+import time
+from mr_frames import (FrameWriter, SCHEMA_GOLF, GOLF_SHOOT, GOLF_TURN, 
+                       GOLF_HEIGHT, CMD_SCORE, CMD_RESET)
+
+# The Bluetooth setup (advertising, the UART service MR talks to and the 
+# BLEPeripheral class) lives in mr_ble.py, save it onto the SPIKE along with 
+# mr_frames.py
+from mr_ble import (BLEPeripheral, Downlink, LoopProfiler, 
+                    EVENT_CONNECT, EVENT_DISCONNECT, EVENT_WRITE)
+# The swing's peak is worked out by swing_peak.py, in the shared folder, 
+# save that onto the SPIKE too
+from swing_peak import SwingPeak
 
 def winning_display():
     """Display target when player completes the hole."""
     for i in range(50):
         hub.light_matrix.show_image("YES", i*2)
 
-class BLEPeripheral:
-    def __init__(self):
-        self._ble = bluetooth.BLE()
-        self._ble.active(True)
-        self._ble.irq(self._irq)
-        ((self._handle_tx, self._handle_rx),) = \
-            self._ble.gatts_register_services((_UART_SERVICE,))
-        self._connections = set()
-        rand = random.randint(1, 100)
-        golf = "golf" + str(rand)
-        self._payload = advertising_payload(name=golf, services=[_UART_UUID])
-        self._advertise()
-
-    def is_connected(self):
-        return len(self._connections) > 0
-
-    def send(self, data):
-        if self.is_connected():
-            for handle in self._connections:
-                self._ble.gatts_notify(handle, self._handle_rx, data)
-                self._ble.gatts_notify(handle, self._handle_tx, data)
-
-    def _irq(self, event, data):
-        if event == _IRQ_CENTRAL_CONNECT:
-            conn_handle, _, _ = data
-            self._connections.add(conn_handle)
-            print("Connection", conn_handle)
-            for i in range(50):
-                hub.light_matrix.show_image("ARROW_N", i*2)
-
-        elif event == _IRQ_CENTRAL_DISCONNECT:
-            print("Disconnected")
-            conn_handle, _, _ = data
-            if conn_handle in self._connections:
-                self._connections.remove(conn_handle)
-                
-            # self._advertise()
-            print("Disconnected", conn_handle)
-
-        elif event == _IRQ_GATTS_WRITE:
-            print('Read')
-            conn_handle, value_handle = data
-
-            value = self._ble.gatts_read(value_handle)
-            if value_handle == self._handle_rx:
-                msg = value.decode()
-                print("Rx", msg)
-                if msg == "score":
-                    winning_display()
-
-
-    def _advertise(self):
-        self._ble.gap_advertise(500000, adv_data=self._payload)
-        # self._ble.gap_advertise(500, "MindRender")
-        print("Advertising")
-
 # Initialize hub
 hub = PrimeHub()
 
 # Indicate that hub is advertising
 hub.light_matrix.show_image('HAPPY')
 
-ble = BLEPeripheral()
+# Change "golf" if you want the hub to be called something else
+ble = BLEPeripheral("golf", SCHEMA_GOLF)
+
+# Frame buffer is made once here and reused, see mr_frames.py for layout
+frame = FrameWriter(SCHEMA_GOLF)
+
+# Set PROFILE to True to time every pass of the shooting, turning and height 
+# loops on the hub, then run latency_probe.py --stats on your computer to see 
+# how long they take
+PROFILE = False
+SHOOTING, TURNING, HEIGHT = 0, 1, 2
+profiler = LoopProfiler(("shooting", "turning", "height"), enabled=PROFILE)
+
+# Unpacks MR's commands and drops resent ones, see mr_frames.pack_command
+downlink = Downlink(ble, profiler=profiler)
+
+# Made once here and reused for every swing
+swing = SwingPeak()
+
+def handle_events():
+    """Acts on what the BLE IRQ recorded since the last call. Returns True if 
+    MR asked for a reset, the mode loops then go back to shooting mode."""
+    reset = False
+    # Gives a central that couldn't keep up another go at what's queued
+    ble.pump()
+    while ble.any():
+        kind, conn_handle, data = ble.read()
+        if kind == EVENT_CONNECT:
+            print("Connection", conn_handle)
+            for i in range(50):
+                hub.light_matrix.show_image("ARROW_N", i*2)
+        elif kind == EVENT_DISCONNECT:
+            print("Disconnected", conn_handle)
+            downlink.forget(conn_handle)
+        elif kind == EVENT_WRITE:
+            cmd = downlink.read(conn_handle, data)
+            if cmd is None:
+                continue
+            command, msg = cmd
+            print("Rx", command, msg)
+            # Older MR projects write "score" and "reset" as text
+            if command == CMD_SCORE or msg == "score":
+                winning_display()
+            elif command == CMD_RESET or msg == "reset":
+                reset = True
+    return reset
 
 def turning_mode():
     """Loop that controls the robot's turning"""
@@ -158,23 +90,29 @@ def turning_mode():
         hub.light_matrix.show_image("SQUARE_SMALL", i*2)
 
     while True:
+        started = profiler.start()
+        # Back to shooting mode if MR sent "reset"
+        if handle_events():
+            break
+
         # Robot turns when -1 or 1 is sent, stops turning when 0 is sent
         if hub.left_button.is_pressed(): 
-            ble.send(str(-1))
+            ble.send(frame.pack(GOLF_TURN, -1))
             print("sent left")
             hub.left_button.wait_until_released()
-            ble.send(str(0))
+            ble.send(frame.pack(GOLF_TURN, 0))
             print("sent neutral")
         elif hub.right_button.is_pressed():
-            ble.send(str(1))
+            ble.send(frame.pack(GOLF_TURN, 1))
             print("sent right")
             hub.right_button.wait_until_released()
-            ble.send(str(0))
+            ble.send(frame.pack(GOLF_TURN, 0))
             print("sent neutral")
         # Cycles to height_mode when tapped
         elif hub.motion_sensor.get_gesture() == "tapped":
             height_mode()
             break
+        profiler.stop(TURNING, started)
 
 def height_mode():
     """Loop that controls the trajectory's height"""
@@ -192,22 +130,28 @@ def height_mode():
         hub.light_matrix.set_pixel(3, 3, i*2)
 
     while True:
+        started = profiler.start()
+        # Back to shooting mode if MR sent "reset"
+        if handle_events():
+            break
+
         # Same mechanism as in turning_mode()
         if hub.left_button.is_pressed():
-            ble.send(str(2))
+            ble.send(frame.pack(GOLF_HEIGHT, -1))
             print("sent down")
             hub.left_button.wait_until_released()
-            ble.send(str(3))
+            ble.send(frame.pack(GOLF_HEIGHT, 0))
             print("sent neutral")
         elif hub.right_button.is_pressed():
-            ble.send(str(4))
+            ble.send(frame.pack(GOLF_HEIGHT, 1))
             print("sent up")
             hub.right_button.wait_until_released()
-            ble.send(str(3))
+            ble.send(frame.pack(GOLF_HEIGHT, 0))
             print("sent neutral")
         # Cycles to main_loop() when tapped
         elif hub.motion_sensor.get_gesture() == "tapped":
             break
+        profiler.stop(HEIGHT, started)
 
 def main_loop():
     """Loop that is responsible for shooting ball based on accelerometer data"""
@@ -217,41 +161,46 @@ def main_loop():
         for i in range(50):
             hub.light_matrix.show_image("ARROW_N", i*2)
 
-        accs = []
-
         while True:
+            # A pass with a swing in it includes the swing
+            started = profiler.start()
+            # Back to shooting mode if MR sent "reset"
+            if handle_events():
+                break
             if hub.left_button.is_pressed():
                 print("collecting data")
                 # Display slower arrow when left button is pressed
                 for i in range(100):
                     hub.light_matrix.show_image("ARROW_N", i)
                     time.sleep(0.01)
+                swing.start()
                 while hub.left_button.is_pressed():
                     # Instantaneous x y z acceleration
                     (a_x, a_y, a_z) = motion.accelerometer()
 
-                    # Take magnitude of x, and y acceleration and append to 
-                    # array
-                    mag = math.sqrt(a_x**2 + a_y**2)
-                    accs.append(mag)
+                    # Keep track of the magnitude of x and y acceleration
+                    swing.add(a_x, a_y)
 
                     # Samples acceleration every 0.01 seconds
                     time.sleep(0.01)
             
-                try:
-                    acc = max(accs)
+                if swing.count:
+                    acc = swing.peak()
                     print("Acceleration: ", acc)
-                    ble.send(str(acc))
+                    ble.send(frame.pack(GOLF_SHOOT, int(acc)))
                 # If no acc data was collected before button was released
-                except ValueError:
+                else:
                     print("Hold down the button for longer!")
             # Cycles to turning_mode() when tapped
             elif hub.motion_sensor.get_gesture() == "tapped":
                 turning_mode()
                 break
+            profiler.stop(SHOOTING, started)
 
 #  Minimizes lag during first connection
 while True:
+    handle_events()
+
     if ble.is_connected():
         time.sleep(1)
         main_loop()
@@ -21,144 +21,86 @@ from spike import (PrimeHub, LightMatrix, Button, ColorSensor, MotionSensor,
                    Motor)
 from spike.control import wait_for_seconds, wait_until, Timer
 from hub import motion
-import math, bluetooth, time, struct, random
-from micropython import const
-
-# Set up Bluetooth structure data, provided to us by the Mind Render folks and 
-# then modified.
-# This takes up a lot of the code, to skip to the main content jump to line 
-# 155. Remember to change the name of your SPIKE (if you want) on line 109.
-_ADV_TYPE_FLAGS = const(0x01)
-_ADV_TYPE_NAME = const(0x09)
-_ADV_TYPE_UUID16_COMPLETE = const(0x3)
-_ADV_TYPE_UUID32_COMPLETE = const(0x5)
-_ADV_TYPE_UUID128_COMPLETE = const(0x7)
-_ADV_TYPE_UUID16_MORE = const(0x2)
-_ADV_TYPE_UUID32_MORE = const(0x4)
-_ADV_TYPE_UUID128_MORE = const(0x6)
-_ADV_TYPE_APPEARANCE = const(0x19)
-_ADV_TYPE_SPECIFIC_DATA = const(0xFF)
-_ADV_DATA_COMPANY_ID = const(0xFFFF)
-
-def advertising_payload(limited_disc=False, br_edr=False, name=None, 
-                        services=None, appearance=0, free=None):
-    payload = bytearray()
-    
-    def _append(adv_type, value):
-        nonlocal payload
-        payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-    _append(
-        _ADV_TYPE_FLAGS,
-        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr 
-                                                             else 0x04)),
-    )
-
-    if name:
-        _append(_ADV_TYPE_NAME, name)
-
-    if services:
-        for uuid in services:
-            b = bytes(uuid)
-            if len(b) == 2:
-                _append(_ADV_TYPE_UUID16_COMPLETE, b)
-            elif len(b) == 4:
-                _append(_ADV_TYPE_UUID32_COMPLETE, b)
-            elif len(b) == 16:
-                _append(_ADV_TYPE_UUID128_COMPLETE, b)
-
-    if appearance:
-        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
-
-    return payload
-
-_IRQ_CENTRAL_CONNECT = const(1)
-_IRQ_CENTRAL_DISCONNECT = const(2)
-_IRQ_GATTS_WRITE = const(3)
-_IRQ_MTU_EXCHANGED = const(21)
-
-_UART_UUID = bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")
-_UART_RX = (
-    bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE,
-)
-_UART_TX = (
-    bluetooth.UUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_NOTIFY,
-)
-_UART_SERVICE = (
-    _UART_UUID,
-    (_UART_TX, _UART_RX),
-)
-
+import time
+from mr_frames import (FrameWriter, SCHEMA_GOLF, GOLF_SHOOT, GOLF_TURN, 
+                       GOLF_HEIGHT, CMD_SCORE, CMD_RESET)
+
+# The Bluetooth setup (advertising, the UART service MR talks to and the 
+# BLEPeripheral class) lives in mr_ble.py, save it onto the SPIKE along with 
+# mr_frames.py
+from mr_ble import (BLEPeripheral, SendRate, DeltaFilter, Downlink, 
+                    LoopProfiler, EVENT_CONNECT, EVENT_SUBSCRIBE, 
+                    EVENT_DISCONNECT, EVENT_WRITE)
+# The swing's peak is worked out by swing_peak.py, in the shared folder, 
+# save that onto the SPIKE too
+from swing_peak import SwingPeak
 
 def won():
     """Display target when player completes the hole."""
     for i in range(50):
         hub.light_matrix.show_image("YES", i*2)
 
-class BLEPeripheral:
-    def __init__(self):
-        self._ble = bluetooth.BLE()
-        self._ble.active(True)
-        self._ble.irq(self._irq)
-        ((self._handle_tx, self._handle_rx),) = \ 
-            self._ble.gatts_register_services((_UART_SERVICE,))
-        self._connections = set()
-        rand = random.randint(1, 100)
-        golf = "golf" + str(rand)
-        self._payload = advertising_payload(name=golf, services=[_UART_UUID])
-        self._advertise()
-
-    def is_connected(self):
-        return len(self._connections) > 0
-
-    def send(self, data):
-        if self.is_connected():
-            for handle in self._connections:
-                self._ble.gatts_notify(handle, self._handle_rx, data)
-                self._ble.gatts_notify(handle, self._handle_tx, data)
-
-    def _irq(self, event, data):
-        if event == _IRQ_CENTRAL_CONNECT:
-            conn_handle, _, _ = data
-            self._connections.add(conn_handle)
-            print("Connection", conn_handle)
-
-        elif event == _IRQ_CENTRAL_DISCONNECT:
-            print("Disconnected")
-            conn_handle, _, _ = data
-            if conn_handle in self._connections:
-                self._connections.remove(conn_handle)
-                
-            # self._advertise()
-            print("Disconnected", conn_handle)
-
-        elif event == _IRQ_GATTS_WRITE:
-            print('Read')
-            conn_handle, value_handle = data
-
-            value = self._ble.gatts_read(value_handle)
-            if value_handle == self._handle_rx:
-                msg = value.decode()
-                print("Rx", msg)
-                if msg == "score":
-                    won()
-                elif msg == "reset":
-                    main_loop()
-
-    def _advertise(self):
-        self._ble.gap_advertise(500000, adv_data=self._payload)
-        # self._ble.gap_advertise(500, "MindRender")
-        print("Advertising")
-
 # Initialize hub
 hub = PrimeHub()
 
 # Indicate that hub is advertising
 hub.light_matrix.show_image('HAPPY')
 
-ble = BLEPeripheral()
+# Change "golf" if you want the hub to be called something else
+ble = BLEPeripheral("golf", SCHEMA_GOLF)
+
+# Frame buffer is made once here and reused, see mr_frames.py for layout
+frame = FrameWriter(SCHEMA_GOLF)
+
+# Picks how long to wait between samples in turning and height mode: short 
+# while the wheel is turning, longer while it's still or MR can't keep up
+rate = SendRate()
+
+# Turning and height only send when the wheel moved, plus a keyframe every 
+# half second in case MR missed one
+delta = DeltaFilter()
+
+# Set PROFILE to True to time every pass of the shooting, turning and height 
+# loops on the hub, then run latency_probe.py --stats on your computer to see 
+# how long they take
+PROFILE = False
+SHOOTING, TURNING, HEIGHT = 0, 1, 2
+profiler = LoopProfiler(("shooting", "turning", "height"), enabled=PROFILE)
+
+# Unpacks MR's commands and drops resent ones, see mr_frames.pack_command
+downlink = Downlink(ble, profiler=profiler)
+
+# Made once here and reused for every swing
+swing = SwingPeak()
+
+def handle_events():
+    """Acts on what the BLE IRQ recorded since the last call. Returns True if 
+    MR asked for a reset, the mode loops then go back to shooting mode."""
+    reset = False
+    # Gives a central that couldn't keep up another go at what's queued
+    ble.pump()
+    while ble.any():
+        kind, conn_handle, data = ble.read()
+        if kind == EVENT_CONNECT:
+            print("Connection", conn_handle)
+        elif kind == EVENT_SUBSCRIBE:
+            # Only now does it get what's sent, so send it where things are
+            delta.keyframe()
+        elif kind == EVENT_DISCONNECT:
+            print("Disconnected", conn_handle)
+            downlink.forget(conn_handle)
+        elif kind == EVENT_WRITE:
+            cmd = downlink.read(conn_handle, data)
+            if cmd is None:
+                continue
+            command, msg = cmd
+            print("Rx", command, msg)
+            # Older MR projects write "score" and "reset" as text
+            if command == CMD_SCORE or msg == "score":
+                won()
+            elif command == CMD_RESET or msg == "reset":
+                reset = True
+    return reset
 
 # Store the degrees counted by the sensor sensor when program exits turning 
 # mode globally so it can be accessed next time the function is called. 
@@ -179,16 +121,29 @@ def turning_mode():
     
     # Start degrees counted where the function last left off
     sensor.set_degrees_counted(last_degrees_counted1)
+    # Let MR know where the wheel is as soon as the mode starts
+    delta.keyframe()
     while True:
+        started = profiler.start()
+        # Back to shooting mode if MR sent "reset", keeping where the sensor 
+        # got to like tapping out does
+        if handle_events():
+            last_degrees_counted1 = sensor.get_degrees_counted()
+            break
+
         # Inverse degree reading to make clockwise rotation of sensor 
         # correspond to clockwise (right) rotation of robot
         degrees = sensor.get_degrees_counted() * -1
         
-        # "turn:" tag indicates to MR that incoming data controls turning
-        ble.send("turn:" + str(degrees / 5))
-        # Sleep time should be tweaked for your system, but for the Microsoft 
-        # Surface Studio Laptop we tested on, 0.02 seconds was optimal.
-        time.sleep(0.02)
+        # GOLF_TURN kind tells MR that this controls turning, MR divides the 
+        # degrees by 5
+        flags = delta.check(degrees)
+        if flags >= 0:
+            ble.send(frame.pack(GOLF_TURN, degrees, flags=flags))
+        profiler.stop(TURNING, started)
+        # No need to tweak a sleep for your system anymore, SendRate slows 
+        # down by itself if MR can't keep up
+        time.sleep_ms(rate.update(ble, degrees))
 
         # Cycles to height_mode when tapped
         if hub.motion_sensor.get_gesture() == "tapped":
@@ -223,7 +178,15 @@ def height_mode():
     global last_degrees_counted2
 
     sensor.set_degrees_counted(last_degrees_counted2)
+    delta.keyframe()
     while True:
+        started = profiler.start()
+        # Back to shooting mode if MR sent "reset", keeping where the sensor 
+        # got to like tapping out does
+        if handle_events():
+            last_degrees_counted2 = sensor.get_degrees_counted()
+            break
+
         # Since the height gauge in MR caps goes from 0 to 50 and starts at 
         # 25, degrees are capped at 250 which in turn is divided by ten which 
         # means the actual number sent is limited between 25 and -25.
@@ -236,8 +199,12 @@ def height_mode():
             degrees = -250
             sensor.set_degrees_counted(-250)
 
-        ble.send("height:" + str(degrees / 10))
-        time.sleep(0.02)
+        # MR divides by 10 to get the height
+        flags = delta.check(degrees)
+        if flags >= 0:
+            ble.send(frame.pack(GOLF_HEIGHT, degrees, flags=flags))
+        profiler.stop(HEIGHT, started)
+        time.sleep_ms(rate.update(ble, degrees))
 
         # Cycles to main_loop() when tapped
         if hub.motion_sensor.get_gesture() == "tapped":
@@ -258,9 +225,13 @@ def main_loop():
         for i in range(50):
             hub.light_matrix.show_image("ARROW_N", i*2)
 
-        accs = []
-
         while True:
+            # A pass with a swing in it includes the swing
+            started = profiler.start()
+            # Back to shooting mode if MR sent "reset"
+            if handle_events():
+                break
+
             # If sensor is covered
             if color.get_reflected_light() > 40:
                 print("collecting data")
@@ -268,26 +239,25 @@ def main_loop():
                 # Turn off light matrix to indicate data collecting
                 hub.light_matrix.off()
 
+                swing.start()
                 while color.get_reflected_light() > 40:
                     # Instantaneous x y z acceleration
                     (a_x, a_y, a_z) = motion.accelerometer()
 
-                    # Take magnitude of x, and y acceleration and append to 
-                    # array
-                    mag = math.sqrt(a_x**2 + a_y**2)
-                    accs.append(mag)
+                    # Keep track of the magnitude of x and y acceleration
+                    swing.add(a_x, a_y)
 
                     # Samples acceleration every 0.01 seconds
                     time.sleep(0.01)
             
-                try:
-                    acc = max(accs)
+                if swing.count:
+                    acc = swing.peak()
                     print("Acceleration: ", acc)
                     for i in range(50):
                         hub.light_matrix.show_image("ARROW_N", i*2)
-                    ble.send("shoot:" + str(acc))
+                    ble.send(frame.pack(GOLF_SHOOT, int(acc)))
                 # If no acc data was collected before button was released
-                except ValueError:
+                else:
                     print("Hold down the button for longer!")
                     for i in range(50):
                         hub.light_matrix.show_image("ARROW_N", i*2)
@@ -296,9 +266,11 @@ def main_loop():
             elif hub.motion_sensor.get_gesture() == "tapped":
                 turning_mode()
                 break
+            profiler.stop(SHOOTING, started)
 
 # Minimizes lag during first connection
 while True:
+    handle_events()
     if ble.is_connected():
         time.sleep(1)
         main_loop()
@@ -8,10 +8,24 @@ Example LEGO FF steering wheel can be found in this folder
 Accompanying MR environment: FF Driving BLE v8; share code: spikedriving
 
 To do
-- Make it faster maybe
+- Make it faster maybe (python3 sim/bench.py wheel says how fast it is now)
 - Add comments to the BLEPeripheral class
 
 Changelog
+10/18/26
+- Writes from MR are queued by the BLE IRQ and wake receiving() instead of 
+  receiving() reading handle 12 every 10 ms, so repeated rumble values aren't 
+  dropped anymore
+- The BLE IRQ no longer beeps or sleeps, connect/disconnect sounds are played 
+  by receiving()
+- sending() picks its own send rate (SendRate) instead of sleeping 10 ms
+- Samples are only sent when something moved, plus a keyframe every 500 ms
+- Notifies go out from their own task (pumping()) through a queue per central
+- Rumble can come as a numbered CMD_RUMBLE command (acked if MR asks), text 
+  still works
+- Frames are timestamped, in the computer's time once it syncs the clock
+- PROFILE times sending(), receiving() and rumble(), read the numbers with 
+  latency_probe.py --stats
 8/4/22
 - Modified the steering so it no longer switches directions when past 360 and 0 
   degrees.
@@ -25,149 +39,59 @@ Changelog
 """
 
 # Initialize the hub and get your imports
-import bluetooth, hub, struct
+import hub
 import uasyncio as ua
 from spike import Motor, ForceSensor
-from micropython import const
 from time import sleep
-from random import randint
-
-# Set up Bluetooth structure data, provided to us by the Mind Render folks and 
-# then modified.
-# This takes up a lot of the code, to skip to the main content jump to line 
-# 169. Remember to change the name of your SPIKE (if you want) on line 111.
-_ADV_TYPE_FLAGS = const(0x01)
-_ADV_TYPE_NAME = const(0x09)
-_ADV_TYPE_UUID16_COMPLETE = const(0x3)
-_ADV_TYPE_UUID32_COMPLETE = const(0x5)
-_ADV_TYPE_UUID128_COMPLETE = const(0x7)
-_ADV_TYPE_UUID16_MORE = const(0x2)
-_ADV_TYPE_UUID32_MORE = const(0x4)
-_ADV_TYPE_UUID128_MORE = const(0x6)
-_ADV_TYPE_APPEARANCE = const(0x19)
-_ADV_TYPE_SPECIFIC_DATA = const(0xFF)
-_ADV_DATA_COMPANY_ID = const(0xFFFF)
-
-def advertising_payload(limited_disc=False, br_edr=False, name=None, 
-                        services=None, appearance=0, free=None):
-    payload = bytearray()
-
-    def _append(adv_type, value):
-        nonlocal payload
-        payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-    _append(
-        _ADV_TYPE_FLAGS,
-        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr 
-                                                             else 0x04)),
-    )
-
-    if name:
-        _append(_ADV_TYPE_NAME, name)
-
-    if services:
-        for uuid in services:
-            b = bytes(uuid)
-            if len(b) == 2:
-                _append(_ADV_TYPE_UUID16_COMPLETE, b)
-            elif len(b) == 4:
-                _append(_ADV_TYPE_UUID32_COMPLETE, b)
-            elif len(b) == 16:
-                _append(_ADV_TYPE_UUID128_COMPLETE, b)
-
-    if appearance:
-        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
-
-    return payload
-
-_IRQ_CENTRAL_CONNECT = const(1)
-_IRQ_CENTRAL_DISCONNECT = const(2)
-_IRQ_GATTS_WRITE = const(3)
-_IRQ_MTU_EXCHANGED = const(21)
-
-_UART_UUID = bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")
-_UART_RX = (
-    bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE,
-)
-_UART_TX = (
-    bluetooth.UUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E"),
-    bluetooth.FLAG_NOTIFY,
-)
-_UART_SERVICE = (
-    _UART_UUID,
-    (_UART_TX, _UART_RX),
-)
-
-class BLEPeripheral:
-    def __init__(self):
-        self._ble = bluetooth.BLE()
-        self._ble.active(True)
-        self._ble.irq(self._irq)
-        ((self._handle_tx, self._handle_rx),) = \
-            self._ble.gatts_register_services((_UART_SERVICE,))
-        self._connections = set()
-        # Change name here, keep it < 9 characters
-        adv_name = "wheel" + str(randint(1, 100)) 
-        self._payload = advertising_payload(name=adv_name, 
-                                            services=[_UART_UUID])
-        self._advertise(adv_name)
-
-    def is_connected(self):
-        return len(self._connections) > 0
-
-    def send(self, data):
-        if self.is_connected():
-            for handle in self._connections:
-                self._ble.gatts_notify(handle, self._handle_rx, data)
-                self._ble.gatts_notify(handle, self._handle_tx, data)
-
-    def _irq(self, event, data):
-        if event == _IRQ_CENTRAL_CONNECT:
-            print('_IRQ_CENTRAL_CONNECT')
-            hub.sound.beep(750,100) # A little sound effect when it connects
-            sleep(.1)
-            hub.sound.beep(800,100)
-            conn_handle, _, _ = data
-            self._connections.add(conn_handle)
-            print("Connected | Handle:", conn_handle)
-
-        elif event == _IRQ_CENTRAL_DISCONNECT:
-            print('line 119|_IRQ_CENTRAL_DISCONNECT')
-            hub.sound.beep(800,100) # A little sound effect when it disconnects
-            sleep(.1)
-            hub.sound.beep(750,100)
-            conn_handle, _, _ = data
-            if conn_handle in self._connections:
-                self._connections.remove(conn_handle)
-            print("Disconnected | Handle:", conn_handle)
-
-        # Have to bypass this entire thing because for some reason it sleeps 
-        # (I think it's from the BLE source code but don't know)
-        # elif event == _IRQ_GATTS_WRITE:
-            # print('line 130|_IRQ_GATTS_WRITE')
-            # conn_handle, value_handle = data
-            # value = self._ble.gatts_read(value_handle)
-            # if value_handle == self._handle_rx:
-            #    msg = float(value.decode()) # Decoding what we read and 
-            #    turning it into a decimal
-            #    # print("received |", msg)
-            #    # await ua.create_task(rumble(msg))
-
-
-    def _advertise(self, name):
-        self._ble.gap_advertise(500000, adv_data=self._payload)
-        # A little sound effect when it starts advertising
-        hub.sound.beep(800,150) 
-        sleep(.18)
-        hub.sound.beep(750,150)
-        sleep(.18)
-        hub.sound.beep(800,150)
-        print("Advertising as", name)
+from mr_frames import FrameWriter, HostClock, SCHEMA_WHEEL, CMD_RUMBLE
 
+# The Bluetooth setup (advertising, the UART service MR talks to and the 
+# BLEPeripheral class) lives in mr_ble.py, save it onto the SPIKE along with 
+# mr_frames.py
+from mr_ble import (BLEPeripheral, SendRate, DeltaFilter, Downlink, CMD_TEXT, 
+                    LoopProfiler, EVENT_CONNECT, EVENT_SUBSCRIBE, 
+                    EVENT_DISCONNECT, EVENT_WRITE)
 
 # This is where our code really begins, post BLE setup stuff
-ble = BLEPeripheral()
+
+# Wakes receiving() up when the BLE IRQ records something. ThreadSafeFlag is 
+# made for being set from an IRQ but older firmware only has Event.
+if hasattr(ua, "ThreadSafeFlag"):
+    event_flag = ua.ThreadSafeFlag()
+else:
+    event_flag = ua.Event()
+
+# Change "wheel" if you want the hub to be called something else. Adding 
+# batch=4 sends 4 samples per notify instead of 1 once MR reads batches 
+# (mr_frames.decode_all), it trades up to 30 ms of delay (batch_ms, how long 
+# a sample waits at most for the rest of its batch) for a quarter of the 
+# notifies. Notifies are sent by pumping() instead of inside ble.send().
+ble = BLEPeripheral("wheel", SCHEMA_WHEEL, event_flag, auto_pump=False)
+
+# Only samples where the wheel or a pedal moved are sent, plus a keyframe 
+# every half second in case MR missed one
+delta = DeltaFilter()
+
+# Set PROFILE to True to time every pass of sending(), receiving() and 
+# rumble() on the hub, then run latency_probe.py --stats on your computer to 
+# see how long they take (nothing gets printed, printing slows the loops down)
+PROFILE = False
+SENDING, RECEIVING, RUMBLE = 0, 1, 2
+profiler = LoopProfiler(("sending", "receiving", "rumble"), enabled=PROFILE)
+
+# Unpacks MR's rumble commands and drops resent ones, so every rumble happens 
+# exactly once even when MR asks for the same strength twice in a row. It also 
+# answers pings and keeps clock in line with the computer's clock (see 
+# mr_sync.py), which sending() stamps every frame with.
+clock = HostClock()
+downlink = Downlink(ble, clock, profiler)
+
+# A little sound effect when it starts advertising
+hub.sound.beep(800,150) 
+sleep(.18)
+hub.sound.beep(750,150)
+sleep(.18)
+hub.sound.beep(800,150)
 
 # Quick light to make sure code is up and running
 hub.display.clear()
@@ -193,50 +117,100 @@ steer.stop()
 
 # Async function for sending SPIKE data to MR
 async def sending():
+    # Frame buffer is made once here and reused, see mr_frames.py for layout. 
+    # Every frame says when it was sampled, in the computer's time once the 
+    # computer has synced the clock (hub time until then), so MR can tell 
+    # jitter from the wheel actually moving.
+    frame = FrameWriter(SCHEMA_WHEEL, timestamp=True, clock=clock)
+    # Sends every 10 ms while the wheel or pedals move and slows down while 
+    # they're still or MR can't keep up, so no sleep needs tuning per laptop
+    rate = SendRate()
     while True:
+        started = profiler.start()
         degrees = steer.get_degrees_counted()
         if degrees > 360:
             degrees = 360
         elif degrees < 0:
             degrees = 0
+        gas_pct = gas.get_force_percentage()
+        brake_pct = brake.get_force_percentage()
         
-        payload = (str(degrees) + "," + str(gas.get_force_percentage()) + "," + 
-                   str(brake.get_force_percentage()))
-        ble.send(payload)
-        # print(payload) # xUncomment if you're sus at what data is being sent 
-        # and you want to see
-        await ua.sleep(.01)
+        flags = delta.check(degrees, gas_pct, brake_pct)
+        if flags >= 0:
+            payload = frame.pack(degrees, gas_pct, brake_pct, flags)
+            ble.send(payload)
+            # print(payload) # xUncomment if you're sus at what data is being 
+            # sent and you want to see
+        profiler.stop(SENDING, started)
+        await ua.sleep_ms(rate.update(ble, degrees, gas_pct, brake_pct))
+
+# Async function that sends what sending() queued. Every central connected 
+# has its own queue, so a laptop that's slow to take notifies only falls 
+# behind on its own and sending() never waits on it.
+async def pumping():
+    while True:
+        ble.pump()
+        await ua.sleep_ms(5)
 
 # Async function for the force feedback, called from receiving()
 async def rumble(speed):
+    started = profiler.start()
     steer.start(round(speed))
     await ua.sleep(.25)
     steer.start(round(-speed))
     await ua.sleep(.25)
     steer.stop()
+    profiler.stop(RUMBLE, started)
 
-# Async function to get info from MR and process it as required
+# Async function to get info from MR and process it as required. Everything 
+# the BLE IRQ records ends up here: connection sounds and the rumble all run 
+# in this task so the IRQ itself never waits on anything.
 async def receiving():
-    old_data = ""
     while True:
-        # 10 for connection statuses, 12 for data Tx (from what I can tell); 
-        # don't change
-        value_handle = 12
-        new_data = ble._ble.gatts_read(value_handle)
-        
-        # Need the second condition for edge case when it starts
-        if (not new_data == old_data) and new_data: 
-            old_data = new_data
-            msg = float(new_data.decode())
-            # Uncomment to see if you're sus
-            # print("msg |", msg,"|| going to rumble")
-            await rumble(msg)
-
-        await ua.sleep(.01)
+        # Sleeps until the IRQ records an event, so nothing gets polled and a 
+        # repeat of the same rumble value still counts as a new message
+        await event_flag.wait()
+        started = profiler.start()
+        # Event has to be cleared by hand, ThreadSafeFlag clears itself
+        if hasattr(event_flag, "clear"):
+            event_flag.clear()
+
+        while ble.any():
+            kind, conn_handle, data = ble.read()
+            if kind == EVENT_CONNECT:
+                print("Connected | Handle:", conn_handle)
+                # A little sound effect when it connects
+                hub.sound.beep(750,100)
+                await ua.sleep(.1)
+                hub.sound.beep(800,100)
+            elif kind == EVENT_SUBSCRIBE:
+                # New central needs the current position straight away, 
+                # anything sent before it subscribed didn't reach it
+                delta.keyframe()
+            elif kind == EVENT_DISCONNECT:
+                print("Disconnected | Handle:", conn_handle)
+                downlink.forget(conn_handle)
+                # A little sound effect when it disconnects
+                hub.sound.beep(800,100)
+                await ua.sleep(.1)
+                hub.sound.beep(750,100)
+            elif kind == EVENT_WRITE:
+                cmd = downlink.read(conn_handle, data)
+                if cmd is None:
+                    continue
+                command, msg = cmd
+                # Uncomment to see if you're sus
+                # print("msg |", msg,"|| going to rumble")
+                if command == CMD_RUMBLE:
+                    await rumble(msg)
+                elif command == CMD_TEXT:
+                    await rumble(float(msg))
+        profiler.stop(RECEIVING, started)
 
 # Putting everything together
 async def main():
     ua.create_task(receiving())
+    ua.create_task(pumping())
     await ua.create_task(sending())
 
 # Run
@@ -0,0 +1,37 @@
+"""
+Computer code (not SPIKE code) that compiles the shared hub modules to .mpy 
+bytecode. The hub can load a .mpy straight away instead of compiling the 
+source every time a program starts, which is faster and doesn't need the RAM 
+the compiler uses. Save the .mpy files it makes onto the SPIKE instead of the 
+.py files (startup_benchmark.py shows the difference).
+
+Needs mpy-cross from the same MicroPython version as the hub's firmware (run 
+"import sys; print(sys.version)" on the hub to check), e.g.
+    pip install mpy-cross==1.12
+A .mpy made by a different version won't import on the hub ("incompatible 
+.mpy file").
+
+Usage: python build_mpy.py [path to mpy-cross]
+"""
+
+import os, subprocess, sys
+
+# Shared modules the hub programs import
+MODULES = ["mr_ble.py", "mr_frames.py"]
+
+def main():
+    mpy_cross = sys.argv[1] if len(sys.argv) > 1 else "mpy-cross"
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in MODULES:
+        src = os.path.join(here, name)
+        out = src[:-3] + ".mpy"
+        try:
+            subprocess.run([mpy_cross, "-o", out, src], check=True)
+        except FileNotFoundError:
+            sys.exit("Couldn't find mpy-cross, install it with pip or pass "
+                     "its path")
+        print("Built", os.path.basename(out), os.path.getsize(out), "bytes",
+              "(source", os.path.getsize(src), "bytes)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Computer code (not SPIKE code) that measures how long data takes to get
+between the computer and one or more hubs, so hubs, laptops and send rates
+can be compared with numbers.
+
+It connects to every MR hub it finds (or the ones whose name starts with
+--name), writes CMD_PING commands to them and times the SCHEMA_PONG answers:
+- RTT: from writing the ping to getting the pong
+- hub: how long the ping sat on the hub before it was answered
+- one way: (RTT - hub) / 2, a guess at the time in the air each way
+- age: if the hub program stamps its frames (FrameWriter(...,
+  timestamp=True)), how old each sample is when it arrives
+
+The pongs also feed an mr_sync.ClockSync, and every --sync pongs the
+estimate is written back to the hub, so programs with a HostClock switch to
+stamping frames in this computer's time. The final offset and drift are
+printed too.
+
+--record FILE saves every notify to a trace file that mr_jitter.py can play
+back offline.
+
+--stats asks the hub program for its loop timings afterwards (CMD_STATS,
+the program needs PROFILE = True, see mr_ble.LoopProfiler) and prints how
+many passes of each loop took how long, plus the hub's free memory and how
+many garbage collections it saw. --reset starts the hub's counts over after
+reading them.
+
+The hub program has to read its writes through mr_ble.Downlink for pings to
+be answered. Close MR first if it's connected, or run this alongside it (a
+hub feeds up to 4 centrals).
+
+Needs bleak (pip install bleak), and mr_frames.py and mr_sync.py from this
+folder.
+
+Usage: python latency_probe.py [--name wheel] [--count 200] [--interval 50]
+                               [--stats] [--reset]
+"""
+
+import argparse, asyncio, os, sys, time
+
+from mr_frames import (decode_all, decode_advert, pack_command, ticks_diff,
+                       ADVERT_COMPANY_ID, CMD_PING, CMD_STATS, STATS_RESET,
+                       PROFILE_BUCKETS_US, SCHEMA_PONG, SCHEMA_LOOP,
+                       SCHEMA_HISTOGRAM, SCHEMA_MEMORY)
+from mr_sync import ClockSync, host_time
+from mr_jitter import TraceWriter
+
+try:
+    from bleak import BleakClient, BleakScanner
+except ImportError:
+    print("latency_probe.py needs bleak, install it with: pip install bleak")
+    sys.exit(1)
+
+_UART_RX = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
+_UART_TX = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
+
+
+def percentile(values, p):
+    """Nearest rank percentile of a list, p from 0 to 100"""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = int(round(p / 100 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class Probe:
+    """Pings one hub and keeps the timings, all in microseconds"""
+    def __init__(self, name, trace=None):
+        self.name = name
+        self.trace = trace
+        self.sent = {}
+        self.pings = 0
+        self.rtt = []
+        self.hub = []
+        self.one_way = []
+        self.ages = []
+        self.bad = 0
+        self.sync = ClockSync()
+        self._pongs = 0
+        # From CMD_STATS: loop number to its SCHEMA_LOOP and
+        # SCHEMA_HISTOGRAM frames, and the latest SCHEMA_MEMORY
+        self.loops = {}
+        self.histograms = {}
+        self.memory = None
+
+    def on_notify(self, _, data):
+        now = time.perf_counter_ns() // 1000
+        if self.trace is not None:
+            self.trace.write(now, data)
+        try:
+            frames = decode_all(bytes(data))
+        except ValueError:
+            self.bad += 1
+            return
+        for frame in frames:
+            if frame.schema == SCHEMA_PONG:
+                sent = self.sent.pop(frame.token, None)
+                if sent is None:
+                    continue
+                rtt = now - sent
+                hub = ticks_diff(frame.tx_us, frame.rx_us)
+                self.rtt.append(rtt)
+                self.hub.append(hub)
+                self.one_way.append((rtt - hub) / 2)
+                self.sync.add(sent, frame.rx_us, frame.tx_us, now)
+                self._pongs += 1
+            elif frame.schema == SCHEMA_LOOP:
+                self.loops[frame.loop] = frame
+            elif frame.schema == SCHEMA_HISTOGRAM:
+                self.histograms[frame.loop] = frame
+            elif frame.schema == SCHEMA_MEMORY:
+                self.memory = frame
+            elif frame.host_time:
+                self.ages.append(now - host_time(frame.stamp_us, now))
+            elif frame.stamp_us is not None and self.sync.offset is not None:
+                self.ages.append(now - self.sync.to_host(frame.stamp_us, now))
+
+    async def run(self, device, count, interval_ms, sync_every, stats=False,
+                  reset=False):
+        async with BleakClient(device) as client:
+            await client.start_notify(_UART_TX, self.on_notify)
+            synced = 0
+            for token in range(count):
+                self.sent[token] = time.perf_counter_ns() // 1000
+                self.pings += 1
+                await client.write_gatt_char(
+                    _UART_RX, pack_command(CMD_PING, 0, token),
+                    response=False)
+                if sync_every and self._pongs - synced >= sync_every:
+                    synced = self._pongs
+                    now = time.perf_counter_ns() // 1000
+                    await client.write_gatt_char(
+                        _UART_RX, self.sync.clock_command(now),
+                        response=False)
+                    await client.write_gatt_char(
+                        _UART_RX, self.sync.drift_command(), response=False)
+                await asyncio.sleep(interval_ms / 1000)
+            # Give the last pongs a chance to arrive
+            await asyncio.sleep(0.5)
+            if stats:
+                await self.read_stats(client, reset)
+            await client.stop_notify(_UART_TX)
+
+    async def read_stats(self, client, reset):
+        """Asks for loop 0, which says how many loops there are, then the
+        rest"""
+        flag = STATS_RESET if reset else 0
+        loop = 0
+        while True:
+            await client.write_gatt_char(
+                _UART_RX, pack_command(CMD_STATS, 0, loop | flag),
+                response=False)
+            await asyncio.sleep(0.3)
+            first = self.loops.get(0)
+            loop += 1
+            if first is None or loop >= first.loops:
+                break
+
+    def report(self):
+        print(self.name)
+        lost = self.pings - len(self.rtt)
+        print("  pings {}, pongs {}, lost {}, bad notifies {}".format(
+            self.pings, len(self.rtt), lost, self.bad))
+        if self.sync.offset is not None:
+            print("  clock offset {:.0f} us, drift {:.1f} ppm".format(
+                self.sync.offset, self.sync.drift_ppm))
+        rows = [("RTT", self.rtt), ("hub", self.hub),
+                ("one way", self.one_way), ("age", self.ages)]
+        for label, values in rows:
+            print("  {:8} p50 {:8.0f}  p90 {:8.0f}  p99 {:8.0f}  "
+                  "max {:8.0f} us".format(
+                      label, percentile(values, 50), percentile(values, 90),
+                      percentile(values, 99),
+                      max(values) if values else float("nan")))
+        self.report_stats()
+
+    def report_stats(self):
+        if self.memory is not None:
+            print("  free memory {} bytes (lowest {}), {} garbage "
+                  "collections".format(self.memory.free,
+                                       self.memory.min_free,
+                                       self.memory.collections))
+        if not self.loops:
+            return
+        # Loops are numbered in the order the program named them
+        bounds = ["<{}".format(b / 1000) for b in PROFILE_BUCKETS_US]
+        bounds.append(">={}".format(PROFILE_BUCKETS_US[-1] / 1000))
+        print("  loop     passes   mean ms    max ms  " +
+              " ".join("{:>6}".format(b) for b in bounds) + " (ms)")
+        for number in sorted(self.loops):
+            loop = self.loops[number]
+            mean = loop.total_ms / loop.count if loop.count else float("nan")
+            counts = self.histograms.get(number)
+            cells = counts.values[1:] if counts is not None else ()
+            print("  {:<6} {:>8} {:>9.2f} {:>9.2f}  ".format(
+                number, loop.count, mean, loop.max_us / 1000) +
+                " ".join("{:>6}".format(c) for c in cells))
+
+
+async def find_hubs(prefix, timeout):
+    found = await BleakScanner.discover(timeout=timeout, return_adv=True)
+    hubs = []
+    for device, adv in found.values():
+        data = adv.manufacturer_data.get(ADVERT_COMPANY_ID)
+        if data is None or decode_advert(data) is None:
+            continue
+        name = adv.local_name or device.name or device.address
+        if prefix and not name.startswith(prefix):
+            continue
+        hubs.append((name, device))
+    return hubs
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Times pings to MR hubs over BLE")
+    parser.add_argument("--name", default="",
+                        help="only hubs whose name starts with this")
+    parser.add_argument("--count", type=int, default=200,
+                        help="pings per hub")
+    parser.add_argument("--interval", type=float, default=50,
+                        help="ms between pings")
+    parser.add_argument("--scan", type=float, default=5,
+                        help="seconds to look for hubs")
+    parser.add_argument("--sync", type=int, default=10,
+                        help="send the clock estimate every this many "
+                             "pongs, 0 to leave the hub's clock alone")
+    parser.add_argument("--record",
+                        help="save every notify to this trace file, one per "
+                             "hub if there are several (name added)")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the hub program's loop timings (it needs "
+                             "PROFILE = True)")
+    parser.add_argument("--reset", action="store_true",
+                        help="with --stats, start the hub's counts over")
+    args = parser.parse_args()
+
+    hubs = await find_hubs(args.name, args.scan)
+    if not hubs:
+        print("No MR hubs found")
+        return
+    probes = []
+    for name, _ in hubs:
+        trace = None
+        if args.record:
+            path = args.record
+            if len(hubs) > 1:
+                root, ext = os.path.splitext(path)
+                path = "{}_{}{}".format(root, name, ext)
+            trace = TraceWriter(path)
+        probes.append(Probe(name, trace))
+    await asyncio.gather(*[probe.run(device, args.count, args.interval,
+                                     args.sync, args.stats, args.reset)
+                           for probe, (_, device) in zip(probes, hubs)])
+    for probe in probes:
+        probe.report()
+        if probe.trace is not None:
+            probe.trace.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,830 @@
+"""
+Bluetooth setup shared by every BLE program in this folder: the advertising 
+payload, the UART service MR talks to and the BLEPeripheral class. It started 
+out as the code the Mind Render folks gave us, which used to be copy-pasted 
+into the top of every program.
+
+Having it in its own module means it can be compiled to mr_ble.mpy once on a 
+computer (see build_mpy.py) instead of the hub compiling all of it from source 
+every time a program starts. Save mr_ble.mpy (or mr_ble.py) and mr_frames.py 
+onto the SPIKE next to the program.
+
+Using it:
+    ble = BLEPeripheral("car", SCHEMA_CAR)
+    ble.send(frame)                 # notifies every subscribed central
+    while ble.any():                # connects, subscribes, disconnects and 
+                                    # writes from MR
+        kind, conn_handle, data = ble.read()
+    ble.pump()                      # lets a slow central catch up
+    downlink = Downlink(ble)        # commands from MR, see mr_frames
+    cmd = downlink.read(conn_handle, data)
+    rate = SendRate()               # instead of a fixed sleep between samples
+    utime.sleep_ms(rate.update(ble, pitch, roll))
+    delta = DeltaFilter()           # only send samples that changed
+    flags = delta.check(pitch, roll)
+    if flags >= 0:
+        ble.send(frame.pack(pitch, roll, flags=flags))
+    profiler = LoopProfiler(("sending",), enabled=True)
+    started = profiler.start()      # times a loop, read with CMD_STATS
+    profiler.stop(0, started)
+"""
+
+import bluetooth, gc, struct, utime
+from array import array
+from micropython import const
+from mr_frames import (advert_data, frame_size, decode_command, FrameWriter, 
+                       SCHEMAS, FLAG_KEYFRAME, FLAG_TIMESTAMP, SCHEMA_ACK, 
+                       SCHEMA_PONG, SCHEMA_LOOP, SCHEMA_HISTOGRAM, 
+                       SCHEMA_MEMORY, PROFILE_BUCKETS_US, CMD_FLAG_ACK, 
+                       CMD_PING, CMD_CLOCK, CMD_DRIFT, CMD_STATS, STATS_RESET)
+
+_ADV_TYPE_FLAGS = const(0x01)
+_ADV_TYPE_NAME = const(0x09)
+_ADV_TYPE_UUID16_COMPLETE = const(0x3)
+_ADV_TYPE_UUID32_COMPLETE = const(0x5)
+_ADV_TYPE_UUID128_COMPLETE = const(0x7)
+_ADV_TYPE_UUID16_MORE = const(0x2)
+_ADV_TYPE_UUID32_MORE = const(0x4)
+_ADV_TYPE_UUID128_MORE = const(0x6)
+_ADV_TYPE_APPEARANCE = const(0x19)
+_ADV_TYPE_SPECIFIC_DATA = const(0xFF)
+_ADV_DATA_COMPANY_ID = const(0xFFFF)
+
+def advertising_payload(limited_disc=False, br_edr=False, name=None, 
+                        services=None, appearance=0, free=None, 
+                        scan_response=False):
+    payload = bytearray()
+
+    def _append(adv_type, value):
+        nonlocal payload
+        payload += struct.pack("BB", len(value) + 1, adv_type) + value
+
+    # Flags aren't allowed in a scan response
+    if not scan_response:
+        _append(
+            _ADV_TYPE_FLAGS,
+            struct.pack("B", (0x01 if limited_disc else 0x02) + 
+                        (0x18 if br_edr else 0x04)),
+        )
+
+    if name:
+        _append(_ADV_TYPE_NAME, name.encode())
+
+    if services:
+        for uuid in services:
+            b = bytes(uuid)
+            if len(b) == 2:
+                _append(_ADV_TYPE_UUID16_COMPLETE, b)
+            elif len(b) == 4:
+                _append(_ADV_TYPE_UUID32_COMPLETE, b)
+            elif len(b) == 16:
+                _append(_ADV_TYPE_UUID128_COMPLETE, b)
+
+    if appearance:
+        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
+
+    # Manufacturer specific data
+    if free:
+        _append(_ADV_TYPE_SPECIFIC_DATA, 
+                struct.pack("<H", _ADV_DATA_COMPANY_ID) + free)
+
+    return payload
+
+def hub_id(ble):
+    """16 bit ID that's the same every time for a given hub, worked out from 
+    its hardware unique ID (or its Bluetooth address on firmware without one)"""
+    try:
+        import machine
+        uid = machine.unique_id()
+    except (ImportError, AttributeError):
+        uid = ble.config("mac")[1]
+    h = 0
+    for b in uid:
+        h = (h * 31 + b) & 0xFFFF
+    return h
+
+_IRQ_CENTRAL_CONNECT = const(1)
+_IRQ_CENTRAL_DISCONNECT = const(2)
+_IRQ_GATTS_WRITE = const(3)
+_IRQ_MTU_EXCHANGED = const(21)
+
+# ATT MTU is 23 bytes until the central agrees to a bigger one, 3 bytes of 
+# that are header so a notify normally carries 20 bytes
+_DEFAULT_MTU = const(23)
+_PREFERRED_MTU = const(247)
+
+# Advertising starts fast so MR finds the hub quickly, then slows down to save 
+# power. It starts over (fast again) whenever a central disconnects.
+_ADV_FAST_INTERVAL_US = const(20000)
+_ADV_FAST_MS = const(30000)
+_ADV_SLOW_INTERVAL_US = const(500000)
+
+_UART_UUID = bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")
+_UART_RX = (
+    bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
+    bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE,
+)
+_UART_TX = (
+    bluetooth.UUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E"),
+    bluetooth.FLAG_NOTIFY,
+)
+_UART_SERVICE = (
+    _UART_UUID,
+    (_UART_TX, _UART_RX),
+)
+
+# The IRQ doesn't act on anything itself. It records what happened in a ring 
+# of _EVENT_SLOTS events and the program handles them later (see read()), so 
+# the BLE stack is never kept waiting. Writes from MR are copied into the 
+# event, 20 bytes is the default BLE write size. EVENT_SUBSCRIBE comes when a 
+# central turns on notifications (right after connecting with notify_both), 
+# which is a while after EVENT_CONNECT: only from then on does send() reach 
+# it.
+EVENT_CONNECT = const(1)
+EVENT_DISCONNECT = const(2)
+EVENT_WRITE = const(3)
+EVENT_SUBSCRIBE = const(4)
+_EVENT_SLOTS = const(8)
+_EVENT_DATA_SIZE = const(20)
+
+# Every central gets its own queue of notifies waiting to go out, so one that 
+# can't keep up doesn't hold back the others or the program. Up to 
+# _MAX_CENTRALS are fed at once (MR plus a logger or a teacher's dashboard).
+_MAX_CENTRALS = const(4)
+_QUEUE_SLOTS = const(4)
+_NO_CONN = const(-1)
+
+class _SendQueue:
+    """Notifies waiting to go to one central. When it's full the oldest one 
+    is dropped, a newer sample is always more useful than an old one. 
+    sizes are the frame sizes to have views ready for from the start."""
+    def __init__(self, slot_size, sizes=()):
+        self.conn = _NO_CONN
+        self.bufs = [bytearray(slot_size) for _ in range(_QUEUE_SLOTS)]
+        # A view of exactly what's in each slot, ready to notify. A program 
+        # only sends a few sizes of frame, so each slot keeps a view per size 
+        # and one is only made the first time a size comes up instead of 
+        # slicing one out for every notify.
+        self.views = [memoryview(buf) for buf in self.bufs]
+        self.sized = [{} for _ in range(_QUEUE_SLOTS)]
+        for i in range(_QUEUE_SLOTS):
+            for n in sizes:
+                if n <= slot_size:
+                    self.sized[i][n] = memoryview(self.bufs[i])[:n]
+        self.lens = [slot_size] * _QUEUE_SLOTS
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+
+    def put(self, data):
+        n = len(data)
+        if n > len(self.bufs[0]):
+            raise ValueError("notify too big for the send queue")
+        if self.count == _QUEUE_SLOTS:
+            self.head = (self.head + 1) % _QUEUE_SLOTS
+            self.count -= 1
+            self.dropped += 1
+        i = (self.head + self.count) % _QUEUE_SLOTS
+        self.bufs[i][:n] = data
+        if n != self.lens[i]:
+            view = self.sized[i].get(n)
+            if view is None:
+                view = memoryview(self.bufs[i])[:n]
+                self.sized[i][n] = view
+            self.views[i] = view
+            self.lens[i] = n
+        self.count += 1
+
+    def reset(self, conn_handle):
+        self.conn = conn_handle
+        self.head = 0
+        self.count = 0
+
+class BLEPeripheral:
+    """Makes the hub a BLE UART peripheral that MR can connect to
+
+    prefix is the start of the hub's name (the rest comes from hub_id()) and 
+    schema the mr_frames schema it sends, which goes in the scan response.
+
+    send() puts data in every subscribed central's queue and pump() sends 
+    what's queued. By default send() pumps once itself; with auto_pump=False 
+    the program runs pump() on its own, e.g. from an async task.
+
+    With batch > 1 samples are sent together once batch of them have come, 
+    or once the first has waited batch_ms, so a still input that's hardly 
+    sending anything doesn't hold one back.
+    """
+    def __init__(self, prefix, schema, event_flag=None, batch=1, 
+                 notify_both=False, auto_pump=True, batch_ms=30):
+        self._ble = bluetooth.BLE()
+        self._ble.active(True)
+        self._ble.irq(self._irq)
+        ((self._handle_tx, self._handle_rx),) = \
+            self._ble.gatts_register_services((_UART_SERVICE,))
+        self._connections = set()
+        # Event ring, allocated once here so the IRQ only copies bytes. The 
+        # IRQ moves _ev_head, read() moves _ev_tail.
+        self._ev_kinds = bytearray(_EVENT_SLOTS)
+        self._ev_conns = [0] * _EVENT_SLOTS
+        self._ev_data = [bytearray(_EVENT_DATA_SIZE) 
+                         for _ in range(_EVENT_SLOTS)]
+        self._ev_lens = bytearray(_EVENT_SLOTS)
+        # ticks_us when each event was recorded, read() puts it in event_us
+        self._ev_us = [0] * _EVENT_SLOTS
+        self.event_us = 0
+        self._ev_head = 0
+        self._ev_tail = 0
+        self.events_dropped = 0
+        # Set whenever an event is recorded so a task can wait on it
+        self._event_flag = event_flag
+        # Only centrals that turned on notifications for TX (by writing its 
+        # CCCD, which sits right after the TX value handle) get sent data. 
+        # notify_both=True brings back the old behaviour of notifying RX and 
+        # TX for every connection, for centrals that listen on RX or never 
+        # subscribe.
+        self._handle_cccd = self._handle_tx + 1
+        self._subscribed = set()
+        self._notify_both = notify_both
+        self._targets = self._connections if notify_both else self._subscribed
+        # Ask for a bigger MTU so one notify can carry several samples, older 
+        # firmware doesn't have this setting
+        try:
+            self._ble.config(mtu=_PREFERRED_MTU)
+        except (AttributeError, ValueError, OSError):
+            pass
+        # Negotiated MTU of every connection and the biggest notify all of 
+        # them can take
+        self._mtu = {}
+        self._max_payload = _DEFAULT_MTU - 3
+        # With batch > 1, send() collects that many samples (or as many as fit 
+        # in one notify) and sends them together, see flush(). pump() sends a 
+        # batch early once its first sample is batch_ms old.
+        self._batch = batch
+        self._batch_ms = batch_ms
+        self._batch_since = 0
+        self._batch_buf = bytearray(_PREFERRED_MTU - 3)
+        self._batch_view = memoryview(self._batch_buf)
+        self._batch_len = 0
+        self._batch_count = 0
+        # Send queues, one per central, allocated here so connecting doesn't 
+        # allocate anything. The IRQ hands them out to centrals (see 
+        # _SendQueue.reset), nothing is ever added to or removed from the list.
+        # A slot fits the biggest stamped frame of any schema, since acks and 
+        # pongs go through the same queues
+        slot_size = 0
+        for s in SCHEMAS:
+            if frame_size(s, FLAG_TIMESTAMP) > slot_size:
+                slot_size = frame_size(s, FLAG_TIMESTAMP)
+        slot_size *= batch
+        if slot_size > _PREFERRED_MTU - 3:
+            slot_size = _PREFERRED_MTU - 3
+        # Views for what this program sends (a batch of 1 or more of its 
+        # frames) are made here too, other sizes like acks the first time 
+        # they come up
+        sizes = []
+        for flags in (0, FLAG_TIMESTAMP):
+            for k in range(1, batch + 1):
+                sizes.append(k * frame_size(schema, flags))
+        self._queues = [_SendQueue(slot_size, sizes) 
+                        for _ in range(_MAX_CENTRALS)]
+        self._auto_pump = auto_pump
+        # How many notifies went through and how many the stack refused
+        self.notify_ok = 0
+        self.notify_failed = 0
+        # The name is the prefix plus 4 hex digits from the hub's hardware ID, 
+        # so every hub in the room has its own name and keeps it between runs
+        uid = hub_id(self._ble)
+        self.name = prefix + "{:04x}".format(uid)
+        # The name goes in the advertisement, the UART service and what kind 
+        # of controller this is (see mr_frames.advert_data) go in the scan 
+        # response, since each only fits 31 bytes
+        self._payload = advertising_payload(name=self.name)
+        self._resp = advertising_payload(services=[_UART_UUID], 
+                                         free=advert_data(schema, uid), 
+                                         scan_response=True)
+        self._adv_fast = False
+        self._adv_fast_until = 0
+        self._advertise()
+        print("Advertising as", self.name)
+
+    def is_connected(self):
+        self._check_advertising()
+        return len(self._connections) > 0
+
+    def any(self):
+        """True if there's an event that hasn't been read yet"""
+        return self._ev_head != self._ev_tail
+
+    def read(self):
+        """Returns the oldest event as (kind, conn_handle, data), or None if 
+        there's nothing waiting. data is the bytes MR wrote for EVENT_WRITE 
+        and None for the other kinds."""
+        tail = self._ev_tail
+        if self._ev_head == tail:
+            return None
+        kind = self._ev_kinds[tail]
+        data = None
+        if kind == EVENT_WRITE:
+            data = bytes(self._ev_data[tail][:self._ev_lens[tail]])
+        event = (kind, self._ev_conns[tail], data)
+        self.event_us = self._ev_us[tail]
+        self._ev_tail = (tail + 1) % _EVENT_SLOTS
+        return event
+
+    def _record(self, kind, conn_handle, value=None):
+        # Runs inside the IRQ, so no waiting around in here. If the ring is 
+        # full the new event is dropped and counted.
+        head = self._ev_head
+        nxt = (head + 1) % _EVENT_SLOTS
+        if nxt == self._ev_tail:
+            self.events_dropped += 1
+            return
+        self._ev_kinds[head] = kind
+        self._ev_conns[head] = conn_handle
+        self._ev_us[head] = utime.ticks_us()
+        if value is not None:
+            n = len(value)
+            if n > _EVENT_DATA_SIZE:
+                n = _EVENT_DATA_SIZE
+                value = value[:n]
+            self._ev_data[head][:n] = value
+            self._ev_lens[head] = n
+        self._ev_head = nxt
+        if self._event_flag is not None:
+            self._event_flag.set()
+
+    def send(self, data):
+        if not self._targets:
+            self._check_advertising()
+            return
+        if self._batch > 1:
+            self._add_to_batch(data)
+        else:
+            self._enqueue(data)
+        if self._auto_pump:
+            self.pump()
+
+    def flush(self):
+        """Queues the samples waiting in the batch right away"""
+        if self._batch_len:
+            self._enqueue(self._batch_view[:self._batch_len])
+            self._batch_len = 0
+            self._batch_count = 0
+
+    def _add_to_batch(self, data):
+        n = len(data)
+        if n > self._max_payload:
+            # Too big to batch at all
+            self.flush()
+            self._enqueue(data)
+            return
+        if self._batch_len + n > self._max_payload:
+            self.flush()
+        if not self._batch_len:
+            self._batch_since = utime.ticks_ms()
+        self._batch_buf[self._batch_len:self._batch_len + n] = data
+        self._batch_len += n
+        self._batch_count += 1
+        if self._batch_count >= self._batch:
+            self.flush()
+
+    def send_to(self, conn_handle, data):
+        """Like send() but only to one central and never batched, for 
+        replies like acks"""
+        for q in self._queues:
+            if q.conn == conn_handle:
+                q.put(data)
+        if self._auto_pump:
+            self.pump()
+
+    def _enqueue(self, data):
+        targets = self._targets
+        for q in self._queues:
+            if q.conn != _NO_CONN and q.conn in targets:
+                q.put(data)
+
+    def pump(self):
+        """Sends the oldest queued notify of every central that has one. Never 
+        waits: a central whose notify fails keeps it for the next pump and the 
+        others go ahead without it. Also slows advertising down once it's been 
+        fast for long enough, programs pump every pass even while nothing is 
+        being sent."""
+        self._check_advertising()
+        if self._batch_len and utime.ticks_diff(
+                utime.ticks_ms(), self._batch_since) >= self._batch_ms:
+            self.flush()
+        for q in self._queues:
+            if not q.count:
+                continue
+            conn = q.conn
+            i = q.head
+            data = q.views[i]
+            # A failed notify means the stack is out of buffers, usually 
+            # because the central can't keep up. SendRate watches these counts 
+            # to back off.
+            try:
+                if self._notify_both:
+                    self._ble.gatts_notify(conn, self._handle_rx, data)
+                self._ble.gatts_notify(conn, self._handle_tx, data)
+            except OSError:
+                self.notify_failed += 1
+                continue
+            self.notify_ok += 1
+            # The disconnect IRQ may have emptied the queue while the notify 
+            # was going out, then there's nothing left to move past
+            if q.conn == conn and q.count > 0:
+                q.head = (i + 1) % _QUEUE_SLOTS
+                q.count -= 1
+
+    def queued(self):
+        """Number of notifies still waiting to go out, over all centrals"""
+        return sum(q.count for q in self._queues)
+
+    def dropped(self):
+        """Number of queued notifies dropped for newer ones, over all 
+        centrals"""
+        return sum(q.dropped for q in self._queues)
+
+    def _cccd_write(self, conn_handle):
+        # Bit 0 of the CCCD says whether notifications are on
+        try:
+            value = self._ble.gatts_read(self._handle_cccd)
+        except OSError:
+            return
+        if value and value[0] & 1:
+            if conn_handle not in self._subscribed:
+                self._subscribed.add(conn_handle)
+                self._record(EVENT_SUBSCRIBE, conn_handle)
+        else:
+            self._subscribed.discard(conn_handle)
+
+    def _update_max_payload(self):
+        # Batches have to fit the smallest MTU of everyone connected
+        mtu = _PREFERRED_MTU
+        for conn_mtu in self._mtu.values():
+            if conn_mtu < mtu:
+                mtu = conn_mtu
+        self._max_payload = mtu - 3
+
+    def _irq(self, event, data):
+        # Only bookkeeping in here, anything slow (sounds, rumble, the display, 
+        # printing) happens when the program reads the event
+        if event == _IRQ_CENTRAL_CONNECT:
+            conn_handle, _, _ = data
+            self._connections.add(conn_handle)
+            self._mtu[conn_handle] = _DEFAULT_MTU
+            self._update_max_payload()
+            # Hand it a free send queue. Past _MAX_CENTRALS a central stays 
+            # connected but isn't sent anything.
+            for q in self._queues:
+                if q.conn == _NO_CONN:
+                    q.reset(conn_handle)
+                    break
+            # Start the MTU exchange from our side in case the central 
+            # doesn't, not every firmware lets a peripheral do this
+            try:
+                self._ble.gattc_exchange_mtu(conn_handle)
+            except (AttributeError, OSError):
+                pass
+            # The stack stops advertising when a central connects. Keep 
+            # advertising (slowly) while there's a free queue for another one.
+            self._adv_fast = False
+            if self._queue_free():
+                self._advertise_slow()
+            self._record(EVENT_CONNECT, conn_handle)
+            if self._notify_both:
+                # Everyone connected is sent to
+                self._record(EVENT_SUBSCRIBE, conn_handle)
+
+        elif event == _IRQ_CENTRAL_DISCONNECT:
+            conn_handle, _, _ = data
+            if conn_handle in self._connections:
+                self._connections.remove(conn_handle)
+            self._subscribed.discard(conn_handle)
+            self._mtu.pop(conn_handle, None)
+            self._update_max_payload()
+            for q in self._queues:
+                if q.conn == conn_handle:
+                    q.reset(_NO_CONN)
+            self._batch_len = 0
+            self._batch_count = 0
+            # Start advertising again right away so MR can reconnect
+            self._advertise()
+            self._record(EVENT_DISCONNECT, conn_handle)
+
+        elif event == _IRQ_MTU_EXCHANGED:
+            conn_handle, mtu = data
+            self._mtu[conn_handle] = mtu
+            self._update_max_payload()
+
+        elif event == _IRQ_GATTS_WRITE:
+            conn_handle, value_handle = data
+            if value_handle == self._handle_cccd:
+                self._cccd_write(conn_handle)
+            elif value_handle == self._handle_rx:
+                self._record(EVENT_WRITE, conn_handle, 
+                             self._ble.gatts_read(value_handle))
+
+    def _advertise(self):
+        # Fast for the first _ADV_FAST_MS, _check_advertising() then slows it 
+        # down
+        self._ble.gap_advertise(_ADV_FAST_INTERVAL_US, adv_data=self._payload, 
+                                resp_data=self._resp)
+        self._adv_fast = True
+        self._adv_fast_until = utime.ticks_add(utime.ticks_ms(), _ADV_FAST_MS)
+
+    def _check_advertising(self):
+        # Called from pump(), which every program calls every pass, so no 
+        # timer is needed. It's only a ticks comparison while advertising is 
+        # already slow.
+        if (self._adv_fast and 
+                utime.ticks_diff(utime.ticks_ms(), self._adv_fast_until) >= 0):
+            self._adv_fast = False
+            if self._queue_free():
+                self._advertise_slow()
+
+    def _advertise_slow(self):
+        self._ble.gap_advertise(_ADV_SLOW_INTERVAL_US, adv_data=self._payload, 
+                                resp_data=self._resp)
+
+    def _queue_free(self):
+        for q in self._queues:
+            if q.conn == _NO_CONN:
+                return True
+        return False
+
+
+class SendRate:
+    """Works out how long to wait before the next sample, instead of every 
+    program sleeping a hand-tuned fixed time
+
+    Samples go out every fast_ms while the input is moving (any value changed 
+    by more than deadband) and the wait grows towards slow_ms while it's 
+    still. If notifies start failing the shortest wait is doubled, then 
+    brought back down 1 ms for every sample that gets through.
+    """
+    def __init__(self, fast_ms=10, slow_ms=50, deadband=1):
+        self.fast_ms = fast_ms
+        self.slow_ms = slow_ms
+        self.deadband = deadband
+        self.period_ms = fast_ms
+        self._floor_ms = fast_ms
+        self._ok = 0
+        self._failed = 0
+        self._a = 0
+        self._b = 0
+        self._c = 0
+
+    def update(self, ble, a, b=0, c=0):
+        """Call once per sample with the values just sent (up to three), 
+        returns how many ms to sleep before the next sample"""
+        failed = ble.notify_failed != self._failed
+        sent = ble.notify_ok != self._ok
+        self._failed = ble.notify_failed
+        self._ok = ble.notify_ok
+        if failed:
+            self._floor_ms = min(self._floor_ms * 2, self.slow_ms)
+        elif sent and self._floor_ms > self.fast_ms:
+            self._floor_ms -= 1
+
+        deadband = self.deadband
+        moving = (abs(a - self._a) > deadband or abs(b - self._b) > deadband 
+                  or abs(c - self._c) > deadband)
+        self._a = a
+        self._b = b
+        self._c = c
+
+        if moving:
+            period = self.fast_ms
+        else:
+            # Back off by about a quarter every still sample
+            period = self.period_ms + (self.period_ms >> 2) + 1
+        if period < self._floor_ms:
+            period = self._floor_ms
+        if period > self.slow_ms:
+            period = self.slow_ms
+        self.period_ms = period
+        return period
+
+
+class DeltaFilter:
+    """Decides which samples are worth sending
+
+    A sample goes out when any value moved more than deadband since the last 
+    one sent, and a full sample (a keyframe) goes out every keyframe_ms no 
+    matter what, so MR catches up if a notify got lost. Call keyframe() to 
+    send the next sample regardless, e.g. on EVENT_SUBSCRIBE (a sample sent 
+    before a central subscribes doesn't reach it).
+    """
+    def __init__(self, deadband=1, keyframe_ms=500):
+        self.deadband = deadband
+        self.keyframe_ms = keyframe_ms
+        self.skipped = 0
+        self._a = 0
+        self._b = 0
+        self._c = 0
+        self._force = True
+        self._next_key = utime.ticks_ms()
+
+    def keyframe(self):
+        """Make the next sample a keyframe"""
+        self._force = True
+
+    def check(self, a, b=0, c=0):
+        """Returns -1 if the sample can be skipped, otherwise the flags to 
+        pack it with"""
+        now = utime.ticks_ms()
+        if self._force or utime.ticks_diff(now, self._next_key) >= 0:
+            flags = FLAG_KEYFRAME
+            self._force = False
+            self._next_key = utime.ticks_add(now, self.keyframe_ms)
+        else:
+            deadband = self.deadband
+            if (abs(a - self._a) <= deadband and abs(b - self._b) <= deadband 
+                    and abs(c - self._c) <= deadband):
+                self.skipped += 1
+                return -1
+            flags = 0
+        self._a = a
+        self._b = b
+        self._c = c
+        return flags
+
+
+# Histogram buckets per loop, one more than there are bounds
+_BUCKETS = const(7)
+# gc.mem_free() has to walk the whole heap, so it's only looked at once every 
+# this many iterations
+_MEM_EVERY = const(32)
+
+class LoopProfiler:
+    """Times iterations of a program's loops without printing anything
+
+    names are the loops, the number passed to stop() is the position in 
+    names. Every iteration lands in a histogram bucket (PROFILE_BUCKETS_US) 
+    and the count, total and longest are kept, all in arrays made here so 
+    timing doesn't allocate. Every _MEM_EVERY iterations gc.mem_free() is 
+    checked too: the lowest it got and how many times it went up, which only 
+    a garbage collection does.
+
+    Nothing is sent until MR (or latency_probe.py --stats) asks with 
+    CMD_STATS, pass the profiler to Downlink for that. With enabled=False 
+    start() and stop() return straight away, so it can stay in a program.
+    """
+    def __init__(self, names, enabled=True):
+        self.names = names
+        self.enabled = enabled
+        n = len(names)
+        self._hist = array("H", [0] * (n * _BUCKETS))
+        self._count = [0] * n
+        self._total_ms = [0] * n
+        self._carry_us = [0] * n
+        self._max_us = [0] * n
+        self._until_mem = _MEM_EVERY
+        self.free = gc.mem_free()
+        self.min_free = self.free
+        self.collections = 0
+        self._loop = FrameWriter(SCHEMA_LOOP)
+        self._histogram = FrameWriter(SCHEMA_HISTOGRAM)
+        self._memory = FrameWriter(SCHEMA_MEMORY)
+
+    def start(self):
+        """Call at the top of an iteration, pass what it returns to stop()"""
+        if not self.enabled:
+            return 0
+        return utime.ticks_us()
+
+    def stop(self, loop, started):
+        """Call at the end of an iteration (before its sleep)"""
+        if not self.enabled:
+            return
+        us = utime.ticks_diff(utime.ticks_us(), started)
+        i = loop * _BUCKETS
+        for bound in PROFILE_BUCKETS_US:
+            if us < bound:
+                break
+            i += 1
+        if self._hist[i] < 0xFFFF:
+            self._hist[i] += 1
+        self._count[loop] += 1
+        if us > self._max_us[loop]:
+            self._max_us[loop] = us
+        # Kept in ms plus what's left over so it stays a small int
+        us += self._carry_us[loop]
+        self._total_ms[loop] += us // 1000
+        self._carry_us[loop] = us % 1000
+        self._until_mem -= 1
+        if not self._until_mem:
+            self._until_mem = _MEM_EVERY
+            self._check_memory()
+
+    def _check_memory(self):
+        free = gc.mem_free()
+        if free > self.free:
+            self.collections += 1
+        if free < self.min_free:
+            self.min_free = free
+        self.free = free
+
+    def reset(self, loop):
+        """Starts the counts of one loop over"""
+        for i in range(loop * _BUCKETS, (loop + 1) * _BUCKETS):
+            self._hist[i] = 0
+        self._count[loop] = 0
+        self._total_ms[loop] = 0
+        self._carry_us[loop] = 0
+        self._max_us[loop] = 0
+
+    def send(self, ble, conn_handle, value):
+        """Answers a CMD_STATS: the loop's numbers, its histogram and memory"""
+        loop = value & 0xFF
+        self._check_memory()
+        if loop < len(self.names):
+            ble.send_to(conn_handle, self._loop.pack_fields(
+                (loop, len(self.names), self._count[loop], 
+                 self._total_ms[loop], self._max_us[loop])))
+            start = loop * _BUCKETS
+            ble.send_to(conn_handle, self._histogram.pack_fields(
+                (loop,) + tuple(self._hist[start:start + _BUCKETS])))
+            if value & STATS_RESET:
+                self.reset(loop)
+        ble.send_to(conn_handle, self._memory.pack_fields(
+            (self.free, self.min_free, min(self.collections, 0xFFFF))))
+
+
+# Command id for writes that weren't in an envelope (text from older MR 
+# projects), the value is then the text
+CMD_TEXT = const(0)
+
+class Downlink:
+    """Reads the commands MR writes to the hub (see mr_frames.pack_command)
+
+    A command is only acted on once: MR resending it after a lost ack has the 
+    same sequence number and is dropped as a repeat, while the same command 
+    sent again on purpose gets a new number and goes through. Gaps in the 
+    numbers (commands that never arrived) are counted.
+
+    CMD_PING is answered here with a SCHEMA_PONG frame and never returned, it 
+    doesn't count towards the sequence numbers either so a latency probe can 
+    run alongside MR. CMD_CLOCK and CMD_DRIFT are handled here the same way, 
+    they go to clock (an mr_frames.HostClock) if there is one, and so is 
+    CMD_STATS, which profiler (a LoopProfiler) answers if there is one.
+    """
+    def __init__(self, ble, clock=None, profiler=None):
+        self._ble = ble
+        self._clock = clock
+        self._profiler = profiler
+        self._ack = FrameWriter(SCHEMA_ACK)
+        self._pong = FrameWriter(SCHEMA_PONG)
+        self._last_seq = {}
+        self.duplicates = 0
+        self.missed = 0
+
+    def read(self, conn_handle, data):
+        """Returns (command, value) for the data of an EVENT_WRITE, or None if 
+        it's a repeat or can't be read. Plain text comes back as (CMD_TEXT, 
+        text)."""
+        cmd = decode_command(data)
+        if cmd is None:
+            try:
+                return CMD_TEXT, data.decode()
+            except UnicodeError:
+                # Stray binary or a multi-byte character cut in half
+                return None
+        command, flags, seq, value = cmd
+        if command == CMD_PING:
+            # When the IRQ recorded the ping and when the pong left, so the 
+            # time the ping spent waiting on the hub can be taken out
+            self._ble.send_to(conn_handle, self._pong.pack(
+                value, self._ble.event_us, utime.ticks_us()))
+            return None
+        if command == CMD_CLOCK:
+            if self._clock is not None:
+                self._clock.set_offset(value, self._ble.event_us)
+            return None
+        if command == CMD_DRIFT:
+            if self._clock is not None:
+                self._clock.set_drift(value)
+            return None
+        if command == CMD_STATS:
+            if self._profiler is not None:
+                self._profiler.send(self._ble, conn_handle, value)
+            return None
+        # Ack repeats too, the first ack may be the thing that got lost
+        if flags & CMD_FLAG_ACK:
+            self._ble.send_to(conn_handle, self._ack.pack(command, seq))
+        last = self._last_seq.get(conn_handle)
+        if last is not None:
+            ahead = (seq - last) & 0xFF
+            # Same number or one from the last half of the range is a resend
+            if ahead == 0 or ahead > 128:
+                self.duplicates += 1
+                return None
+            self.missed += ahead - 1
+        self._last_seq[conn_handle] = seq
+        return command, value
+
+    def forget(self, conn_handle):
+        """Call on EVENT_DISCONNECT, the next central to get this handle starts 
+        counting from scratch"""
+        self._last_seq.pop(conn_handle, None)
@@ -0,0 +1,359 @@
+"""
+Binary telemetry frames for the MR controllers.
+
+The hub programs used to build their payloads as text, e.g. "180,0,12", which
+means a handful of new strings and float formatting every 10 ms. This module
+packs the same values into a small fixed-size frame instead, written into a
+buffer that is allocated once when the program starts.
+
+The same file runs on the hub (FrameWriter) and on the computer (decode), so
+keep it to things both MicroPython and regular Python have. Save it onto the
+SPIKE next to the program that imports it.
+
+Commands from the computer to the hub (rumble, score, reset) go the other 
+way in a small envelope (pack_command, decode_command) with a sequence number, 
+so the hub can drop repeats and, if asked, send back an ack frame 
+(SCHEMA_ACK) saying which command it got. CMD_PING is answered straight away 
+with a SCHEMA_PONG frame, latency_probe.py uses that to time the link. The 
+same pings let the computer work out how the hub's clock lines up with its 
+own (mr_sync.py) and send that back (CMD_CLOCK, CMD_DRIFT), so a HostClock on 
+the hub can stamp frames in the computer's time. CMD_STATS asks a program 
+that times its loops (mr_ble.LoopProfiler) how they're doing, the answer is 
+a SCHEMA_LOOP, a SCHEMA_HISTOGRAM and a SCHEMA_MEMORY frame.
+
+Hubs also describe themselves in their scan response (advert_data), so a
+computer can pick out the right hub before connecting (decode_advert).
+
+Frame layout (little endian):
+    byte 0   version, bumped whenever the layout below changes
+    byte 1   schema id, says which controller sent the frame
+    byte 2   flags, see FLAG_*
+    byte 3   sequence number, counts up by one per frame and wraps at 256
+    byte 4-7 only with FLAG_TIMESTAMP: the hub's utime.ticks_us() when the 
+             frame was packed, or the computer's clock in microseconds if 
+             FLAG_HOST_TIME is set too. Both wrap at TICKS_PERIOD (see 
+             ticks_diff)
+    then     the fields of the schema, see SCHEMAS
+
+Schemas:
+    SCHEMA_WHEEL  FF steering wheel (SpikeSendReceiveBLE.py)
+                  steering degrees (0-360), gas %, brake %
+    SCHEMA_CAR    gyro car (MR_car.py)
+                  pitch angle, roll angle, both raw degrees from the hub
+    SCHEMA_GOLF   golf club (MR_golf.py, MR_golf_improved.py)
+                  kind (GOLF_SHOOT, GOLF_TURN, GOLF_HEIGHT) and a value:
+                  shoot = peak acceleration, turn/height = sensor degrees, or
+                  -1/0/1 for the button version
+    SCHEMA_ACK    sent back by the hub for a command that asked for one
+                  command id, the command's sequence number
+    SCHEMA_PONG   answer to CMD_PING
+                  the ping's value, ticks_us when the ping arrived, ticks_us 
+                  when the pong was packed
+    SCHEMA_LOOP   answer to CMD_STATS, one of the program's timed loops
+                  loop number, how many loops are timed, iterations, total 
+                  ms spent in them, longest iteration in us
+    SCHEMA_HISTOGRAM  answer to CMD_STATS, the same loop's iterations by 
+                  how long they took, one count per PROFILE_BUCKETS_US bucket 
+                  (stops at 65535)
+    SCHEMA_MEMORY answer to CMD_STATS
+                  gc.mem_free() now, the least it's been, how many garbage 
+                  collections were seen
+
+Flags:
+    FLAG_KEYFRAME  a full sample sent on a timer. Programs that only send 
+                   when a value changes (mr_ble.DeltaFilter) still send one 
+                   of these every so often, so a lost notify doesn't leave MR 
+                   stuck on an old value
+    FLAG_TIMESTAMP the frame carries the hub's ticks_us (FrameWriter with 
+                   timestamp=True), so the computer can tell how old it is
+    FLAG_HOST_TIME the timestamp is in the computer's time, the hub's 
+                   HostClock had been synced when the frame was packed
+"""
+
+import struct
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+try:
+    from utime import ticks_us as _ticks_us, ticks_add as _ticks_add
+    from utime import ticks_diff as _ticks_diff
+except ImportError:
+    import time
+
+    def _ticks_us():
+        return (time.perf_counter_ns() // 1000) & (TICKS_PERIOD - 1)
+
+    def _ticks_add(ticks, delta):
+        return (ticks + delta) & (TICKS_PERIOD - 1)
+
+    def _ticks_diff(end, start):
+        return ticks_diff(end, start)
+
+VERSION = const(1)
+
+SCHEMA_WHEEL = const(1)
+SCHEMA_CAR = const(2)
+SCHEMA_GOLF = const(3)
+
+GOLF_SHOOT = const(0)
+GOLF_TURN = const(1)
+GOLF_HEIGHT = const(2)
+
+FLAG_KEYFRAME = const(0x01)
+FLAG_TIMESTAMP = const(0x02)
+FLAG_HOST_TIME = const(0x04)
+
+SCHEMA_ACK = const(4)
+SCHEMA_PONG = const(5)
+SCHEMA_LOOP = const(6)
+SCHEMA_HISTOGRAM = const(7)
+SCHEMA_MEMORY = const(8)
+
+# Upper ends (us) of the SCHEMA_HISTOGRAM buckets, the last bucket is 
+# everything from 50 ms up
+PROFILE_BUCKETS_US = (500, 1000, 2000, 5000, 10000, 50000)
+
+# utime.ticks_us() counts up to this and starts over at 0 (2**30 on the SPIKE)
+TICKS_PERIOD = const(1 << 30)
+
+_HEADER = "<BBBB"
+HEADER_SIZE = const(4)
+_STAMP = "I"
+STAMP_SIZE = const(4)
+
+# schema id: (struct format of the fields, field names)
+SCHEMAS = {
+    SCHEMA_WHEEL: ("hBB", ("degrees", "gas", "brake")),
+    SCHEMA_CAR: ("hh", ("pitch", "roll")),
+    SCHEMA_GOLF: ("Bi", ("kind", "value")),
+    SCHEMA_ACK: ("BB", ("command", "acked")),
+    SCHEMA_PONG: ("iII", ("token", "rx_us", "tx_us")),
+    SCHEMA_LOOP: ("BBIII", ("loop", "loops", "count", "total_ms", "max_us")),
+    SCHEMA_HISTOGRAM: ("BHHHHHHH", ("loop", "b0", "b1", "b2", "b3", "b4", 
+                                    "b5", "b6")),
+    SCHEMA_MEMORY: ("iiH", ("free", "min_free", "collections")),
+}
+
+
+# Command envelope (little endian), written by the computer to the hub's RX:
+#     byte 0   version, same as frames
+#     byte 1   command id, see CMD_*
+#     byte 2   flags, CMD_FLAG_ACK asks the hub for an ack frame
+#     byte 3   sequence number, one per new command (a resend keeps its 
+#              number), wraps at 256
+#     byte 4+  value, 32 bit signed
+# MR projects that still write plain text ("score", "2.5") keep working, see 
+# decode_command().
+CMD_RUMBLE = const(1)
+CMD_SCORE = const(2)
+CMD_RESET = const(3)
+CMD_PING = const(4)
+# value: computer clock minus hub ticks_us, wrapped into +-TICKS_PERIOD/2
+CMD_CLOCK = const(5)
+# value: hub microseconds per microsecond of drift (0 for none), see HostClock
+CMD_DRIFT = const(6)
+# value: which loop to report on, plus STATS_RESET to start its counts over
+CMD_STATS = const(7)
+STATS_RESET = const(0x100)
+
+CMD_FLAG_ACK = const(0x01)
+
+_COMMAND = "<BBBBi"
+COMMAND_SIZE = const(8)
+
+
+def pack_command(command, seq, value=0, ack=False):
+    """Bytes to write to the hub for one command"""
+    return struct.pack(_COMMAND, VERSION, command, 
+                       CMD_FLAG_ACK if ack else 0, seq & 0xFF, value)
+
+
+def decode_command(data):
+    """Returns (command, flags, seq, value) from a command envelope, or None 
+    if data isn't one (e.g. an old plain text write). Text never starts with 
+    the version byte, so the two can't be mixed up."""
+    if len(data) != COMMAND_SIZE or data[0] != VERSION:
+        return None
+    return struct.unpack(_COMMAND, data)[1:]
+
+
+# Scan response manufacturer data: company ID (0xFFFF is the one reserved for 
+# testing), then "MR", the schema id, the frame version and the hub's 16 bit ID
+ADVERT_COMPANY_ID = const(0xFFFF)
+_ADVERT = "<2sBBH"
+_ADVERT_MAGIC = b"MR"
+
+
+def advert_data(schema, hub_id):
+    """Manufacturer data (without the company ID) for a hub's scan response"""
+    return struct.pack(_ADVERT, _ADVERT_MAGIC, schema, VERSION, hub_id)
+
+
+def decode_advert(data):
+    """Returns (schema, version, hub_id) from a hub's manufacturer data, or 
+    None if the data didn't come from an MR hub"""
+    if len(data) < struct.calcsize(_ADVERT):
+        return None
+    magic, schema, version, hub_id = struct.unpack_from(_ADVERT, data)
+    if magic != _ADVERT_MAGIC:
+        return None
+    return schema, version, hub_id
+
+
+def frame_size(schema, flags=0):
+    """Number of bytes in one frame of the given schema"""
+    size = struct.calcsize(_HEADER + SCHEMAS[schema][0])
+    if flags & FLAG_TIMESTAMP:
+        size += STAMP_SIZE
+    return size
+
+
+def ticks_diff(end, start):
+    """Like utime.ticks_diff, for the hub's ticks_us values on a computer"""
+    return ((end - start + TICKS_PERIOD // 2) & (TICKS_PERIOD - 1)) \
+        - TICKS_PERIOD // 2
+
+
+class FrameWriter:
+    """Builds frames of one schema into a single reusable buffer
+
+    pack() returns the same bytearray every time, so send it (or copy it)
+    before packing the next sample. flags is any of the FLAG_* bits. With 
+    timestamp=True every frame is stamped with ticks_us (FLAG_TIMESTAMP), or 
+    with clock.now() once the HostClock passed as clock has been synced.
+    """
+    def __init__(self, schema, timestamp=False, clock=None):
+        fields, names = SCHEMAS[schema]
+        self.schema = schema
+        self._stamp = timestamp
+        self._clock = clock
+        self._fmt = _HEADER + (_STAMP if timestamp else "") + fields
+        self._count = len(names)
+        self.buf = bytearray(struct.calcsize(self._fmt))
+        self.seq = 0
+
+    def pack(self, a, b, c=0, flags=0):
+        if self._stamp:
+            clock = self._clock
+            if clock is not None and clock.synced:
+                stamp = clock.now()
+                flags |= FLAG_TIMESTAMP | FLAG_HOST_TIME
+            else:
+                stamp = _ticks_us()
+                flags |= FLAG_TIMESTAMP
+            if self._count == 3:
+                struct.pack_into(self._fmt, self.buf, 0, VERSION, self.schema,
+                                 flags, self.seq, stamp, a, b, c)
+            else:
+                struct.pack_into(self._fmt, self.buf, 0, VERSION, self.schema,
+                                 flags, self.seq, stamp, a, b)
+        elif self._count == 3:
+            struct.pack_into(self._fmt, self.buf, 0, VERSION, self.schema,
+                             flags, self.seq, a, b, c)
+        else:
+            struct.pack_into(self._fmt, self.buf, 0, VERSION, self.schema,
+                             flags, self.seq, a, b)
+        self.seq = (self.seq + 1) & 0xFF
+        return self.buf
+
+    def pack_fields(self, values, flags=0):
+        """Like pack() for schemas with any number of fields, values is a 
+        tuple of all of them. Never stamped, it's for replies rather than 
+        samples."""
+        struct.pack_into(self._fmt, self.buf, 0, VERSION, self.schema, flags, 
+                         self.seq, *values)
+        self.seq = (self.seq + 1) & 0xFF
+        return self.buf
+
+
+class HostClock:
+    """The computer's clock as seen from the hub, in microseconds wrapped at 
+    TICKS_PERIOD like ticks_us
+
+    The computer works out the offset between the two clocks from pings and 
+    sends it over as CMD_CLOCK every so often (mr_ble.Downlink passes it on 
+    here). In between, CMD_DRIFT corrects for the hub's clock running a bit 
+    fast or slow: one microsecond per that many since the last CMD_CLOCK.
+    """
+    def __init__(self):
+        self.synced = False
+        self._offset = 0
+        self._anchor = 0
+        self._drift_div = 0
+
+    def set_offset(self, offset, at_us):
+        """offset came in a CMD_CLOCK that arrived at ticks_us at_us"""
+        self._offset = offset
+        self._anchor = at_us
+        self.synced = True
+
+    def set_drift(self, divisor):
+        self._drift_div = divisor
+
+    def now(self):
+        # ticks_add keeps every step a small int, so this doesn't allocate
+        ticks = _ticks_us()
+        host = _ticks_add(ticks, self._offset)
+        if self._drift_div:
+            host = _ticks_add(host, _ticks_diff(ticks, self._anchor) 
+                              // self._drift_div)
+        return host
+
+
+class Frame:
+    """A decoded frame; the schema's fields are available as attributes"""
+    def __init__(self, version, schema, flags, seq, names, values, 
+                 stamp_us=None):
+        self.version = version
+        self.schema = schema
+        self.flags = flags
+        self.keyframe = bool(flags & FLAG_KEYFRAME)
+        self.seq = seq
+        # Hub's ticks_us when the frame was packed, None if it wasn't stamped. 
+        # If host_time is True it's the computer's clock instead.
+        self.stamp_us = stamp_us
+        self.host_time = bool(flags & FLAG_HOST_TIME)
+        self.values = values
+        for name, value in zip(names, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "Frame(schema={}, seq={}, values={})".format(
+            self.schema, self.seq, self.values)
+
+
+def decode(data, offset=0):
+    """Decode the frame starting at offset, raises ValueError if it's bad"""
+    if len(data) - offset < HEADER_SIZE:
+        raise ValueError("frame too short")
+    version, schema, flags, seq = struct.unpack_from(_HEADER, data, offset)
+    if version != VERSION:
+        raise ValueError("unsupported frame version {}".format(version))
+    if schema not in SCHEMAS:
+        raise ValueError("unknown schema {}".format(schema))
+    fields, names = SCHEMAS[schema]
+    if len(data) - offset < frame_size(schema, flags):
+        raise ValueError("frame too short")
+    offset += HEADER_SIZE
+    stamp_us = None
+    if flags & FLAG_TIMESTAMP:
+        stamp_us = struct.unpack_from("<" + _STAMP, data, offset)[0]
+        offset += STAMP_SIZE
+    values = struct.unpack_from("<" + fields, data, offset)
+    return Frame(version, schema, flags, seq, names, values, stamp_us)
+
+
+def decode_all(data):
+    """Decode every frame in a payload holding one or more frames back to
+    back"""
+    frames = []
+    offset = 0
+    while offset < len(data):
+        frame = decode(data, offset)
+        frames.append(frame)
+        offset += frame_size(frame.schema, frame.flags)
+    return frames
@@ -0,0 +1,308 @@
+"""
+Computer code (not SPIKE code) that evens out the data coming from a hub
+before the game uses it.
+
+BLE delivers notifies in bursts (once per connection interval), so applying
+every value the moment it arrives makes the steering stutter. Smoother keeps a
+short buffer of samples per stream and plays them back a little behind real
+time at a steady rate, interpolating between samples and, if asked,
+predicting a little way past the newest one (dead reckoning) when the next
+one is late. The delay adapts to how jittery the link is: the more jitter,
+the further behind it plays.
+
+It reads both the binary frames from mr_frames.py and the comma separated
+text the older hub programs send ("180,0,12"). Frames stamped in the
+computer's time (FLAG_HOST_TIME, see mr_sync.py) are placed at the time they
+were sampled, everything else at the time it arrived. Samples that arrive
+together in one burst then all land at the same time, so stamped frames
+smooth out much better.
+
+Everything takes the current time as an argument instead of reading a clock,
+so a recorded trace (latency_probe.py --record) plays back exactly the same
+way offline:
+    python mr_jitter.py trace.txt [--rate 60] [--predict 20] [--csv out.csv]
+prints how much smoother the output is than using every value as it arrives.
+
+Trace files have one notify per line: arrival time in microseconds, a comma,
+then the notify's bytes in hex. Lines starting with # are ignored.
+"""
+
+import argparse, bisect
+
+from mr_frames import decode_all, VERSION, SCHEMA_WHEEL, SCHEMA_CAR, \
+    SCHEMA_GOLF
+from mr_sync import host_time
+
+# Intervals longer than this mean the hub stopped sending because nothing
+# changed (mr_ble.DeltaFilter), not jitter, so they're left out of the average
+_MAX_INTERVAL_US = 100000
+
+STREAM_TEXT = "text"
+
+
+class Sample:
+    """One set of values from a hub. stream says which values they are: the
+    schema id for the wheel and car, (SCHEMA_GOLF, kind) for the golf club
+    (whose values are then just the value) or STREAM_TEXT for text."""
+    def __init__(self, stream, time_us, arrival_us, values):
+        self.stream = stream
+        self.time_us = time_us
+        self.arrival_us = arrival_us
+        self.values = values
+
+    def __repr__(self):
+        return "Sample({}, {}, {})".format(self.stream, self.time_us,
+                                           self.values)
+
+
+def parse(data, arrival_us, sync=None):
+    """Samples in one notify that arrived at arrival_us. Frames stamped in hub
+    time are placed with sync (an mr_sync.ClockSync) if it's given. Acks,
+    pongs and anything that doesn't decode are skipped."""
+    data = bytes(data)
+    if data[:1] == bytes((VERSION,)):
+        try:
+            frames = decode_all(data)
+        except ValueError:
+            return []
+        samples = []
+        for frame in frames:
+            if frame.host_time:
+                time_us = host_time(frame.stamp_us, arrival_us)
+            elif (frame.stamp_us is not None and sync is not None
+                    and sync.offset is not None):
+                time_us = sync.to_host(frame.stamp_us, arrival_us)
+            else:
+                time_us = arrival_us
+            if frame.schema == SCHEMA_GOLF:
+                samples.append(Sample((SCHEMA_GOLF, frame.kind), time_us,
+                                      arrival_us, (frame.value,)))
+            elif frame.schema in (SCHEMA_WHEEL, SCHEMA_CAR):
+                samples.append(Sample(frame.schema, time_us, arrival_us,
+                                      frame.values))
+        return samples
+    try:
+        values = tuple(float(v) for v in data.decode().strip().split(","))
+    except ValueError:
+        return []
+    return [Sample(STREAM_TEXT, arrival_us, arrival_us, values)]
+
+
+class JitterBuffer:
+    """Samples of one stream, played back delay_us behind the newest time
+
+    The delay is the average time samples take to arrive, plus the average
+    time between them (so there's usually a sample on each side of the
+    playback point to interpolate between), plus 3 times the jitter, kept
+    between min_delay_us and max_delay_us. predict_us is how far past the
+    newest sample values may be extrapolated, 0 holds the newest value.
+    """
+    def __init__(self, min_delay_us=10000, max_delay_us=100000, predict_us=0,
+                 keep=64):
+        self.min_delay_us = min_delay_us
+        self.max_delay_us = max_delay_us
+        self.predict_us = predict_us
+        self.keep = keep
+        self.delay_us = min_delay_us
+        self.jitter_us = 0.0
+        self.late = 0
+        self._times = []
+        self._samples = []
+        self._transit = None
+        self._interval = None
+        self._played_us = None
+
+    def add(self, sample):
+        transit = sample.arrival_us - sample.time_us
+        if self._samples:
+            last = self._samples[-1]
+            interval = sample.time_us - last.time_us
+            if 0 < interval < _MAX_INTERVAL_US:
+                if self._interval is None:
+                    self._interval = float(interval)
+                else:
+                    dev = abs(interval - self._interval)
+                    self._interval += (interval - self._interval) / 16
+                    if transit == 0:
+                        # Not stamped, all there is to go on is how unevenly
+                        # the samples arrive
+                        self.jitter_us += (dev - self.jitter_us) / 16
+            if transit:
+                # Stamped, jitter is how much the trip time varies (RFC 3550)
+                dev = abs(transit - self._transit)
+                self.jitter_us += (dev - self.jitter_us) / 16
+                self._transit += (transit - self._transit) / 16
+        else:
+            self._transit = float(transit)
+
+        delay = self._transit + (self._interval or 0) + 3 * self.jitter_us
+        self.delay_us = max(self.min_delay_us, min(delay, self.max_delay_us))
+
+        if self._played_us is not None and sample.time_us < self._played_us:
+            self.late += 1
+        i = bisect.bisect(self._times, sample.time_us)
+        self._times.insert(i, sample.time_us)
+        self._samples.insert(i, sample)
+        if len(self._samples) > self.keep:
+            del self._times[0]
+            del self._samples[0]
+
+    def value_at(self, time_us):
+        """Values at the given time, or None before the first sample"""
+        samples = self._samples
+        if not samples:
+            return None
+        i = bisect.bisect(self._times, time_us)
+        if i == 0:
+            return samples[0].values
+        if i < len(samples):
+            a, b = samples[i - 1], samples[i]
+            span = b.time_us - a.time_us
+            if span <= 0:
+                return b.values
+            k = (time_us - a.time_us) / span
+            return tuple(va + (vb - va) * k
+                         for va, vb in zip(a.values, b.values))
+        newest = samples[-1]
+        if self.predict_us <= 0 or len(samples) < 2:
+            return newest.values
+        # Past the newest sample: carry on at the speed the last two had
+        prev = samples[-2]
+        span = newest.time_us - prev.time_us
+        if span <= 0 or span >= _MAX_INTERVAL_US:
+            return newest.values
+        ahead = min(time_us - newest.time_us, self.predict_us)
+        return tuple(vn + (vn - vp) * ahead / span
+                     for vp, vn in zip(prev.values, newest.values))
+
+    def play(self, now_us):
+        """Values to use now, i.e. at now_us - delay_us"""
+        self._played_us = now_us - self.delay_us
+        return self.value_at(self._played_us)
+
+
+class Smoother:
+    """Takes notifies as they arrive and gives values for every stream at
+    whatever rate the game asks for them (output(), e.g. once a frame)"""
+    def __init__(self, sync=None, **buffer_args):
+        self.sync = sync
+        self.buffer_args = buffer_args
+        self.buffers = {}
+
+    def feed(self, data, arrival_us):
+        """Feeds one notify in, returns the samples it had"""
+        samples = parse(data, arrival_us, self.sync)
+        for sample in samples:
+            buf = self.buffers.get(sample.stream)
+            if buf is None:
+                buf = self.buffers[sample.stream] = \
+                    JitterBuffer(**self.buffer_args)
+            buf.add(sample)
+        return samples
+
+    def output(self, now_us):
+        """{stream: values} to use now"""
+        out = {}
+        for stream, buf in self.buffers.items():
+            values = buf.play(now_us)
+            if values is not None:
+                out[stream] = values
+        return out
+
+
+def read_trace(path):
+    """(arrival_us, bytes) for every notify in a trace file"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            arrival, payload = line.split(",", 1)
+            yield int(arrival), bytes.fromhex(payload)
+
+
+class TraceWriter:
+    """Records notifies to a trace file that read_trace() can play back"""
+    def __init__(self, path):
+        self._file = open(path, "w")
+        self._file.write("# arrival_us,payload hex\n")
+
+    def write(self, arrival_us, data):
+        self._file.write("{},{}\n".format(arrival_us, bytes(data).hex()))
+
+    def close(self):
+        self._file.close()
+
+
+def roughness(values):
+    """Average size of the second difference of a list of numbers: how much
+    the rate of change jumps around from one output to the next"""
+    if len(values) < 3:
+        return 0.0
+    return sum(abs(values[i + 1] - 2 * values[i] + values[i - 1])
+               for i in range(1, len(values) - 1)) / (len(values) - 2)
+
+
+def replay(trace, rate_hz=60, **buffer_args):
+    """Plays a trace through a Smoother at rate_hz. Returns {stream: (raw,
+    smooth)}, lists of value tuples at every output tick: raw being the
+    newest value that had arrived, smooth what the Smoother gave."""
+    smoother = Smoother(**buffer_args)
+    step = 1e6 / rate_hz
+    notifies = list(trace)
+    if not notifies:
+        return {}
+    latest = {}
+    result = {}
+    tick = notifies[0][0]
+    i = 0
+    while i < len(notifies):
+        while i < len(notifies) and notifies[i][0] <= tick:
+            for sample in smoother.feed(notifies[i][1], notifies[i][0]):
+                latest[sample.stream] = sample.values
+            i += 1
+        for stream, values in smoother.output(tick).items():
+            raw, smooth = result.setdefault(stream, ([], []))
+            raw.append(latest[stream])
+            smooth.append(values)
+        tick += step
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays a recorded hub trace through the jitter buffer")
+    parser.add_argument("trace")
+    parser.add_argument("--rate", type=float, default=60,
+                        help="outputs per second, like the game's frame rate")
+    parser.add_argument("--predict", type=float, default=0,
+                        help="ms to predict past the newest sample")
+    parser.add_argument("--min-delay", type=float, default=10,
+                        help="shortest playback delay in ms")
+    parser.add_argument("--max-delay", type=float, default=100,
+                        help="longest playback delay in ms")
+    parser.add_argument("--csv", help="write every output to this file")
+    args = parser.parse_args()
+
+    result = replay(read_trace(args.trace), args.rate,
+                    min_delay_us=args.min_delay * 1000,
+                    max_delay_us=args.max_delay * 1000,
+                    predict_us=args.predict * 1000)
+    for stream, (raw, smooth) in result.items():
+        print("stream", stream, "-", len(smooth), "outputs")
+        for ch in range(len(smooth[0])):
+            print("  value {}: roughness as it arrives {:.3f}, smoothed "
+                  "{:.3f}".format(ch, roughness([v[ch] for v in raw]),
+                                  roughness([v[ch] for v in smooth])))
+    if args.csv:
+        with open(args.csv, "w") as f:
+            f.write("stream,tick,raw,smooth\n")
+            for stream, (raw, smooth) in result.items():
+                for tick, (r, s) in enumerate(zip(raw, smooth)):
+                    f.write('"{}",{},"{}","{}"\n'.format(
+                        stream, tick, " ".join(str(v) for v in r),
+                        " ".join("{:.2f}".format(v) for v in s)))
+
+
+if __name__ == "__main__":
+    main()
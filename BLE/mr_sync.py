@@ -0,0 +1,112 @@
+"""
+Computer code (not SPIKE code) that works out how a hub's clock lines up with
+the computer's, NTP style, from CMD_PING/SCHEMA_PONG exchanges.
+
+Every exchange gives four times: t1 when the ping left the computer, t2 when
+it reached the hub, t3 when the pong left the hub and t4 when it got back.
+Assuming the trip takes as long both ways, computer time minus hub time is
+((t1 - t2) + (t4 - t3)) / 2. The exchanges that took longest were held up
+somewhere along the way, so only the quickest half of the last few are used,
+and a straight line through their offsets gives the drift (how much faster or
+slower the hub's clock runs).
+
+The result goes back to the hub as CMD_CLOCK/CMD_DRIFT (clock_command(),
+drift_command()), after which hub programs with a HostClock stamp their
+frames in the computer's time (FLAG_HOST_TIME) and host_time() turns those
+stamps back into full computer times. latency_probe.py shows it in use.
+
+"Computer time" is whatever microsecond clock the caller uses for t1, t4 and
+host_time(), as long as it's always the same one, e.g.
+time.perf_counter_ns() // 1000.
+"""
+
+from mr_frames import (pack_command, ticks_diff, CMD_CLOCK, CMD_DRIFT,
+                       TICKS_PERIOD)
+
+
+def host_time(stamp, now_us):
+    """Full computer time of a FLAG_HOST_TIME stamp, given the computer's time
+    now (the stamp only keeps the bottom 30 bits)"""
+    return now_us - ticks_diff(now_us % TICKS_PERIOD, stamp)
+
+
+class ClockSync:
+    """Estimate of computer time minus hub time, from ping exchanges"""
+    def __init__(self, window=32):
+        self.window = window
+        # (computer time in the middle of the exchange, offset, delay)
+        self._samples = []
+        self._last_ticks = None
+        self._hub_time = 0
+        # Offset (us) at computer time _ref and how much it changes per us
+        self.offset = None
+        self.drift = 0.0
+        self._ref = 0
+
+    def _unwrap(self, ticks):
+        # Hub ticks wrap every ~18 minutes, keep a running total instead. It 
+        # starts at the first tick value so it stays equal to ticks_us modulo 
+        # TICKS_PERIOD, which is what the hub's HostClock works in.
+        if self._last_ticks is None:
+            self._hub_time = ticks
+        else:
+            self._hub_time += ticks_diff(ticks, self._last_ticks)
+        self._last_ticks = ticks
+        return self._hub_time
+
+    def add(self, t1, t2, t3, t4):
+        """One exchange: t1/t4 computer time when the ping left and the pong
+        arrived, t2/t3 the pong's rx_us/tx_us. Returns the exchange's delay
+        (round trip minus the time spent on the hub)."""
+        hub_rx = self._unwrap(t2)
+        hub_tx = self._unwrap(t3)
+        delay = (t4 - t1) - (hub_tx - hub_rx)
+        offset = ((t1 - hub_rx) + (t4 - hub_tx)) / 2
+        self._samples.append(((t1 + t4) / 2, offset, delay))
+        if len(self._samples) > self.window:
+            self._samples.pop(0)
+        self._fit()
+        return delay
+
+    def _fit(self):
+        best = sorted(self._samples, key=lambda s: s[2])
+        best = best[:max(2, (len(best) + 1) // 2)]
+        n = len(best)
+        mean_t = sum(s[0] for s in best) / n
+        mean_o = sum(s[1] for s in best) / n
+        spread = sum((s[0] - mean_t) ** 2 for s in best)
+        if n >= 2 and spread > 0:
+            self.drift = sum((s[0] - mean_t) * (s[1] - mean_o)
+                             for s in best) / spread
+        self.offset = mean_o
+        self._ref = mean_t
+
+    @property
+    def drift_ppm(self):
+        return self.drift * 1e6
+
+    def offset_at(self, host_us):
+        """Computer time minus hub time at the given computer time"""
+        return self.offset + self.drift * (host_us - self._ref)
+
+    def to_host(self, ticks, now_us):
+        """Computer time of a hub ticks_us value (e.g. an unsynced stamp),
+        given the computer's time now"""
+        hub_now = now_us - self.offset_at(now_us)
+        ago = ticks_diff(int(hub_now) % TICKS_PERIOD, ticks)
+        return now_us - ago
+
+    def clock_command(self, now_us):
+        """CMD_CLOCK to write to the hub, with the offset as of now"""
+        offset = int(round(self.offset_at(now_us)))
+        offset = ((offset + TICKS_PERIOD // 2) % TICKS_PERIOD) \
+            - TICKS_PERIOD // 2
+        return pack_command(CMD_CLOCK, 0, offset)
+
+    def drift_command(self):
+        """CMD_DRIFT to write to the hub: hub us per us of correction"""
+        divisor = 0
+        if abs(self.drift) > 1 / (1 << 31):
+            divisor = int(round(1 / self.drift))
+            divisor = max(-(1 << 31), min(divisor, (1 << 31) - 1))
+        return pack_command(CMD_DRIFT, 0, divisor)
@@ -0,0 +1,29 @@
+"""
+SPIKE code that measures what loading the shared BLE modules costs at 
+startup: how long the import takes, how much RAM is used while importing and 
+how much stays used afterwards.
+
+Run it once with mr_ble.py and mr_frames.py saved on the hub (compiled from 
+source on the hub, like the programs used to do with their copy-pasted BLE 
+code) and once with only mr_ble.mpy and mr_frames.mpy from build_mpy.py. 
+Restart the program between runs so nothing is imported yet.
+"""
+
+import gc, utime
+
+for name in ("mr_frames", "mr_ble"):
+    gc.collect()
+    free_before = gc.mem_free()
+    start = utime.ticks_us()
+    module = __import__(name)
+    elapsed = utime.ticks_diff(utime.ticks_us(), start)
+    # Includes the garbage the compiler left behind
+    used_importing = free_before - gc.mem_free()
+    gc.collect()
+    # Only what the module keeps
+    used_after = free_before - gc.mem_free()
+
+    print(name, "from", getattr(module, "__file__", "?"))
+    print("  import time:", elapsed, "us")
+    print("  RAM used while importing:", used_importing, "bytes")
+    print("  RAM still used after gc:", used_after, "bytes")
@@ -11,17 +11,36 @@ To do
   be turned on/off)
 
 Changelog
+10/18/26
+- WiFi and MR's IP/port are saved on the ESP (esp_send.save_config) instead 
+  of written here, and the ESP waits until it's really connected
+- Acceleration samples go into a buffer made once at the start instead of a 
+  new list every push, and a push too short to sample no longer crashes
+- The peak is worked out while the button is held, comparing squared 
+  magnitudes, so there's no square root per sample and no search at the end
+- SwingPeak comes from swing_peak.py (shared with the golf programs) 
+  instead of being pasted in here, and no longer keeps the samples nothing 
+  read
+- The peak is a whole number (rounded down, so e.g. 512.00 goes to MR), 
+  worked out without making a float
+- Pushes go to MR through esp_agent.py (esp_link.py) with the number written 
+  straight into the frame, instead of formatting a line of Python for 
+  dongle.ask() every push
 6/15/22
 - Cleaned up the code a little bit
 6/14/22
 - Gave code a proper name
 """
 
-# Make sure you have Backpack_Code.py "installed" (aka saved) on the Spike and 
-# esp_send.py installed on the ESP
+# Make sure you have Backpack_Code.py, esp_link.py, esp_frames.py and 
+# swing_peak.py (from the shared folder) 
+# "installed" (aka saved) on the Spike and esp_send.py, esp_agent.py and 
+# esp_frames.py installed on the ESP
 
 # Initialize the hub and get your imports
 from Backpack_Code import Backpack
+from esp_link import AgentLink
+from swing_peak import SwingPeak
 import hub, math, utime, os, sys
 from hub import motion
 from spike import PrimeHub
@@ -36,6 +55,8 @@ file = file.replace("\'",'"')
 dongle = Backpack(hub.port.F, verbose = True) 
 
 dongle.setup()
+# Once the agent is running on the ESP everything goes through this
+link = AgentLink(hub.port.F)
 filename = 'test.py'
 dongle.load(filename,file)
 reply = dongle.get(filename)
@@ -46,14 +67,19 @@ print("_________________________________________________________")
 
 
 # On first run of this code, we need to get the ESP to import our send library
-dongle.ask('from esp_send import send_message')
-# We then need to set up our connection over wifi - change the IP address 
-# address and port below.
-# The IP should be the computer that is running MR. DO NOT change anything else 
-# - leave the quotes, slashes, and commas the way they are.
-#                                   IP          port 
-#                                   ↓            ↓
-dongle.ask('x = send_message(\"10.247.98.69\", 21024)')
+dongle.ask('from esp_send import send_message, save_config')
+# The WiFi network and the IP and port of the computer that is running MR are 
+# saved on the ESP, so they only need setting once. Uncomment this line, 
+# change them and run it once. DO NOT change anything else - leave the quotes, 
+# slashes, and commas the way they are. See esp_send.py for everything you 
+# can set.
+# dongle.ask('save_config(ssid="Tufts_Wireless", mr_host="10.247.98.69", '
+#            'mr_port=21024)')
+# We then need to set up our connection over wifi. It waits until the ESP is 
+# actually connected.
+reply = dongle.ask('x = send_message()')
+if "Error" in reply:
+    print("The ESP couldn't connect to WiFi:", reply)
 
 
 hub.display.clear()
@@ -62,33 +88,40 @@ hub.display.pixel(2,2,10)
 
 hub = PrimeHub()
 
+# Set up the agent on the ESP, it sends what it's handed with x
+dongle.ask('from esp_agent import Agent, serve')
+dongle.ask('agent = Agent(x)')
+# From here on the REPL is busy running the agent, so no more dongle.ask()
+if not link.start('agent'):
+    print("The ESP agent didn't start, is esp_agent.py saved on the ESP?")
+
+# Made once here and reused for every swing
+swing = SwingPeak()
+
 while True:
-    # Empty array to hold acceleration values
-    accs = []
-    
     # Wait until left button is pressed
     hub._left_button.wait_until_pressed()
+    swing.start()
     while hub._left_button.is_pressed():
         # Instantaneous x y z acceleration
         (a_x, a_y, a_z) = motion.accelerometer()
         
-        # Take magnitude of x and y acceleration (since on flat table) and add 
-        # to array
-        mag = math.sqrt(a_x**2 + a_y**2)
-        accs.append(mag)
+        # Keep track of the magnitude of x and y acceleration
+        swing.add(a_x, a_y)
         
         # Sample acceleration every 0.01 seconds
         utime.sleep(0.01)
+    if not swing.count:
+        continue
     
     # find maximum acceleration while left button was held
-    acc = max(accs)
+    acc = swing.peak()
     
-    # Uncomment these if you want to see the accel data
-    # print(accs)
+    # Uncomment this if you want to see the accel data
     # print(acc)
-    message = "x.send(\'" + str(acc) + "\')"
-    dongle.ask(message)
-    print(message)
+    # Sent with 2 decimals, MR reads it as a number either way
+    link.send_number(acc, 2)
+    link.tick()
     
     # Display an arrow on hub display with increasing brightness
     for i in range(11):
@@ -6,6 +6,25 @@ To do
 - Make faster(?)
 
 Changelog
+10/18/26
+- WiFi and MR's IP/port are saved on the ESP (esp_send.save_config) instead 
+  of written here, and the ESP waits until it's really connected
+- The position can go to MR in batches with sequence numbers and 
+  timestamps (batch_ms in esp_send.py), off by default for today's scenes
+- The link to the ESP runs at 460800 baud with COBS framed, CRC checked 
+  frames, so a garbled frame is dropped instead of read as a wrong number
+- The ESP keeps only MR's newest message and never waits for one, so the 
+  position goes out every PERIOD_MS whether or not MR is sending (MR doesn't 
+  need to keep sending 1s anymore)
+- Talks to esp_agent.py on the ESP through esp_link.py, one binary frame each 
+  way per loop, instead of four dongle.ask() calls the ESP's REPL has to 
+  compile and print the answers to. It also no longer hangs forever if MR 
+  stops sending
+- MR's number is read out of the ESP's reply in one pass instead of building 
+  a new string one character at a time
+- The position is written straight into the frame (link.send_number) and 
+  MR's reply read where link.tick() copied it, so the loop makes nothing new 
+  for the GC to clean up
 7/7/22
 - Updated code, now it receives the speed from MR when the car hits something 
   and then shakes
@@ -14,11 +33,13 @@ Changelog
 - Created file
 """
 
-# Make sure you have Backpack_Code.py "installed" (aka saved) on the Spike and 
-# esp_send.py installed on the ESP
+# Make sure you have Backpack_Code.py, esp_link.py and esp_frames.py 
+# "installed" (aka saved) on the Spike and esp_send.py, esp_agent.py and 
+# esp_frames.py installed on the ESP
 
 # Initialize the hub and get your imports
 from Backpack_Code import Backpack
+from esp_link import AgentLink
 import hub, math, utime, os, sys
 from hub import motion
 from spike import PrimeHub, Motor
@@ -28,6 +49,8 @@ from time import sleep
 # Prime
 dongle = Backpack(hub.port.F, verbose = True)
 dongle.setup()
+# Once the agent is running on the ESP everything goes through this
+link = AgentLink(hub.port.F)
 
 # If dongle stuff starts giving you an error uncomment the following lines 
 # and see if the serial communication is working. If everything works properly 
@@ -47,15 +70,23 @@ dongle.setup()
 
 
 # On first run of this code, we need to get the ESP to import our send library
-dongle.ask('from esp_send import send_message')
-# We then need to set up our connection over wifi - change the IP address 
-# address and port below.
-# The IP should be the laptop that is running MR. DO NOT change anything else - 
-# leave the quotes, 
-# slashes, and commas the way they are.
-#                                   IP          port 
-#                                   ↓            ↓
-dongle.ask('x = send_message(\"10.247.98.69\", 21024)')
+dongle.ask('from esp_send import send_message, save_config')
+# The WiFi network, the IP and port of the laptop that is running MR and 
+# (optionally) a static IP for the ESP are saved on the ESP, so they only need 
+# setting once. Uncomment this line, change them and run it once. DO NOT 
+# change anything else - leave the quotes, slashes, and commas the way they 
+# are. See esp_send.py for everything you can set.
+# dongle.ask('save_config(ssid="Tufts_Wireless", mr_host="10.247.98.69", '
+#            'mr_port=21024, ip="10.245.81.17")')
+# We then need to set up our connection over wifi. It waits until the ESP is 
+# actually connected, which is quick after the first time since the ESP 
+# remembers which access point it used.
+# For an MR scene that reads batched positions (see esp_send.py), use 
+# send_message(batch_ms=50) to send them 50 ms at a time with sequence 
+# numbers and timestamps
+reply = dongle.ask('x = send_message()')
+if "Error" in reply:
+    print("The ESP couldn't connect to WiFi:", reply)
 
     
 # Quick light to make sure code is working
@@ -65,45 +96,77 @@ hub.display.pixel(2,2,10)
 
 hub = PrimeHub()
 
-# Set up the UDP connections on the ESP. Change the IP and port as needed to the IP of your ESP.
-dongle.ask('import socket')
-dongle.ask('UDP_IP = "10.245.81.17"')
-dongle.ask('UDP_PORT = 21024')
-dongle.ask('sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)')
-dongle.ask('sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)')
-dongle.ask('sock.bind((UDP_IP, UDP_PORT))')
+# Set up the agent on the ESP, it sends with x and listens for MR on the 
+# ESP's IP and listen_port (saved with save_config above, 21024 by default)
+dongle.ask('from esp_agent import Agent, serve')
+dongle.ask('agent = Agent(x)')
+# From here on the REPL is busy running the agent, so no more dongle.ask()
+if not link.start('agent'):
+    print("The ESP agent didn't start, is esp_agent.py saved on the ESP?")
+
+def parse_number(data, n):
+    """Reads the number out of the first n bytes of what MR sent, skipping 
+    everything but digits, "-" and ".", in one pass without building a new 
+    string. None if there were no digits."""
+    value = 0
+    scale = 0
+    negative = False
+    digits = False
+    # Indexing bytes gives small ints, no new one-letter strings
+    for i in range(n):
+        c = data[i]
+        if 48 <= c <= 57:
+            value = value * 10 + c - 48
+            digits = True
+            if scale:
+                scale *= 10
+        elif c == 46 and not scale:
+            scale = 1
+        elif c == 45:
+            negative = True
+    if not digits:
+        return None
+    if scale > 1:
+        value = value / scale
+    return -value if negative else value
 
 # Set up the motor on the Prime
 motor = Motor('E') # Make sure to switch this to the right port
 motor.set_stop_action('coast')
 motor.stop()
 
+# How often the motor position goes to MR, in ms. What MR sends comes back 
+# with it, however often MR sends.
+PERIOD_MS = 20
+next_tick = utime.ticks_ms()
+
 # Main loop, where the real stuff happens
 while True:
-    # Turn LEDs off, clear variables, get data from the socket
+    # Wait for the next tick
+    wait = utime.ticks_diff(next_tick, utime.ticks_ms())
+    if wait > 0:
+        utime.sleep_ms(wait)
+    else:
+        # Running late (after a rumble), count from now instead of catching up
+        next_tick = utime.ticks_ms()
+    next_tick = utime.ticks_add(next_tick, PERIOD_MS)
+
+    # Turn LEDs off, send our motor position to MR (at all times, because we 
+    # need to steer) and get what MR sent since the last tick, one frame each 
+    # way
     hub._light_matrix.off()
-    ESPraw = ""
-    dongle.ask('data, addr = sock.recvfrom(1024)')
-    dongle.ask("data = data.decode('UTF-8')")
-    ESPraw = dongle.ask('print(data)')
-    ESPclean = ""
-
-    # Once we have data, we clean it up into something usable and turn the 
-    # light on
-    if not (ESPraw == ""): # Checks if MR sent data (which it always should)
-        for i in ESPraw:
-            if (i == "-"):
-                ESPclean = ESPclean + i
-            elif i.isdigit():
-                ESPclean = ESPclean + i
-            elif (i == "."):
-                ESPclean = ESPclean + i
+    link.send_number(motor.get_position())
+    n = link.tick()
+
+    # If MR sent something (it's in link.data), we read the number out of it 
+    # and turn the light on
+    MRdata = parse_number(link.data, n) if n > 0 else None
+    if MRdata is not None:
         hub._light_matrix.set_pixel(4,4,99)
-        MRdata = float(ESPclean) # Convert the cleaned up string into a decimal
 
-        # MR is set to send 1s when there's no collision so we handle that 
-        # here; if we have data, then we set that as the rumble factor and 
-        # shake the wheel
+        # MR sends 1s when there's no collision (older projects keep sending 
+        # them) so we handle that here; if we have data, then we set that as 
+        # the rumble factor and shake the wheel
         if not (MRdata == 1):
             # hub._speaker.beep(80)
             motor.start(round(MRdata))
@@ -113,12 +176,6 @@ while True:
             motor.start(round(MRdata))
             motor.stop()
 
-    # We send our motor position back to MR at all times (because we need to 
-    # steer)
-    message = "x.send(\'" + str(motor.get_position()) + "\')"
-    dongle.ask(message)
-    # print(message)
-
 
 # Sanity check
 print('If this is printing then something is very wrong with the loop.')
\ No newline at end of file
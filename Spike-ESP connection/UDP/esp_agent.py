@@ -0,0 +1,78 @@
+"""
+Runs on the ESP, save it there next to esp_send.py and esp_frames.py. The
+SPIKE starts it once (see esp_link.py) and from then on it has the serial
+cable to itself: the SPIKE sends a frame of records (see esp_frames.py) and
+gets one frame back, instead of typing lines of Python at the REPL and
+reading what gets printed.
+
+While it runs the cable is at esp_frames.LINK_BAUD instead of the REPL's
+115200, it goes back when the SPIKE sends STOP.
+"""
+
+import sys, time, machine, micropython
+from esp_frames import (Batch, FrameReader, records, SEND, TICK, DATA, HELLO,
+                        STOP, REPL_BAUD)
+
+# The most a DATA record can carry
+MAX_PAYLOAD = 240
+
+
+class Agent:
+    """Sends what the SPIKE hands it with sender (a send_message from
+    esp_send.py), which also listens for MR on IP and port, the ESP's own
+    address (left out, the ones in esp_send's config)"""
+    def __init__(self, sender, IP=None, port=None):
+        self.sender = sender
+        sender.listen(IP, port)
+
+    def handle(self, kind, payload, answer):
+        """Acts on one record from the SPIKE, adding anything to send back
+        to the answer Batch"""
+        if kind == SEND:
+            self.sender.send(payload)
+        elif kind == TICK:
+            # A batch that's been collecting long enough goes out
+            self.sender.poll()
+            data = self.sender.latest()
+            answer.add(DATA, data[:MAX_PAYLOAD] if data else b"")
+        elif kind == HELLO:
+            answer.add(HELLO)
+
+
+def _baud(rate):
+    # UART 0 is the one the REPL (and so the cable) is on
+    machine.UART(0, rate)
+
+
+def serve(agent, baud=None):
+    """Answers the SPIKE's frames over the REPL's serial port until it sends
+    STOP, at baud if given. Ctrl-C is off while it runs since a 3 in a frame
+    isn't one."""
+    read = sys.stdin.buffer.read
+    write = sys.stdout.buffer.write
+    reader = FrameReader()
+    answer = Batch()
+    micropython.kbd_intr(-1)
+    if baud:
+        _baud(baud)
+    try:
+        while True:
+            n = reader.feed(read(1))
+            if not n:
+                continue
+            stop = False
+            for kind, payload in records(reader.body, n):
+                if kind == STOP:
+                    stop = True
+                    answer.add(STOP)
+                else:
+                    agent.handle(kind, payload, answer)
+            write(answer.frame(reader.body[0]))
+            if stop:
+                return
+    finally:
+        if baud:
+            # Let the last frame out before changing speed
+            time.sleep_ms(20)
+            _baud(REPL_BAUD)
+        micropython.kbd_intr(3)
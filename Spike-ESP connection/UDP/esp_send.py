@@ -1,34 +1,258 @@
-import network, socket, time
+import network, socket, struct, time, json, binascii
+
+# Where the WiFi and MR settings are kept on the ESP, see save_config()
+CONFIG_FILE = "mr_wifi.json"
+
+# What's used for anything not in CONFIG_FILE
+DEFAULT_CONFIG = {
+    # Network to join, key is its password (None for an open network like 
+    # Tufts_Wireless)
+    "ssid": "Tufts_Wireless",
+    "key": None,
+    # The access point last connected to and its channel, saved after the 
+    # first connection so the next one can skip scanning for it
+    "bssid": None,
+    "channel": None,
+    # A static address for the ESP (skips asking for one), e.g. 
+    # "10.245.81.17", with netmask, gateway and dns. None uses DHCP.
+    "ip": None,
+    "netmask": "255.255.255.0",
+    "gateway": None,
+    "dns": None,
+    # The computer running MR and the port in its receive UDP block, and the 
+    # port the ESP listens on for MR (see listen())
+    "mr_host": "10.247.98.69",
+    "mr_port": 21024,
+    "listen_port": 21024,
+}
+
+# How long one try at connecting gets, how long all of them get, and the 
+# first wait between tries (it doubles each time, up to BACKOFF_MAX_MS)
+CONNECT_MS = 6000
+TIMEOUT_MS = 20000
+BACKOFF_MS = 250
+BACKOFF_MAX_MS = 4000
+
+# Statuses that mean this try failed, whichever of them this port has
+_FAILED = tuple(getattr(network, name) for name in 
+                ("STAT_NO_AP_FOUND", "STAT_WRONG_PASSWORD", 
+                 "STAT_CONNECT_FAIL", "STAT_ASSOC_FAIL", 
+                 "STAT_BEACON_TIMEOUT", "STAT_HANDSHAKE_TIMEOUT") 
+                if hasattr(network, name))
+
+def load_config():
+    """DEFAULT_CONFIG with whatever's saved in CONFIG_FILE on top"""
+    config = dict(DEFAULT_CONFIG)
+    try:
+        with open(CONFIG_FILE) as f:
+            config.update(json.load(f))
+    except (OSError, ValueError):
+        # No file yet, or a broken one, the defaults will do
+        pass
+    return config
+
+def save_config(**settings):
+    """Saves settings (see DEFAULT_CONFIG) to CONFIG_FILE on the ESP, keeping 
+    what's already there, e.g. from the SPIKE:
+        dongle.ask('save_config(mr_host="10.247.98.69", ip="10.245.81.17", 
+                                gateway="10.245.81.1")')
+    Changing the network forgets the access point saved for the old one."""
+    config = load_config()
+    if "ssid" in settings and settings["ssid"] != config["ssid"]:
+        config["bssid"] = config["channel"] = None
+    config.update(settings)
+    saved = {}
+    for name, value in config.items():
+        if value != DEFAULT_CONFIG.get(name):
+            saved[name] = value
+    with open(CONFIG_FILE, "w") as f:
+        json.dump(saved, f)
+    return config
+
+def _scan(wlan, ssid):
+    """(bssid, channel) of the strongest access point for ssid, or None"""
+    best = None
+    for found in wlan.scan():
+        if found[0] == ssid.encode() and (best is None or found[3] > best[3]):
+            best = found
+    if best is None:
+        return None
+    return best[1], best[2]
+
+def connect_wifi(config, timeout_ms=TIMEOUT_MS):
+    """Joins the network in config and waits until it actually has an 
+    address, trying again with backoff. Skips the scan if it knows the 
+    access point and its channel from last time and asking for an address if config has a 
+    static one. Returns the connected WLAN and saves the access point for 
+    next time, raises OSError if it couldn't connect within timeout_ms."""
+    wlan = network.WLAN(network.STA_IF)
+    if wlan.isconnected():
+        return wlan
+    wlan.active(True)
+    if config["ip"]:
+        gateway = config["gateway"] or config["ip"].rsplit(".", 1)[0] + ".1"
+        wlan.ifconfig((config["ip"], config["netmask"], gateway, 
+                       config["dns"] or gateway))
+
+    ssid = config["ssid"]
+    bssid = config["bssid"]
+    channel = config["channel"]
+    started = time.ticks_ms()
+    backoff = BACKOFF_MS
+    while True:
+        if bssid is None:
+            # Only the first time (or when the saved one stops working)
+            found = _scan(wlan, ssid)
+            if found is not None:
+                bssid = binascii.hexlify(found[0]).decode()
+                channel = found[1]
+        if channel:
+            # Straight to the access point's channel, with only its bssid 
+            # the ESP still listens on every channel for it
+            try:
+                wlan.config(channel=channel)
+            except (ValueError, OSError):
+                # Not on every port
+                pass
+        print("Connecting to {}...".format(ssid))
+        wlan.connect(ssid, config["key"], bssid=bssid and 
+                     binascii.unhexlify(bssid))
+        tried = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), tried) < CONNECT_MS:
+            status = wlan.status()
+            if status == network.STAT_GOT_IP:
+                if bssid != config["bssid"]:
+                    save_config(bssid=bssid, channel=channel)
+                return wlan
+            if status in _FAILED:
+                break
+            time.sleep_ms(50)
+        wlan.disconnect()
+        # The access point might have changed, look for it again next time
+        bssid = channel = None
+        if time.ticks_diff(time.ticks_ms(), started) + backoff > timeout_ms:
+            raise OSError("couldn't connect to " + ssid)
+        time.sleep_ms(backoff)
+        backoff = min(backoff * 2, BACKOFF_MAX_MS)
+
+# Batched datagrams (see send_message): a header, then each sample
+BATCH_VERSION = 0xB1
+BATCH_HEADER = "<BBHI"      # version, samples, first sample's sequence 
+                            # number, ESP ticks_ms of the first sample
+BATCH_SAMPLE = "<HB"        # ms after the first sample, length, then the 
+                            # sample's bytes
+BATCH_MAX = 508             # fits in one datagram anywhere without splitting
+HEADER_SIZE = struct.calcsize(BATCH_HEADER)
+SAMPLE_SIZE = struct.calcsize(BATCH_SAMPLE)
 
 class send_message():
     """Connects device to WiFi and allows device to send UDP
     
     IP is the address of the computer running MR
     port must be the same port used in MR specified in the receive UDP block
-    """
-    def __init__(self, IP, port):
-        wlan = network.WLAN(network.STA_IF)
+    Leave them out to use mr_host and mr_port from CONFIG_FILE. The WiFi 
+    settings come from there too (see DEFAULT_CONFIG and save_config()), and 
+    nothing is sent until the ESP is actually connected.
 
-        if not wlan.isconnected():
-            wlan.active(True)
+    With batch_ms, send() doesn't send right away. Samples are collected for 
+    up to batch_ms (or until BATCH_MAX bytes) and go out together in one 
+    datagram with sequence numbers and timestamps, so the computer can tell 
+    if any got lost or came out of order (receive_udp.py decodes them). 
+    Without it every send() is its own datagram with just the message in it, 
+    which is what the MR scenes so far expect.
+    """
+    def __init__(self, IP=None, port=None, batch_ms=None, 
+                 timeout_ms=TIMEOUT_MS):
+        self.config = load_config()
 
-            # Try to connect to Tufts_Wireless (if connecting to Tufts_Wireless 
-            # make sure to register your esp at https://it.tufts.edu/it-
-            # computing/wifi-network/manual-non-browser-device-registration)
-            ssid = "Tufts_Wireless"
-            print("Connecting to {}...".format(ssid))
-            wlan.connect(ssid)
+        # If connecting to Tufts_Wireless make sure to register your esp at 
+        # https://it.tufts.edu/it-computing/wifi-network/manual-non-browser-
+        # device-registration
+        wlan = connect_wifi(self.config, timeout_ms)
+        self.ip = wlan.ifconfig()[0]
 
         self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.s.connect((IP, port))
+        self.s.connect((IP or self.config["mr_host"], 
+                        port or self.config["mr_port"]))
         
         print("Connected!")
-        print("IP address:", wlan.ifconfig()[0])
+        print("IP address:", self.ip)
+
+        self.batch_ms = batch_ms
+        # Made once, every batch is written into it
+        self.buf = bytearray(BATCH_MAX)
+        self.n = 0
+        self.count = 0
+        self.seq = 0
+        self.started = 0
         
+    def listen(self, IP=None, port=None):
+        """Starts taking what MR sends to IP and port (the ESP's own address, 
+        and listen_port from CONFIG_FILE if left out) without ever waiting 
+        for it, see latest()"""
+        self.r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.r.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.r.bind((IP or self.ip, port or self.config["listen_port"]))
+        self.r.setblocking(False)
+
+    def latest(self):
+        """MR's newest message since the last call, or None if it hasn't sent 
+        anything. Older ones that came in between are dropped, only the 
+        newest matters."""
+        newest = None
+        while True:
+            try:
+                newest, addr = self.r.recvfrom(1024)
+            except OSError:
+                # Nothing more waiting (EAGAIN)
+                return newest
+
     def send(self, msg):
-        msg = bytes(msg, "utf-8")
+        # esp_agent.py hands over bytes already
+        if isinstance(msg, str):
+            msg = bytes(msg, "utf-8")
         
-        self.s.send(msg)
+        if self.batch_ms is None:
+            self.s.send(msg)
+            return
+
+        size = min(len(msg), 255)
+        now = time.ticks_ms()
+        if self.n and (self.n + SAMPLE_SIZE + size > BATCH_MAX or 
+                       time.ticks_diff(now, self.started) > 0xFFFF):
+            self.flush()
+        if not self.n:
+            self.n = HEADER_SIZE
+            self.started = now
+        struct.pack_into(BATCH_SAMPLE, self.buf, self.n, 
+                         time.ticks_diff(now, self.started), size)
+        self.n += SAMPLE_SIZE
+        self.buf[self.n:self.n + size] = msg[:size]
+        self.n += size
+        self.count += 1
+        self.poll()
+
+    def poll(self):
+        """Sends the batch if it's been collecting for batch_ms, call it 
+        every so often so the last samples don't wait for the next send()"""
+        if self.n and time.ticks_diff(time.ticks_ms(), 
+                                      self.started) >= self.batch_ms:
+            self.flush()
+
+    def flush(self):
+        """Sends whatever's in the batch now"""
+        if not self.n:
+            return
+        struct.pack_into(BATCH_HEADER, self.buf, 0, BATCH_VERSION, 
+                         self.count, self.seq, self.started & 0xFFFFFFFF)
+        self.s.send(memoryview(self.buf)[:self.n])
+        self.seq = (self.seq + self.count) & 0xFFFF
+        self.n = 0
+        self.count = 0
 
     def close(self):
+        if self.batch_ms is not None:
+            self.flush()
         self.s.close()
+        if hasattr(self, "r"):
+            self.r.close()
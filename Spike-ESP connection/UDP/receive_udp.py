@@ -1,15 +1,52 @@
-"""Test file that receives UDP messages"""
+"""Test file that receives UDP messages
 
-import socket
+Set BATCHED to True to read what esp_send.py sends with batch_ms set: every 
+sample with its sequence number and time, and any that went missing."""
+
+import socket, struct
 
 UDP_IP = "10.245.95.56"
 UDP_PORT = 21024
+BATCHED = False
+
+def decode_batch(data):
+    """(sequence number, ESP ticks_ms, bytes) for each sample in a batched 
+    datagram, see esp_send.py for the layout"""
+    version, count, seq, started = struct.unpack_from("<BBHI", data)
+    if version != 0xB1:
+        raise ValueError("not a batch")
+    samples = []
+    i = struct.calcsize("<BBHI")
+    for k in range(count):
+        offset, size = struct.unpack_from("<HB", data, i)
+        i += 3
+        samples.append(((seq + k) & 0xFFFF, started + offset, 
+                        data[i:i + size]))
+        i += size
+    return samples
 
 sock = socket.socket(socket.AF_INET, # Internet
                      socket.SOCK_DGRAM) # UDP
 sock.bind((UDP_IP, UDP_PORT))
 
+expected = None
 while True:
     data, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
-    data = data.decode('UTF-8')
-    print("received message: %s" % data)
\ No newline at end of file
+    if not BATCHED:
+        data = data.decode('UTF-8')
+        print("received message: %s" % data)
+        continue
+    for seq, ms, sample in decode_batch(data):
+        late = False
+        if expected is not None:
+            gap = (seq - expected) & 0xFFFF
+            if gap >= 0x8000:
+                # Behind what's been seen already, UDP delivered it out of 
+                # order (or twice), so it isn't a gap and doesn't move on
+                late = True
+            elif gap:
+                print("missed %d samples" % gap)
+        if not late:
+            expected = (seq + 1) & 0xFFFF
+        print("%5d %10d ms: %s%s" % (seq, ms, sample.decode('UTF-8'), 
+                                     " (late)" if late else ""))
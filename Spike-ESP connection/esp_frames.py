@@ -0,0 +1,299 @@
+"""
+Frames for the Backpack cable between the SPIKE (esp_link.py) and the agent
+on the ESP (UDP/esp_agent.py). Save it onto both, it only uses what
+MicroPython has.
+
+Every frame is COBS encoded and has a 0 byte at each end, so a frame never
+has a 0 in it and whoever reads can always find where the next one starts,
+whatever came before (the REPL echoing, a byte lost at the wrong baud). The
+last two bytes before encoding are a CRC16 (CCITT, like XMODEM but starting
+at 0xFFFF) and a frame that fails it is dropped, not read as something else.
+
+Inside, after decoding:
+    byte 0   sequence number, the ESP answers with the same one so the SPIKE
+             can tell a late answer to an earlier frame from the one it's
+             waiting for
+    then     records, as many as fit: type, length, that many bytes
+    last 2   CRC16 of everything before it, little endian
+
+Record types:
+    SEND   SPIKE -> ESP   payload goes to MR over UDP
+    TICK   SPIKE -> ESP   asks for MR's newest message, answered with DATA
+    DATA   ESP -> SPIKE   MR's newest message since the last TICK (empty if
+                          nothing came)
+    HELLO  both ways      the SPIKE checking the agent is there
+    STOP   both ways      the agent goes back to the REPL
+
+The ESP answers every frame with exactly one frame, even if it's empty.
+Frames are padded with 0s (empty frames, skipped) to a multiple of
+FRAME_STEP bytes so sending one never has to make anything.
+"""
+
+from array import array
+
+SEND = 1
+TICK = 2
+DATA = 3
+HELLO = 4
+STOP = 5
+
+# Baud rate the cable switches to once the agent is running, both ends have
+# to be able to do it (the REPL runs at 115200)
+LINK_BAUD = 460800
+REPL_BAUD = 115200
+
+# Most bytes in a frame before encoding, CRC included. COBS adds one byte
+# per 254, so an encoded frame with its 0s fits in 256.
+MAX_BODY = 253
+
+# Frames go out padded to a multiple of this, there's a view of the out
+# buffer made for each length up front
+FRAME_STEP = 8
+
+
+def _crc_table():
+    table = array("H", [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table[i] = crc & 0xFFFF
+    return table
+
+_CRC_TABLE = _crc_table()
+
+
+def crc16(data, n):
+    """CRC16 of the first n bytes of data"""
+    crc = 0xFFFF
+    table = _CRC_TABLE
+    for i in range(n):
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ data[i]]
+    return crc
+
+
+def cobs_encode(src, n, dst):
+    """COBS encodes the first n bytes of src into dst, returns the length"""
+    code_at = 0
+    out = 1
+    code = 1
+    for i in range(n):
+        c = src[i]
+        if c:
+            dst[out] = c
+            out += 1
+            code += 1
+            if code < 0xFF:
+                continue
+        dst[code_at] = code
+        code_at = out
+        out += 1
+        code = 1
+    dst[code_at] = code
+    return out
+
+
+def cobs_decode(src, n, dst):
+    """Decodes the first n bytes of src (no 0s) into dst, returns the length
+    or -1 if it isn't valid COBS"""
+    i = 0
+    out = 0
+    while i < n:
+        code = src[i]
+        if code == 0 or i + code > n:
+            return -1
+        i += 1
+        for _ in range(code - 1):
+            dst[out] = src[i]
+            out += 1
+            i += 1
+        if code < 0xFF and i < n:
+            dst[out] = 0
+            out += 1
+    return out
+
+
+class Batch:
+    """Records waiting to go out in the next frame. Buffers (and the views
+    of them frame() hands out) are made once here and reused for every
+    frame."""
+    def __init__(self):
+        self.body = bytearray(MAX_BODY)
+        size = MAX_BODY + MAX_BODY // 254 + 3
+        size = (size + FRAME_STEP - 1) // FRAME_STEP * FRAME_STEP
+        self.out = bytearray(size)
+        view = memoryview(self.out)
+        self.encoded = view[1:]
+        self.views = [view[:k] for k in range(0, size + 1, FRAME_STEP)]
+        self.n = 1
+
+    def add(self, kind, payload=b""):
+        """Adds a record, False if it doesn't fit in this frame"""
+        n = self.n
+        size = len(payload)
+        if n + 2 + size > MAX_BODY - 2:
+            return False
+        body = self.body
+        body[n] = kind
+        body[n + 1] = size
+        n += 2
+        # A slice assignment makes a slice of payload first
+        for i in range(size):
+            body[n + i] = payload[i]
+        self.n = n + size
+        return True
+
+    def add_number(self, kind, value, decimals=0):
+        """Adds a record of value written out like b"%.2f" % value (with
+        decimals 2), but straight into the frame without making the bytes
+        first. False if it doesn't fit."""
+        negative = value < 0
+        if negative:
+            value = -value
+        # Whole numbers without a float in between, that'd be garbage
+        if isinstance(value, int):
+            whole = value * 10 ** decimals
+        else:
+            whole = int(value * 10 ** decimals + 0.5)
+        digits = 1
+        left = whole
+        while left >= 10:
+            left //= 10
+            digits += 1
+        if digits <= decimals:
+            digits = decimals + 1
+        size = digits + (1 if decimals else 0) + (1 if negative else 0)
+        n = self.n
+        if n + 2 + size > MAX_BODY - 2:
+            return False
+        body = self.body
+        body[n] = kind
+        body[n + 1] = size
+        # Written from the last digit back
+        i = n + 2 + size
+        for k in range(digits):
+            if k == decimals and decimals:
+                i -= 1
+                body[i] = 46    # .
+            i -= 1
+            body[i] = 48 + whole % 10
+            whole //= 10
+        if negative:
+            body[i - 1] = 45    # -
+        self.n = n + 2 + size
+        return True
+
+    def frame(self, seq):
+        """The encoded frame, 0s and padding included, as a memoryview that's
+        good until the next call. The batch starts empty again after."""
+        body = self.body
+        n = self.n
+        body[0] = seq
+        crc = crc16(body, n)
+        body[n] = crc & 0xFF
+        body[n + 1] = crc >> 8
+        out = self.out
+        out[0] = 0
+        size = cobs_encode(body, n + 2, self.encoded) + 1
+        padded = (size + FRAME_STEP) // FRAME_STEP
+        for i in range(size, padded * FRAME_STEP):
+            out[i] = 0
+        self.n = 1
+        return self.views[padded]
+
+
+class FrameReader:
+    """Finds frames in the bytes coming off the cable. Ones that don't decode
+    or fail the CRC are dropped and counted in bad."""
+    def __init__(self):
+        self.raw = bytearray(MAX_BODY + MAX_BODY // 254 + 1)
+        self.body = bytearray(MAX_BODY)
+        self.n = 0
+        # What was read past the last frame, from rest_at on
+        self.rest = None
+        self.rest_at = 0
+        self.bad = 0
+
+    def feed(self, data):
+        """Takes bytes read off the cable and returns the length of the next
+        good frame's body (sequence number and records, see records()),
+        which is at the start of body until the next call, or 0 until one's
+        complete"""
+        start = 0
+        if self.rest is not None:
+            if data:
+                # Rare, a read that went past a frame and then more
+                data = self.rest[self.rest_at:] + data
+            else:
+                data = self.rest
+                start = self.rest_at
+            self.rest = None
+        raw = self.raw
+        end = len(data)
+        for i in range(start, end):
+            c = data[i]
+            if c:
+                if self.n < len(raw):
+                    raw[self.n] = c
+                # Past the end it's too long to be a frame, noted below
+                self.n += 1
+                continue
+            n = self.n
+            self.n = 0
+            if n == 0:
+                continue
+            size = self._decode(n)
+            if size < 0:
+                self.bad += 1
+                continue
+            # The padding after it is only empty frames, no need to keep it
+            i += 1
+            while i < end and data[i] == 0:
+                i += 1
+            if i < end:
+                self.rest = data
+                self.rest_at = i
+            return size
+        return 0
+
+    def _decode(self, n):
+        if n > len(self.raw):
+            return -1
+        body = self.body
+        size = cobs_decode(self.raw, n, body)
+        if size < 3:
+            return -1
+        size -= 2
+        if crc16(body, size) != body[size] | body[size + 1] << 8:
+            return -1
+        return size
+
+
+def records(body, n):
+    """(type, payload) for each record in the first n bytes of a frame body
+    from FrameReader, payloads are memoryviews into it"""
+    view = memoryview(body)
+    i = 1
+    while i + 2 <= n:
+        kind = body[i]
+        size = body[i + 1]
+        if i + 2 + size > n:
+            return
+        yield kind, view[i + 2:i + 2 + size]
+        i += 2 + size
+
+
+def find(body, n, kind):
+    """Where the payload of the first kind record in the first n bytes of a
+    frame body starts (its length is the byte before), -1 if there isn't
+    one. Unlike records() it makes nothing, for loops that run all the
+    time."""
+    i = 1
+    while i + 2 <= n:
+        size = body[i + 1]
+        if i + 2 + size > n:
+            return -1
+        if body[i] == kind:
+            return i + 2
+        i += 2 + size
+    return -1
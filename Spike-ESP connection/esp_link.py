@@ -0,0 +1,115 @@
+"""
+The SPIKE's side of esp_agent.py: starts the agent on the ESP, then swaps one
+frame each way with it per tick over the Backpack cable. Save it onto the
+SPIKE along with Backpack_Code.py and esp_frames.py, and esp_agent.py and
+esp_frames.py onto the ESP.
+
+With dongle.ask() every message is a line of Python the ESP's REPL has to
+compile and run, and the answer is whatever it printed, echo and all. Here
+the REPL is only used to start the agent. After that the frames are COBS
+encoded with a CRC (see esp_frames.py), so a bad one is dropped instead of
+read wrong, and everything queued since the last tick goes in one write.
+"""
+
+import utime
+from esp_frames import (Batch, FrameReader, find, SEND, TICK, DATA, HELLO,
+                        STOP, MAX_BODY, LINK_BAUD, REPL_BAUD)
+
+
+class AgentLink:
+    """port is the Backpack's port (hub.port.F) after Backpack.setup() put it
+    in full duplex mode. The cable runs at baud once the agent has started
+    (None leaves it at the REPL's). timeout_ms is how long to wait for the
+    ESP to answer a frame. MR's messages land in data, see tick()."""
+    def __init__(self, port, baud=LINK_BAUD, timeout_ms=200):
+        self.port = port
+        self.baud = baud
+        self.timeout_ms = timeout_ms
+        self.batch = Batch()
+        self.reader = FrameReader()
+        self.data = bytearray(MAX_BODY)
+        self.seq = 0
+        # Frames that went unanswered
+        self.lost = 0
+
+    def start(self, agent="agent", tries=10):
+        """Types serve(agent) at the ESP's REPL to start the agent, then says
+        HELLO until it answers. False if it never did."""
+        if self.baud:
+            command = "serve(%s, %d)\r\n" % (agent, self.baud)
+        else:
+            command = "serve(%s)\r\n" % agent
+        self.port.write(command.encode())
+        if self.baud:
+            # Let the line through before changing speed, the echo gets lost
+            # but there's nothing in it anyway
+            utime.sleep_ms(20)
+            self.port.baud(self.baud)
+        for _ in range(tries):
+            self.batch.add(HELLO)
+            n = self._exchange()
+            if n and find(self.reader.body, n, HELLO) >= 0:
+                return True
+        return False
+
+    def send(self, message):
+        """Queues message (bytes) to go to MR with the next tick, several can
+        go in one. False if the frame is full."""
+        return self.batch.add(SEND, message)
+
+    def send_number(self, value, decimals=0):
+        """Queues value to go to MR as text with decimals places, like
+        send(b"%d" % value) but without making the bytes every time"""
+        return self.batch.add_number(SEND, value, decimals)
+
+    def tick(self, message=None):
+        """Sends what's queued (and message, if given) to the ESP in one frame
+        and copies MR's newest message since the last tick into the start of
+        data, returning its length (0 if nothing came). -1 if the ESP didn't
+        answer in time."""
+        if message:
+            self.send(message)
+        self.batch.add(TICK)
+        n = self._exchange()
+        if not n:
+            return -1
+        body = self.reader.body
+        at = find(body, n, DATA)
+        if at < 0:
+            return 0
+        size = body[at - 1]
+        data = self.data
+        for i in range(size):
+            data[i] = body[at + i]
+        return size
+
+    def stop(self):
+        """Sends the agent back to the REPL so dongle.ask() works again"""
+        self.batch.add(STOP)
+        answered = self._exchange() > 0
+        if self.baud:
+            utime.sleep_ms(20)
+            self.port.baud(REPL_BAUD)
+        return answered
+
+    def _exchange(self):
+        """Writes what's in the batch as one frame and returns the length of
+        the ESP's answer to it (its body is in reader.body), or 0 if it
+        didn't come in time"""
+        self.seq = (self.seq + 1) & 0xFF
+        self.port.write(self.batch.frame(self.seq))
+        deadline = utime.ticks_add(utime.ticks_ms(), self.timeout_ms)
+        while True:
+            got = self.port.read(64)
+            n = self.reader.feed(got)
+            while n:
+                # A late answer to an earlier frame is skipped
+                if self.reader.body[0] == self.seq:
+                    return n
+                n = self.reader.feed(b"")
+            if got:
+                continue
+            if utime.ticks_diff(deadline, utime.ticks_ms()) <= 0:
+                self.lost += 1
+                return 0
+            utime.sleep_ms(1)
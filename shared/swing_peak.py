@@ -0,0 +1,42 @@
+"""
+The peak of a swing (or a push) worked out from the hub's accelerometer, used
+by the golf programs in BLE and SpikeSend.py in Spike-ESP connection. Save it
+onto the SPIKE next to whichever of them you run.
+
+Using it:
+    swing = SwingPeak()
+    swing.start()                   # when the swing starts
+    swing.add(a_x, a_y)             # every sample while it lasts
+    if swing.count:
+        acc = swing.peak()
+"""
+
+class SwingPeak:
+    """Peak x-y acceleration of a swing, kept up to date as the samples come
+    in so it's ready the moment the swing ends. It compares squared
+    magnitudes, so only the peak gets a square root, and nothing grows
+    however long the swing is held."""
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        """Forgets the last swing"""
+        self.count = 0
+        self.biggest = 0
+
+    def add(self, a_x, a_y):
+        squared = a_x * a_x + a_y * a_y
+        self.count += 1
+        if squared > self.biggest:
+            self.biggest = squared
+
+    def peak(self):
+        """The peak, rounded down to a whole number. Newton's method on whole
+        numbers, math.sqrt() would make a float for the GC."""
+        n = self.biggest
+        root = n
+        smaller = (root + 1) // 2
+        while smaller < root:
+            root = smaller
+            smaller = (root + n // root) // 2
+        return root
@@ -0,0 +1,38 @@
+"""Stand-in for Backpack_Code.py, the SPIKE's side of the serial cable to the
+ESP. Commands go to simworld's Esp, which runs them like the ESP's REPL would,
+and the time they'd take over the cable is charged to the clock."""
+
+from simworld import world, clock, COSTS
+
+
+class Backpack:
+    def __init__(self, port, verbose=False):
+        self.port = port
+        self.verbose = verbose
+
+    def _serial(self, sent, received):
+        n = len(sent) + len(received)
+        world.counts["serial_bytes"] += n
+        # The REPL echoes what it's sent, so every byte crosses twice
+        clock.advance_to(clock.now_us + 2 * n * COSTS["serial_byte"])
+
+    def setup(self):
+        clock.charge("serial_ask")
+        if self.verbose:
+            print("Success")
+
+    def ask(self, command):
+        world.counts["asks"] += 1
+        clock.charge("serial_ask")
+        reply = world.esp.run(command)
+        self._serial(command, reply)
+        return reply.rstrip("\r\n")
+
+    def load(self, filename, text):
+        world.esp.files[filename] = text
+        self._serial(text, "")
+
+    def get(self, filename):
+        text = world.esp.files.get(filename, "")
+        self._serial("", text)
+        return text
@@ -0,0 +1,441 @@
+"""
+Computer code (not SPIKE code) that benchmarks every controller program on
+the simulated hub (see run.py): each one gets a scripted input trace, MR on
+the other end of BLE or UDP takes what it sends, and you get
+
+    samples_per_s, bytes_per_s    what MR got
+    cpu_us_per_sample             this computer's CPU time per sample
+    hub_us_per_sample             hub time spent in calls per sample (COSTS)
+    latency_p50_ms/p99_ms         from the input changing to MR getting a
+                                  sample with the new value
+    missed                        input changes MR never saw
+    heap_growth                   bytes the program's code holds on to after
+                                  warming up, should be 0
+    pass_alloc                    with --no-growth, the most bytes the
+                                  program's code allocated between two sleeps
+                                  after warming up, should be 0
+
+    python3 sim/bench.py                       all of them
+    python3 sim/bench.py car golf --json out.json
+    python3 sim/bench.py --baseline sim/bench_baseline.json
+    python3 sim/bench.py --no-growth
+
+--no-growth fails (exit code 1) if any program's heap grew by more than
+HEAP_SLACK bytes after warming up, i.e. something in a loop keeps what it
+allocates (a list that's appended to forever and the like), or if any pass
+through a loop after warming up allocates anything at all, kept or not (a
+string built to send, a new list every pass). Every allocation is garbage
+the hub's GC has to stop the loop to collect sooner or later. That needs
+every program run a second time with every bytecode traced (see
+run._PassAllocs), so it takes a while. It runs run.py --self-test first and
+fails straight away if that doesn't count a loop that allocates.
+
+With --baseline it fails (exit code 1) when a program got worse than the
+baseline by more than THRESHOLDS allows. Throughput isn't checked since
+sending less while nothing moves is the point of DeltaFilter. Save a new
+baseline with --json after making something faster.
+
+Each program runs in its own Python process so they don't share the
+simulated world or imported modules.
+"""
+
+import argparse, json, math, os, subprocess, sys
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.join(REPO, "BLE"))
+
+# MR's side: BLE hands notifies over once per connection interval, UDP takes
+# a millisecond or so on the local network
+CONNECTION_INTERVAL_US = 15000
+UDP_DELAY_US = 1000
+
+# Most bytes a program's heap can grow by after warming up before
+# --no-growth fails, tracemalloc moves by a few blocks either way
+HEAP_SLACK = 256
+
+# How much worse than the baseline a metric can get before the run fails:
+# (relative, absolute), so a metric fails past baseline * (1 + relative) +
+# absolute. This computer's CPU time jumps around a lot more than anything
+# else.
+THRESHOLDS = {
+    "latency_p50_ms": (0.2, 2.0),
+    "latency_p99_ms": (0.2, 5.0),
+    "hub_us_per_sample": (0.2, 50.0),
+    "cpu_us_per_sample": (1.0, 50.0),
+    "missed": (0.0, 0),
+    "heap_growth": (0.0, 256),
+}
+
+
+def steps(values, start, period, before=None):
+    """A signal holding values[k] from start + k * period, before (or the
+    first value) until then"""
+    if before is None:
+        before = values[0]
+
+    def signal(t):
+        k = int((t - start) // period)
+        if k < 0:
+            return before
+        return values[min(k, len(values) - 1)]
+    return signal
+
+
+def step_times(values, start, period):
+    return [start + k * period for k in range(len(values))]
+
+
+def hold(windows, level, rest=0):
+    """level(k) during the k-th (start, end) window, rest otherwise"""
+    def signal(t):
+        for k, (a, b) in enumerate(windows):
+            if a <= t < b:
+                return level(k)
+        return rest
+    return signal
+
+
+# The traces. Inputs step to a new value every so often and every step is
+# an input MR should see: (time it changed in seconds, what MR should get).
+# Steps to the value MR already has don't count.
+
+STEER = [40, 90, 60, -30, -90, -10, 20, 120, 5, -60, 0, -20] * 3
+GAS = [20, 55, 100, 70, 30, 0, 0, 10, 80, 40, 0, 0] * 3
+BRAKE = [0, 0, 0, 25, 60, 90, 30, 0, 0, 15, 0, 0] * 3
+
+
+def wheel(world):
+    # The wheel centers itself (run_to_position, set_degrees_counted(180))
+    # in the first ~2 s, after that degrees counted is 180 + steering
+    start, period = 3.0, 0.25
+    world.motor("A", steps(STEER, start, period, before=0))
+    world.force("F", steps(GAS, start, period, before=0))
+    world.force("E", steps(BRAKE, start, period, before=0))
+    world.add_central(connect_at=0.5)
+    inputs = []
+    for at, s, g, b in zip(step_times(STEER, start, period), STEER, GAS,
+                           BRAKE):
+        inputs.append((at, (max(0, min(360, 180 + s)), g, b)))
+    return inputs
+
+
+PITCH = [10, 25, 40, 15, -5, -30, -45, -20, 0, 35, -35, 0] * 3
+ROLL = [-5, -15, -25, -10, 5, 15, 30, 10, 0, -20, 20, 0] * 3
+
+
+def car(world):
+    start, period = 2.0, 0.25
+    world.pitch = steps(PITCH, start, period, before=0)
+    world.roll = steps(ROLL, start, period, before=0)
+    world.add_central(connect_at=0.5)
+    return list(zip(step_times(PITCH, start, period), zip(PITCH, ROLL)))
+
+
+# Swing peaks go up so the answer is the same whether or not the program
+# forgets earlier swings
+SWINGS = [(2.5, 4.5, 800), (5.5, 7.5, 1100), (8.5, 10.5, 1400),
+          (11.5, 13.5, 1700)]
+
+
+def swing_accel(swings):
+    peak = hold([(a, b) for a, b, _ in swings],
+                lambda k: swings[k][2])
+    # Flat on the table and swinging along x, peak is the magnitude
+    return lambda t: (peak(t), 0, 980)
+
+
+def golf(world):
+    # MR_golf.py starts collecting a second after the left button goes down
+    # and sends the peak when it's let go
+    world.accel = swing_accel([(a + 1.2, b, p) for a, b, p in SWINGS])
+    for a, b, _ in SWINGS:
+        world.press("left", a, b)
+    world.add_central(connect_at=0.5)
+    inputs = [(b, (0, p)) for _, b, p in SWINGS]
+    # Then over to turning mode and turn right and left
+    world.gesture(15.0, "tapped")
+    for a, b, direction in ((16.0, 16.5, 1), (17.0, 17.6, -1),
+                            (18.0, 18.3, 1)):
+        world.press("right" if direction > 0 else "left", a, b)
+        inputs += [(a, (1, direction)), (b, (1, 0))]
+    return inputs
+
+
+TURN = [-20, -45, -90, -60, -10, 30, 75, 40, 0, 10] * 2
+
+
+def golf_improved(world):
+    # Covering the color sensor (port E) collects, uncovering sends
+    world.accel = swing_accel(SWINGS)
+    world.color("E", hold([(a, b) for a, b, _ in SWINGS], lambda k: 80,
+                          rest=10))
+    world.add_central(connect_at=0.5)
+    inputs = [(b, (0, p)) for _, b, p in SWINGS]
+    # Turning mode negates degrees counted, which starts at 0
+    start, period = 16.0, 0.25
+    world.gesture(15.0, "tapped")
+    world.motor("A", steps([-d for d in TURN], start, period, before=0))
+    inputs += [(at, (1, d)) for at, d in
+               zip(step_times(TURN, start, period), TURN)]
+    return inputs
+
+
+def known_wifi(world):
+    """The ESP has connected before (see esp_send.py), so it knows the access
+    point and has a static address"""
+    world.esp.files["mr_wifi.json"] = json.dumps({
+        "bssid": world.wifi.bssid.hex(), "channel": world.wifi.channel,
+        "ip": world.wifi.ip})
+
+
+def shuffleboard(world):
+    # SpikeSend.py sends the peak of each push while the left button is held
+    pushes = [(2.0, 2.6, 500), (4.0, 4.6, 900), (6.0, 6.6, 1300),
+              (8.0, 8.6, 1600), (10.0, 10.6, 1900)]
+    known_wifi(world)
+    world.accel = swing_accel(pushes)
+    for a, b, _ in pushes:
+        world.press("left", a, b)
+    return [(b, float(p)) for _, b, p in pushes]
+
+
+POSITION = [15, 40, 90, 180, 270, 300, 330, 350, 10, 60, 120, 0] * 3
+
+
+def esp_steering(world):
+    # SpikeSendReceive.py sends the motor position on its own clock and
+    # picks up MR's newest datagram as it goes, MR only sends now and then
+    known_wifi(world)
+    world.udp_every(0.1, lambda t: b"1", start=1.0)
+    start, period = 4.0, 0.5
+    world.motor("E", steps(POSITION, start, period, before=0))
+    return list(zip(step_times(POSITION, start, period),
+                    (float(p) for p in POSITION)))
+
+
+CASES = {
+    "wheel": ("BLE/SpikeSendReceiveBLE.py", wheel, 12.0),
+    "car": ("BLE/MR_car.py", car, 12.0),
+    "golf": ("BLE/MR_golf.py", golf, 20.0),
+    "golf_improved": ("BLE/MR_golf_improved.py", golf_improved, 22.0),
+    "shuffleboard": ("Spike-ESP connection/SpikeSend.py", shuffleboard,
+                     12.0),
+    "esp_steering": ("Spike-ESP connection/SpikeSendReceive.py",
+                     esp_steering, 22.0),
+}
+
+
+def delivered(world):
+    """What MR got: (time in us, values, bytes) per sample"""
+    from mr_frames import decode_all
+    samples = []
+    for central in world.centrals:
+        for at, _, data in central.notifies:
+            # Handed over at the next connection event
+            at = -(-at // CONNECTION_INTERVAL_US) * CONNECTION_INTERVAL_US
+            frames = decode_all(data)
+            for frame in frames:
+                samples.append((at, frame.values, len(data) / len(frames)))
+    for at, _, data in world.udp_sent:
+        try:
+            value = float(data)
+        except ValueError:
+            continue
+        samples.append((at + UDP_DELAY_US, value, len(data)))
+    samples.sort(key=lambda s: s[0])
+    return samples
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100 * len(values)))
+                      - 1)]
+
+
+def latencies(inputs, samples):
+    """Time from each input to the first sample at or after it with the
+    value it should have, and how many never got one"""
+    result = []
+    missed = 0
+    for k, (at, expected) in enumerate(inputs):
+        if k and inputs[k - 1][1] == expected:
+            continue
+        at_us = at * 1e6
+        # Once the next input has had a second to show up, this one was
+        # missed
+        until = inputs[k + 1][0] * 1e6 + 1e6 if k + 1 < len(inputs) else None
+        for when, values, _ in samples:
+            if when < at_us:
+                continue
+            if until is not None and when >= until:
+                missed += 1
+                break
+            if values == expected:
+                result.append((when - at_us) / 1000)
+                break
+        else:
+            missed += 1
+    return result, missed
+
+
+def run_case(name, per_pass=False):
+    """Runs one program, in this process, and returns its results. With
+    per_pass only what it allocates per pass, the tracing makes the rest
+    meaningless."""
+    import run
+    script, trace, seconds = CASES[name]
+    inputs = []
+    report = run.run(os.path.join(REPO, script),
+                     lambda world: inputs.extend(trace(world)),
+                     seconds=seconds, quiet=True, alloc=not per_pass,
+                     warmup=seconds / 4, per_pass=per_pass)
+    if per_pass:
+        return {
+            "pass_alloc": report["alloc_per_pass"],
+            "pass_alloc_lines": report["alloc_lines"],
+        }
+    from simworld import world, clock
+    samples = delivered(world)
+    ms, missed = latencies(inputs, samples)
+    n = len(samples) or 1
+    return {
+        "program": script,
+        "ended": report["ended"],
+        "virtual_s": report["virtual_s"],
+        "samples": len(samples),
+        "samples_per_s": len(samples) / report["virtual_s"],
+        "bytes_per_s": sum(s[2] for s in samples) / report["virtual_s"],
+        "cpu_us_per_sample": report["cpu_s"] * 1e6 / n,
+        "hub_us_per_sample": clock.busy_us / n,
+        "latency_p50_ms": percentile(ms, 50),
+        "latency_p99_ms": percentile(ms, 99),
+        "inputs": len(inputs),
+        "missed": missed,
+        "heap_growth": report["alloc_growth"],
+    }
+
+
+def run_isolated(name, per_pass=False):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                          "--child", name] + (["--per-pass"] if per_pass
+                                              else []),
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError("{} failed:\n{}".format(name, out.stderr))
+    return json.loads(out.stdout)
+
+
+def regressions(results, baseline):
+    """What got worse than the baseline by more than THRESHOLDS allows"""
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, (relative, absolute) in THRESHOLDS.items():
+            old, new = baseline[name].get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            limit = old * (1 + relative) + absolute if old >= 0 else \
+                old + absolute
+            if new > limit:
+                found.append("{} {}: {:.4g} (baseline {:.4g}, limit {:.4g})"
+                             .format(name, metric, new, old, limit))
+    return found
+
+
+def show(results):
+    columns = ("samples_per_s", "bytes_per_s", "cpu_us_per_sample",
+               "hub_us_per_sample", "latency_p50_ms", "latency_p99_ms",
+               "missed", "heap_growth", "pass_alloc")
+    print("{:14}".format("") + "".join("{:>12}".format(c[:11])
+                                       for c in columns))
+    for name, result in results.items():
+        cells = []
+        for c in columns:
+            value = result.get(c)
+            cells.append("{:>12}".format("-" if value is None else
+                                         "{:.1f}".format(value)))
+        print("{:14}".format(name) + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the controller programs on the simulated hub")
+    parser.add_argument("cases", nargs="*", help="default is all of: " +
+                        ", ".join(CASES))
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline",
+                        help="fail if worse than the results in this file")
+    parser.add_argument("--no-growth", action="store_true",
+                        help="fail if any program's heap grows or its "
+                        "loops allocate")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--per-pass", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(args.child, args.per_pass)))
+        return
+
+    names = args.cases or list(CASES)
+    for name in names:
+        if name not in CASES:
+            parser.error("no benchmark called " + name)
+    if args.no_growth:
+        # Passing means nothing if the counting can't see an allocation
+        out = subprocess.run([sys.executable, os.path.join(HERE, "run.py"),
+                              "--self-test"], capture_output=True, text=True)
+        if out.returncode != 0:
+            print(out.stdout + out.stderr, end="")
+            sys.exit(1)
+    results = {name: run_isolated(name) for name in names}
+    if args.no_growth:
+        # All at once, CPU time doesn't mean anything with the tracing
+        with ThreadPoolExecutor() as pool:
+            for name, counted in zip(names, pool.map(
+                    lambda name: run_isolated(name, per_pass=True), names)):
+                results[name].update(counted)
+    show(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    failed = False
+    if args.no_growth:
+        for name, result in results.items():
+            if result["heap_growth"] > HEAP_SLACK:
+                print("HEAP GROWTH {}: {} bytes".format(
+                    name, result["heap_growth"]))
+                failed = True
+            if result["pass_alloc"] > 0:
+                lines = ", ".join("{} {}".format(where, size) for where, size
+                                  in result["pass_alloc_lines"].items())
+                print("ALLOCATES {}: {} bytes in a pass ({})".format(
+                    name, result["pass_alloc"], lines))
+                failed = True
+        if not failed:
+            print("No heap growth or allocation in the loops")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline)
+        for line in found:
+            print("REGRESSION", line)
+        if found:
+            failed = True
+        else:
+            print("No regressions against", args.baseline)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
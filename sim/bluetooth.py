@@ -0,0 +1,138 @@
+"""Stand-in for MicroPython's bluetooth module: the hub's side of BLE, with
+the centrals from simworld on the other end"""
+
+import errno
+
+from simworld import world, clock
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+_IRQ_MTU_EXCHANGED = 21
+
+
+class UUID:
+    def __init__(self, value):
+        self.value = value
+
+    def __bytes__(self):
+        if isinstance(self.value, int):
+            return self.value.to_bytes(2, "little")
+        return bytes.fromhex(self.value.replace("-", ""))[::-1]
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and bytes(self) == bytes(other)
+
+    def __hash__(self):
+        return hash(bytes(self))
+
+    def __repr__(self):
+        return "UUID({!r})".format(self.value)
+
+
+class BLE:
+    """There's only one, like on the hub"""
+    def __new__(cls):
+        if world.ble is None:
+            world.ble = super().__new__(cls)
+            world.ble._setup()
+        return world.ble
+
+    def _setup(self):
+        self.irq_handler = None
+        self.is_active = False
+        self.advertising = False
+        self.adv = None
+        self.connected = {}
+        self.values = {}
+        self.handle_tx = None
+        self.handle_rx = None
+        self.settings = {"mtu": 23, "mac": (0, world.uid[:6])}
+        self.notifies = 0
+        self.notify_errors = 0
+
+    def active(self, flag=None):
+        if flag is not None:
+            self.is_active = bool(flag)
+        return self.is_active
+
+    def irq(self, handler):
+        self.irq_handler = handler
+
+    def config(self, *names, **settings):
+        clock.charge("ble")
+        if settings:
+            self.settings.update(settings)
+            return None
+        return self.settings[names[0]]
+
+    def gatts_register_services(self, services):
+        # Handles count up the way the hub's stack hands them out: a
+        # characteristic's value handle, then its CCCD if it has one
+        handle = 9
+        result = []
+        for _, characteristics in services:
+            handles = []
+            for _, flags in characteristics:
+                handle += 1
+                handles.append(handle)
+                self.values[handle] = b""
+                if flags & (FLAG_NOTIFY | FLAG_INDICATE):
+                    handle += 1
+                    self.values[handle] = b"\x00\x00"
+            result.append(tuple(handles))
+        # The UART service is the only one the programs register: TX, then RX
+        self.handle_tx, self.handle_rx = result[0][:2]
+        return tuple(result)
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None,
+                      connectable=True):
+        clock.charge("ble")
+        self.advertising = interval_us is not None
+        self.adv = (interval_us, adv_data, resp_data)
+        world.record("advertise", interval_us)
+
+    def gatts_read(self, handle):
+        clock.charge("ble")
+        return self.values[handle]
+
+    def gatts_write(self, handle, data, send_update=False):
+        clock.charge("ble")
+        if isinstance(data, str):
+            data = data.encode()
+        self.values[handle] = bytes(memoryview(data))
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        clock.charge("notify")
+        central = self.connected.get(conn_handle)
+        if central is None:
+            self.notify_errors += 1
+            raise OSError(errno.ENOTCONN)
+        if central.is_congested(clock.now_us):
+            central.failed += 1
+            self.notify_errors += 1
+            raise OSError(errno.ENOMEM)
+        if data is None:
+            data = self.values[value_handle]
+        elif isinstance(data, str):
+            data = data.encode()
+        self.notifies += 1
+        central.notifies.append((clock.now_us, value_handle,
+                                 bytes(memoryview(data)[:central.mtu - 3])))
+
+    def gattc_exchange_mtu(self, conn_handle):
+        clock.charge("ble")
+        central = self.connected.get(conn_handle)
+        if central is None:
+            raise OSError(errno.ENOTCONN)
+        mtu = min(central.mtu, self.settings["mtu"])
+        central.mtu = mtu
+        clock.schedule(clock.now_us + 10000, self._mtu_exchanged,
+                       conn_handle, mtu)
+
+    def _mtu_exchanged(self, conn_handle, mtu):
+        if conn_handle in self.connected:
+            self.irq_handler(_IRQ_MTU_EXCHANGED, (conn_handle, mtu))
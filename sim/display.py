@@ -0,0 +1,13 @@
+"""Stand-in for the Atlantis firmware's display module"""
+
+from simworld import world, clock
+
+
+def display_clear():
+    clock.charge("display")
+    world.record("display", "clear")
+
+
+def display_set_pixel(x, y, brightness):
+    clock.charge("display")
+    world.record("display", "pixel", x, y, brightness)
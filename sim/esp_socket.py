@@ -0,0 +1,72 @@
+"""Stand-in for the socket module on the ESP. Datagrams sent are kept in
+simworld (world.udp_sent) instead of going anywhere, and ones MR sends come
+from world.udp_arrive()/udp_every()."""
+
+import errno
+
+import network
+from simworld import world, clock
+
+AF_INET = 2
+SOCK_STREAM = 1
+SOCK_DGRAM = 2
+SOL_SOCKET = 1
+SO_REUSEADDR = 4
+
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    return [(AF_INET, SOCK_DGRAM, 0, "", (host, port))]
+
+
+class socket:
+    def __init__(self, af=AF_INET, type=SOCK_STREAM, proto=0):
+        self._peer = None
+        self._timeout = None
+
+    def connect(self, address):
+        self._peer = tuple(address)
+
+    def bind(self, address):
+        pass
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def settimeout(self, seconds):
+        self._timeout = seconds
+
+    def setblocking(self, flag):
+        self._timeout = None if flag else 0
+
+    def send(self, data):
+        return self.sendto(data, self._peer)
+
+    def sendto(self, data, address):
+        clock.charge("udp")
+        if not network.connected():
+            # Not on the network yet, it goes nowhere and nothing says so
+            world.counts["udp_dropped"] += 1
+            return len(data)
+        # A copy, so keeping it doesn't count as memory the program holds
+        world.udp_sent.append((clock.now_us, tuple(address),
+                               bytes(memoryview(data))))
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        if not world.udp_inbox:
+            if self._timeout == 0:
+                raise OSError(errno.EAGAIN)
+            deadline = None
+            if self._timeout is not None:
+                deadline = clock.now_us + int(self._timeout * 1e6)
+            if not clock.wait(lambda: bool(world.udp_inbox), deadline,
+                              "a datagram"):
+                raise OSError(errno.ETIMEDOUT)
+        data, address = world.udp_inbox.popleft()
+        return data[:bufsize], address
+
+    def recv(self, bufsize):
+        return self.recvfrom(bufsize)[0]
+
+    def close(self):
+        pass
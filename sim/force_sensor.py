@@ -0,0 +1,11 @@
+"""Stand-in for the Atlantis firmware's force_sensor module. Ports are
+numbers, 0 is A."""
+
+from simworld import world, clock
+
+_PORTS = "ABCDEF"
+
+
+def get_force(port):
+    clock.charge("sensor")
+    return int(world.force(_PORTS[port])(world.t()))
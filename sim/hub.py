@@ -0,0 +1,76 @@
+"""Stand-in for the SPIKE's low level hub module"""
+
+from simworld import world, clock
+
+
+class _Sound:
+    def beep(self, freq=1000, duration=100, volume=100):
+        clock.charge("sound")
+        world.record("beep", freq, duration)
+
+    def play(self, *args, **kwargs):
+        clock.charge("sound")
+        world.record("sound", args)
+
+
+class _Display:
+    def clear(self):
+        clock.charge("display")
+        world.record("display", "clear")
+
+    def pixel(self, x, y, brightness=9):
+        clock.charge("display")
+        world.record("display", "pixel", x, y, brightness)
+
+    def show(self, image, *args, **kwargs):
+        clock.charge("display")
+        world.record("display", "show", image)
+
+
+class _Motion:
+    def accelerometer(self, filtered=False):
+        clock.charge("sensor")
+        return tuple(world.accel(world.t()))
+
+    def gyroscope(self, filtered=False):
+        clock.charge("sensor")
+        return (0, 0, 0)
+
+    def position(self):
+        clock.charge("sensor")
+        t = world.t()
+        return (world.yaw(t), world.pitch(t), world.roll(t))
+
+
+class _Port:
+    def __init__(self, name):
+        self.name = name
+        self.device = None
+
+    # With the Backpack cable in, what's written goes to the ESP (after
+    # Backpack.setup() has put the port in full duplex mode)
+
+    def write(self, data):
+        world.esp.serial_write(data)
+        return len(data)
+
+    def read(self, n=1):
+        return world.esp.hub_read(n)
+
+    def baud(self, rate):
+        world.esp.hub_baud = rate
+
+    def __repr__(self):
+        return "Port({})".format(self.name)
+
+
+class _Ports:
+    def __init__(self):
+        for name in "ABCDEF":
+            setattr(self, name, _Port(name))
+
+
+sound = _Sound()
+display = _Display()
+motion = _Motion()
+port = _Ports()
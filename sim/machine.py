@@ -0,0 +1,19 @@
+"""Stand-in for MicroPython's machine module"""
+
+from simworld import world
+
+
+def unique_id():
+    return world.uid
+
+
+def freq():
+    return 100000000
+
+
+class UART:
+    """Only what esp_agent.py does with it on the ESP, changing the baud rate
+    of the REPL's UART (0), which the Backpack cable is on"""
+    def __init__(self, id, baudrate=115200, **kwargs):
+        if id == 0:
+            world.esp.baud = baudrate
@@ -0,0 +1,21 @@
+"""Stand-in for MicroPython's micropython module"""
+
+
+def const(x):
+    return x
+
+
+def schedule(fn, arg):
+    fn(arg)
+
+
+def mem_info(*args):
+    pass
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def kbd_intr(chr):
+    pass
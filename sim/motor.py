@@ -0,0 +1,28 @@
+"""Stand-in for the Atlantis firmware's motor module (SpikeSendReceiveBLE_3.py).
+Ports are numbers, 0 is A."""
+
+from simworld import world, clock
+
+MOTOR_END_STATE_FLOAT = 0
+MOTOR_END_STATE_BRAKE = 1
+MOTOR_END_STATE_HOLD = 2
+
+_PORTS = "ABCDEF"
+
+
+def motor_move_at_speed(port, speed):
+    clock.charge("motor")
+    world.motor(_PORTS[port]).speed = speed
+    world.record("motor", _PORTS[port], "start", speed)
+
+
+def motor_stop(port=None, end_state=MOTOR_END_STATE_FLOAT):
+    clock.charge("motor")
+    if port is not None:
+        world.motor(_PORTS[port]).speed = 0
+        world.record("motor", _PORTS[port], "stop")
+
+
+def motor_move_by_degrees(port, degrees, speed, end_state=MOTOR_END_STATE_FLOAT):
+    world.record("motor", _PORTS[port], "run_for_degrees", degrees)
+    clock.sleep_us(abs(degrees) * 1000)
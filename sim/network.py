@@ -0,0 +1,98 @@
+"""Stand-in for MicroPython's network module on the ESP, connecting to
+simworld's Wifi"""
+
+from simworld import world, clock
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+STAT_NO_AP_FOUND = 201
+STAT_WRONG_PASSWORD = 202
+
+
+# Every WLAN made, so the socket stand-in can tell if the ESP is on the network
+_interfaces = []
+
+
+def connected():
+    """Whether the ESP has an address, i.e. what it sends goes anywhere"""
+    return any(w.status() == STAT_GOT_IP for w in _interfaces)
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        _interfaces.append(self)
+        self.interface = interface
+        self._active = False
+        self._connect_at = None
+        self._ssid = None
+        self._bssid = None
+        self._channel = None
+        self._static = None
+
+    def active(self, flag=None):
+        if flag is not None:
+            self._active = bool(flag)
+        return self._active
+
+    def connect(self, ssid=None, key=None, bssid=None):
+        world.record("wifi", "connect", ssid)
+        self._ssid = ssid
+        self._bssid = bssid
+        self._connect_at = clock.now_us
+        wifi = world.wifi
+        # Knowing the access point and its channel already skips the scan,
+        # with only the bssid it still has to find the channel
+        self._ready_us = clock.now_us + int(wifi.associate_s * 1e6)
+        if bssid is None or self._channel != wifi.channel:
+            self._ready_us += int(wifi.scan_s * 1e6)
+        if self._static is None:
+            self._ready_us += int(wifi.dhcp_s * 1e6)
+
+    def disconnect(self):
+        self._connect_at = None
+
+    def status(self):
+        if self._connect_at is None:
+            return STAT_IDLE
+        wifi = world.wifi
+        if not wifi.up or self._ssid != wifi.ssid or (
+                self._bssid is not None and self._bssid != wifi.bssid):
+            return STAT_NO_AP_FOUND
+        if clock.now_us < self._ready_us:
+            return STAT_CONNECTING
+        return STAT_GOT_IP
+
+    def isconnected(self):
+        clock.charge("ble")
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self, config=None):
+        if config is not None:
+            self._static = tuple(config)
+            return None
+        if self._static is not None:
+            return self._static
+        if self.isconnected():
+            return (world.wifi.ip, "255.255.255.0", "10.245.81.1",
+                    "10.245.81.1")
+        return ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+
+    def config(self, *names, **settings):
+        if settings:
+            if "channel" in settings:
+                self._channel = settings["channel"]
+            return None
+        values = {"mac": world.uid[:6], "essid": self._ssid,
+                  "channel": self._channel or world.wifi.channel}
+        return values[names[0]]
+
+    def scan(self):
+        clock.sleep_us(world.wifi.scan_s * 1e6)
+        wifi = world.wifi
+        if not wifi.up:
+            return []
+        return [(wifi.ssid.encode(), wifi.bssid, wifi.channel, -50, 0, 0)]
@@ -0,0 +1,14 @@
+"""Stand-in for the Atlantis firmware's port module. Ports are numbers, 0 is
+A."""
+
+from simworld import world, clock
+
+_PORTS = "ABCDEF"
+
+
+def port_getSensor(port):
+    """(speed, relative position, absolute position) of a motor"""
+    clock.charge("sensor")
+    state = world.motor(_PORTS[port])
+    angle = int(state.angle(world.t())) + state.base
+    return (state.speed, angle - state.counted_offset, angle % 360)
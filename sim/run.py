@@ -0,0 +1,443 @@
+"""
+Computer code (not SPIKE code) that runs a hub program on your computer with
+the stand-in modules in this folder, e.g.
+    python3 sim/run.py BLE/MR_car.py --seconds 20
+    python3 sim/run.py BLE/MR_golf.py --scenario sim/scenarios/golf_swing.py
+
+The program runs unmodified on virtual time (see simworld.py) and at the end
+you get how fast it looped, what it sent over BLE/UDP and, with --alloc, how
+much memory the program's own code (its folder and the shared one, not the
+stand-ins) holds on to after warming up. --per-pass counts what it allocates
+between one sleep and the next after warming up, even what it lets go of
+again, which is what the hub's GC ends up cleaning.
+    python3 sim/run.py --self-test
+checks --per-pass still sees a loop that allocates (selftest/alloc_probe.py).
+
+A scenario is a Python file with a setup(world) function, without one the
+default scenario is used (every sensor moving and MR connected at 0.5 s).
+"""
+
+import argparse, dis, gc, json, os, runpy, sys, time, tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# SPIKE code programs in either folder import, saved on the hub next to them
+SHARED = os.path.join(os.path.dirname(HERE), "shared")
+
+
+class _Discard:
+    """Where the program's prints go with --quiet. Unlike a file nothing is
+    buffered, so it doesn't look like memory the program holds on to."""
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def load_scenario(world, scenario):
+    """scenario is a file with a setup(world), a setup function itself or None
+    for the default"""
+    if scenario is None:
+        import simworld
+        simworld.default_scenario(world)
+    elif callable(scenario):
+        scenario(world)
+    else:
+        runpy.run_path(scenario)["setup"](world)
+
+
+def _held(folders):
+    """Bytes tracemalloc sees held by lines of code in folders"""
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, os.path.join(f, "*")) for f in folders])
+    return sum(stat.size for stat in snapshot.statistics("filename"))
+
+
+# What a bound C method takes, CPython makes one to call a C method while
+# tracing (to report the call) where the hub doesn't
+_BOUND_BYTES = sys.getsizeof([].append)
+
+# An int under 2 ** 30, CPython makes a new one for anything over 256 where
+# the hub keeps it in the pointer. Depending on how it's made that's its size
+# or its size rounded up to 8 bytes, and an allocation of exactly either is
+# taken to be one of those.
+_INT_BYTES = sys.getsizeof(1 << 20)
+_SMALL_INT_BYTES = (_INT_BYTES, (_INT_BYTES + 7) & ~7)
+
+# Calls, by what the Python versions since 3.8 call them, and how many more
+# than their arg they take off the stack after the callee (the keyword names)
+_CALLS = {"CALL": 0, "CALL_FUNCTION": 0, "CALL_METHOD": 0,
+          "CALL_KW": 1, "CALL_FUNCTION_KW": 1}
+
+# Bytecodes that only shuffle the stack around a call, 3.11 has PRECALL and
+# KW_NAMES between the arguments and the call, 3.13 PUSH_NULL between the
+# callee and its arguments
+_AROUND_CALLS = ("PRECALL", "KW_NAMES", "PUSH_NULL", "CACHE", "EXTENDED_ARG")
+
+# Bytecodes that never allocate, no point emptying the freelists for them
+_QUIET = ("NOP", "RESUME", "CACHE", "EXTENDED_ARG", "LOAD_FAST",
+          "LOAD_FAST_CHECK", "LOAD_FAST_LOAD_FAST", "STORE_FAST", "LOAD_CONST",
+          "LOAD_GLOBAL", "POP_TOP", "PUSH_NULL", "COPY", "SWAP", "DUP_TOP",
+          "ROT_TWO", "ROT_THREE", "PRECALL", "KW_NAMES", "IS_OP")
+
+
+def _effect(op):
+    return dis.stack_effect(op.opcode, op.arg)
+
+
+def _callee(ops, k):
+    """The bytecode that put the function called by the call at ops[k] on
+    the stack, back past its arguments, or None. Works from the stack
+    effects rather than what's where, since every Python version lays a call
+    out differently."""
+    j = k - 1
+    while j >= 0 and ops[j].opname in _AROUND_CALLS:
+        j -= 1
+    need = ops[k].arg + _CALLS[ops[k].opname]
+    while j >= 0 and need > 0:
+        need -= _effect(ops[j])
+        j -= 1
+    while j >= 0 and ops[j].opname in _AROUND_CALLS:
+        j -= 1
+    return ops[j] if j >= 0 else None
+
+
+def _is_method(op):
+    """Whether op loads a method to call it without a bound method"""
+    return op.opname == "LOAD_METHOD" or (
+        op.opname == "LOAD_ATTR" and sys.version_info >= (3, 12) and
+        op.arg & 1)
+
+
+def _hub_free(code):
+    """Offsets of the bytecodes in code where CPython allocates what the
+    hub doesn't, and how many bytes of it (None for all):
+    - for loops keep their iterator on the stack, and for ... in range() is
+      compiled to a counter, no range at all
+    - unpacking a tuple or list into names doesn't make an iterator
+    - int() of a float goes through objects CPython makes on the way, the
+      hub just makes the int (which it keeps in the pointer)
+    - obj.method() calls the method without making a bound method first
+    - module.function() gets the function out of the module, where the
+      stand-in modules that are objects make a bound method"""
+    ops = [op for op in dis.get_instructions(code) if op.opname != "CACHE"]
+    free = {}
+    for k, op in enumerate(ops):
+        if op.opname in ("UNPACK_SEQUENCE", "GET_ITER"):
+            free[op.offset] = None
+        elif op.opname in _CALLS:
+            callee = _callee(ops, k)
+            if callee is None:
+                continue
+            if _is_method(callee):
+                size = _BOUND_BYTES
+            elif callee.opname == "LOAD_ATTR":
+                free[callee.offset] = None
+                continue
+            elif callee.opname in ("LOAD_GLOBAL", "LOAD_NAME") and (
+                    callee.argval == "int" or callee.argval == "range" and
+                    k + 1 < len(ops) and ops[k + 1].opname == "GET_ITER"):
+                size = None
+            else:
+                continue
+            free[op.offset] = size
+            j = k - 1
+            while j >= 0 and ops[j].opname in _AROUND_CALLS:
+                free[ops[j].offset] = size
+                j -= 1
+    return free
+
+
+def _quiet(code):
+    """Offsets of the bytecodes in code that never allocate"""
+    return frozenset(op.offset for op in dis.get_instructions(code)
+                     if op.opname in _QUIET or "JUMP" in op.opname)
+
+
+class _PassAllocs:
+    """Counts what the program's own code (files in folders) allocates in
+    each pass, from one sleep to the next, even if it's let go of again
+    before the sleep. That's what MicroPython's GC has to clean up later,
+    and what _held() can't see.
+
+    It traces the program's code one bytecode at a time and takes the
+    tracemalloc peak over each one, so something made and dropped inside a
+    pass still counts. Time in the stand-ins doesn't count, nor does code
+    elsewhere(its globals) says runs on the ESP, nor what CPython allocates
+    where the hub doesn't (see _hub_free, and ints under 2 ** 30, which the
+    hub keeps in the pointer).
+
+    CPython keeps floats, tuples, lists and dicts it's done with to hand out
+    again without allocating, where the hub allocates every one, so once
+    it's counting it empties those (gc.collect() does) before every bytecode
+    that could make one. Everything there is at the end of a pass is frozen
+    so that stays quick."""
+
+    def __init__(self, folders, clock, warmup_us, elsewhere=None):
+        self.folders = tuple(os.path.join(f, "") for f in folders)
+        self.elsewhere = elsewhere
+        self.clock = clock
+        self.warmup_us = warmup_us
+        self.sleeps = clock.sleeps
+        # When the pass going on started, one that started before warmup_us
+        # is still setup
+        self.started_us = clock.now_us
+        self.counting = warmup_us <= 0
+        self.mine = {}
+        self.free = {}
+        self.quiet = {}
+        # Whether the code running since the last event was the program's
+        self.inside = False
+        self.where = None
+        self.hub_free = 0
+        self.base = 0
+        self.now = 0
+        self.passes = 0
+        self.allocating = 0
+        self.worst = 0
+        # Most bytes each line allocated in one pass, by "file:line"
+        self.lines = {}
+        self.now_lines = {}
+        # Made once, a bound method made per event would count as the
+        # program's
+        self.step = self._step
+
+    def _is_mine(self, frame):
+        # By id, code objects compare equal by contents and the ESP's copy
+        # of a module isn't the hub's. The code is kept so its id isn't
+        # reused.
+        code = frame.f_code
+        seen = self.mine.get(id(code))
+        if seen is None:
+            mine = code.co_filename.startswith(self.folders) and not (
+                self.elsewhere and self.elsewhere(frame.f_globals))
+            seen = self.mine[id(code)] = (code, mine)
+            if mine:
+                self.free[code] = _hub_free(code)
+                self.quiet[code] = _quiet(code)
+        return seen[1]
+
+    def start(self):
+        sys.settrace(self._call)
+
+    def stop(self):
+        sys.settrace(None)
+
+    def _call(self, frame, event, arg):
+        # What went on since the last event was making the frame (for the
+        # tracing, the hub doesn't have one) so it's never counted
+        if not self._is_mine(frame):
+            self.inside = False
+            return None
+        frame.f_trace_lines = False
+        frame.f_trace_opcodes = True
+        self._restart(frame)
+        return self.step
+
+    def _step(self, frame, event, arg):
+        cur, peak = tracemalloc.get_traced_memory()
+        size = peak - self.base
+        if self.hub_free:
+            size -= self.hub_free
+        if self.inside and self.hub_free is not None and size > 0 and \
+                size not in _SMALL_INT_BYTES:
+            self.now += size
+            self.now_lines[self.where] = self.now_lines.get(self.where, 0) \
+                + size
+        if self.clock.sleeps != self.sleeps:
+            self._end_pass()
+        del cur, peak
+        if event == "return":
+            back = frame.f_back
+            self.inside = back is not None and self._is_mine(back)
+            self.base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            return self.step
+        self._restart(frame)
+        return self.step
+
+    def _restart(self, frame):
+        self.inside = True
+        code = frame.f_code
+        self.hub_free = self.free[code].get(frame.f_lasti, 0)
+        self.where = "{}:{}".format(os.path.basename(code.co_filename),
+                                    frame.f_lineno)
+        if self.counting and frame.f_lasti not in self.quiet[code]:
+            # Again after, the tuple get_traced_memory() returns goes in one
+            gc.collect()
+            self.base = tracemalloc.get_traced_memory()[0]
+            gc.collect()
+        else:
+            self.base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def _end_pass(self):
+        self.sleeps = self.clock.sleeps
+        if self.started_us >= self.warmup_us:
+            self.passes += 1
+            if self.now:
+                self.allocating += 1
+                self.worst = max(self.worst, self.now)
+            for where, size in self.now_lines.items():
+                self.lines[where] = max(self.lines.get(where, 0), size)
+        self.started_us = self.clock.now_us
+        self.counting = self.started_us >= self.warmup_us
+        if self.counting:
+            gc.freeze()
+        self.now = 0
+        self.now_lines = {}
+
+    def report(self):
+        return {
+            "alloc_passes": self.passes,
+            "alloc_passes_allocating": self.allocating,
+            "alloc_per_pass": self.worst,
+            "alloc_lines": dict(sorted(self.lines.items(),
+                                       key=lambda item: -item[1])),
+        }
+
+
+def run(script, scenario=None, seconds=10.0, quiet=False, alloc=False,
+        warmup=None, per_pass=False):
+    """Runs script for seconds of virtual time and returns the report.
+
+    With alloc, alloc_growth is how much more memory the program's code
+    holds at the end than at warmup seconds in (default a fifth of the run),
+    so imports and setup don't count. With per_pass, alloc_per_pass is the
+    most the program's code allocated in one pass after warmup (see
+    _PassAllocs). That traces every bytecode, so the program runs many times
+    slower and cpu_s means nothing."""
+    sys.path.insert(0, HERE)
+    import simworld
+    world, clock = simworld.world, simworld.clock
+
+    folder = os.path.dirname(os.path.abspath(script))
+    sys.path.insert(1, folder)
+    sys.path.insert(2, SHARED)
+    world.esp.path = [folder, os.path.join(folder, "UDP")]
+    mine = world.esp.path + [SHARED]
+    clock.limit_us = int(seconds * 1e6)
+    load_scenario(world, scenario)
+    sys.modules["time"] = simworld.time_module()
+    sys.modules["gc"] = simworld.gc_module()
+
+    if warmup is None:
+        warmup = seconds / 5
+    held = {}
+    if alloc:
+        clock.schedule(warmup * 1e6,
+                       lambda: held.setdefault("warm", _held(mine)))
+        # Just before the end, while the program still has its variables
+        clock.schedule(clock.limit_us - 1,
+                       lambda: held.setdefault("end", _held(mine)))
+
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = _Discard()
+    if alloc or per_pass:
+        tracemalloc.start(1)
+    if per_pass:
+        passes = _PassAllocs(mine, clock, warmup * 1e6,
+                             world.esp.runs)
+        passes.start()
+    cpu = time.process_time()
+    ended = "program finished"
+    try:
+        # Absolute so the code's file names start with its folder
+        runpy.run_path(os.path.abspath(script), run_name="__main__")
+    except simworld.SimulationDone as e:
+        ended = str(e)
+    finally:
+        cpu = time.process_time() - cpu
+        if per_pass:
+            passes.stop()
+        if alloc:
+            held.setdefault("end", _held(mine))
+            peak = tracemalloc.get_traced_memory()[1]
+        if alloc or per_pass:
+            tracemalloc.stop()
+        if quiet:
+            sys.stdout = stdout
+
+    report = world.report()
+    report["script"] = script
+    report["ended"] = ended
+    report["cpu_s"] = cpu
+    if alloc:
+        report["alloc_growth"] = held["end"] - held.get("warm", held["end"])
+        report["alloc_held"] = held["end"]
+        report["alloc_peak"] = peak
+    if per_pass:
+        report.update(passes.report())
+    return report
+
+
+def self_test():
+    """Runs selftest/alloc_probe.py with per_pass and returns what
+    _PassAllocs got wrong about it, nothing if it's working: every pass
+    allocates, on the lines marked allocates and none marked free"""
+    probe = os.path.join(HERE, "selftest", "alloc_probe.py")
+    marked = {"allocates": [], "free": []}
+    with open(probe) as f:
+        for number, line in enumerate(f, 1):
+            mark = line.rpartition("#")[2].strip()
+            if mark in marked:
+                marked[mark].append("alloc_probe.py:{}".format(number))
+
+    report = run(probe, seconds=2.0, quiet=True, per_pass=True)
+    wrong = []
+    if not report["alloc_passes"] or \
+            report["alloc_passes_allocating"] != report["alloc_passes"]:
+        wrong.append("{} of {} passes allocated, should be all".format(
+            report["alloc_passes_allocating"], report["alloc_passes"]))
+    for where in marked["allocates"]:
+        if where not in report["alloc_lines"]:
+            wrong.append(where + " allocates but wasn't counted")
+    for where in marked["free"]:
+        if where in report["alloc_lines"]:
+            wrong.append("{} doesn't allocate on the hub but {} bytes were "
+                         "counted".format(where, report["alloc_lines"][where]))
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a hub program on the simulated hub")
+    parser.add_argument("script", nargs="?")
+    parser.add_argument("--scenario", help="file with a setup(world)")
+    parser.add_argument("--seconds", type=float, default=10.0,
+                        help="virtual seconds to run for (default 10)")
+    parser.add_argument("--quiet", action="store_true",
+                        help="hide what the program prints")
+    parser.add_argument("--alloc", action="store_true",
+                        help="track memory held by the program's code")
+    parser.add_argument("--per-pass", action="store_true",
+                        help="count what the program's code allocates "
+                        "between sleeps (slow)")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--self-test", action="store_true",
+                        help="check --per-pass counts what it should")
+    args = parser.parse_args()
+
+    if args.self_test:
+        wrong = self_test()
+        for line in wrong:
+            print("SELF-TEST", line)
+        if wrong:
+            sys.exit(1)
+        print("--per-pass counts what it should")
+        return
+    if args.script is None:
+        parser.error("the script to run is needed")
+
+    report = run(args.script, args.scenario, args.seconds, args.quiet,
+                 args.alloc, per_pass=args.per_pass)
+    text = json.dumps(report, indent=2)
+    print(text, file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
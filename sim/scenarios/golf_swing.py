@@ -0,0 +1,22 @@
+"""A golf swing for MR_golf.py/MR_golf_improved.py: hold the left button,
+swing, let go, MR says you scored, then tap over to turning mode and turn
+right for a bit"""
+
+import math
+
+
+def setup(world):
+    # Left button held from 1 to 3 s, the swing peaks at 2.5 s
+    world.press("left", 1.0, 3.0)
+    world.accel = lambda t: (int(1500 * math.exp(-((t - 2.5) * 8) ** 2)),
+                             int(300 * math.sin(t * 5)), 980)
+
+    # The motor/position sensor and color sensor MR_golf_improved.py reads
+    world.motor("A", lambda t: 45 * math.sin(t))
+    world.color("B", lambda t: 60 if 3.5 < t < 4 else 10)
+
+    mr = world.add_central(connect_at=0.5)
+    mr.write(4.0, b"score")
+
+    world.gesture(6.0, "tapped")
+    world.press("right", 7.0, 7.5)
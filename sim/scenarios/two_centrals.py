@@ -0,0 +1,16 @@
+"""MR and a second central (a logger, latency_probe.py) both on MR_car.py:
+MR connects at 0.5 s, the logger at 1 s, both should get every sample, and
+the logger leaving at 6 s shouldn't bother MR
+
+    python3 sim/run.py BLE/MR_car.py --scenario sim/scenarios/two_centrals.py
+"""
+
+import math
+
+
+def setup(world):
+    world.pitch = lambda t: int(30 * math.sin(t))
+    world.roll = lambda t: int(20 * math.cos(t * 0.7))
+    world.add_central(connect_at=0.5)
+    logger = world.add_central(connect_at=1.0)
+    logger.disconnect(6.0)
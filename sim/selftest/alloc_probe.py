@@ -0,0 +1,21 @@
+"""A hub loop for run.py --self-test that allocates every pass, to check
+--per-pass sees it: the lines marked allocates have to be reported and the
+ones marked free mustn't be. The floats and tuples are the ones CPython hands
+back from its freelists without allocating, the rest is what CPython
+allocates where the hub doesn't."""
+
+import utime
+
+values = [0, 0, 0, 0]
+x = 7
+while True:
+    ratio = x / 3.0                     # allocates
+    pair = (x, ratio)                   # allocates
+    both = [x, x]                       # allocates
+    x = (x + 1000) % 5000               # free
+    values.pop()                        # free
+    values.append(x)                    # free
+    now = utime.ticks_ms()              # free
+    for i in range(2):                  # free
+        a, b = pair                     # free
+    utime.sleep_ms(10)
@@ -0,0 +1,623 @@
+"""
+The simulated world the stand-in hub modules (hub, spike, bluetooth, ...) read
+from and write to: a virtual clock, the sensors, BLE centrals, the ESP on the
+other end of the Backpack cable and the network behind it.
+
+Nothing here waits for real. Time only moves when a program sleeps or calls
+something that would take time on a real hub (see COSTS), so a 60 second run
+finishes in a second or two and always does the same thing.
+
+A scenario sets the world up before the program starts, e.g.
+    def setup(world):
+        world.motor("A", lambda t: 180 + 90 * math.sin(t))   # t in seconds
+        world.force("F", lambda t: 100 if 2 < t < 3 else 0)
+        world.press("left", 1.0, 1.4)
+        world.gesture(5.0, "tapped")
+        mr = world.add_central(connect_at=0.5)
+        mr.write(2.0, b"score")
+        world.udp_every(0.02, lambda t: b"1")   # MR sending to the ESP
+"""
+
+import errno, heapq, io, math, os, threading, types
+from collections import deque
+from contextlib import redirect_stdout
+
+# Roughly how long things take on a real hub, in microseconds. Every call to
+# a stand-in module moves the clock on by its cost, so loops that never sleep
+# still move forward and their rate comes out about right. Guesses, tune them
+# to your hub.
+COSTS = {
+    "sensor": 100,          # reading a sensor or the motion sensor
+    "display": 50,          # a light matrix or display call
+    "sound": 50,            # starting a beep
+    "motor": 100,           # a motor command
+    "notify": 300,          # gatts_notify
+    "ble": 50,              # any other BLE call
+    "udp": 200,             # sending a datagram from the ESP
+    "serial_byte": 87,      # one byte over the Backpack cable at 115200 baud
+    "serial_ask": 5000,     # the ESP's REPL running one command
+}
+
+TICKS_PERIOD = 1 << 30
+
+# What gc.mem_free()/mem_alloc() say, about a SPIKE with a program loaded
+HEAP_FREE = 120000
+HEAP_ALLOC = 80000
+
+
+class SimulationDone(BaseException):
+    """Raised out of the program when the run is over. It's a BaseException so
+    the program's own try/excepts don't catch it."""
+
+
+class Clock:
+    """Virtual time in microseconds, plus things scheduled to happen at set
+    times (a central connecting, MR writing, a datagram arriving)"""
+    def __init__(self):
+        self.now_us = 0
+        self.limit_us = None
+        self.sleeps = 0
+        self.busy_us = 0
+        self._events = []
+        self._seq = 0
+
+    def schedule(self, at_us, fn, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (int(at_us), self._seq, fn, args))
+
+    def next_event_us(self):
+        return self._events[0][0] if self._events else None
+
+    def _check_limit(self):
+        if self.limit_us is not None and self.now_us >= self.limit_us:
+            self.now_us = self.limit_us
+            raise SimulationDone("time limit")
+
+    def advance_to(self, at_us, until=None):
+        """Moves time on to at_us, running whatever was scheduled on the way.
+        Stops early, right after an event, once until() is true."""
+        while self._events and self._events[0][0] <= at_us:
+            when, _, fn, args = heapq.heappop(self._events)
+            if when > self.now_us:
+                self.now_us = when
+                self._check_limit()
+            fn(*args)
+            if until is not None and until():
+                return
+        if at_us > self.now_us:
+            self.now_us = at_us
+        self._check_limit()
+
+    def sleep_us(self, us):
+        self.sleeps += 1
+        self.advance_to(self.now_us + max(0, int(us)))
+
+    def charge(self, kind):
+        """Time passes for one call of the given kind (see COSTS)"""
+        us = COSTS[kind]
+        self.busy_us += us
+        self.advance_to(self.now_us + us)
+
+    def wait(self, cond, deadline_us=None, what="something"):
+        """Moves time on until cond() is true. Returns False if deadline_us
+        passes first, ends the run if nothing left could make it true."""
+        while not cond():
+            nxt = self.next_event_us()
+            if nxt is None or (deadline_us is not None and nxt > deadline_us):
+                if deadline_us is None:
+                    raise SimulationDone("waiting forever for " + what)
+                self.advance_to(deadline_us)
+                return cond()
+            self.advance_to(nxt, until=cond)
+        return True
+
+    def ticks_us(self):
+        return self.now_us % TICKS_PERIOD
+
+    def ticks_ms(self):
+        return (self.now_us // 1000) % TICKS_PERIOD
+
+
+def _zero(t):
+    return 0
+
+
+class MotorState:
+    """A motor or position sensor. angle(t) is where a hand has turned it
+    to, the hub's own commands are logged"""
+    def __init__(self, angle=_zero):
+        self.angle = angle
+        self.base = 0
+        self.counted_offset = 0
+        self.speed = 0
+
+
+class Central:
+    """A virtual BLE central (MR, a logger, ...) that connects to the hub"""
+    def __init__(self, world, conn_handle, connect_at, subscribe, mtu,
+                 subscribe_after=0.005):
+        self.world = world
+        self.conn_handle = conn_handle
+        self.subscribe = subscribe
+        self.subscribe_after = subscribe_after
+        self.mtu = mtu
+        self.connected = False
+        self.notifies = []
+        self.failed = 0
+        self._congested = []
+        world.clock.schedule(connect_at * 1e6, self._connect)
+
+    def _connect(self):
+        ble = self.world.ble
+        if ble is None or ble.irq_handler is None or not ble.advertising:
+            # Nothing to connect to yet, look again shortly
+            self.world.clock.schedule(self.world.clock.now_us + 100000,
+                                      self._connect)
+            return
+        self.connected = True
+        ble.advertising = False
+        ble.connected[self.conn_handle] = self
+        ble.irq_handler(1, (self.conn_handle, 0, bytes(6)))
+        if self.subscribe:
+            self.world.clock.schedule(
+                self.world.clock.now_us + self.subscribe_after * 1e6,
+                self._subscribe)
+
+    def _subscribe(self):
+        ble = self.world.ble
+        if not self.connected:
+            return
+        ble.values[ble.handle_tx + 1] = b"\x01\x00"
+        ble.irq_handler(3, (self.conn_handle, ble.handle_tx + 1))
+
+    def write(self, at, data):
+        """MR writes data to the hub's RX at time at (seconds)"""
+        self.world.clock.schedule(at * 1e6, self._write, bytes(data))
+
+    def _write(self, data):
+        ble = self.world.ble
+        if not self.connected:
+            return
+        data = data[:self.mtu - 3]
+        ble.values[ble.handle_rx] = data
+        self.world.counts["writes"] += 1
+        ble.irq_handler(3, (self.conn_handle, ble.handle_rx))
+
+    def disconnect(self, at):
+        self.world.clock.schedule(at * 1e6, self._disconnect)
+
+    def _disconnect(self):
+        ble = self.world.ble
+        if not self.connected:
+            return
+        self.connected = False
+        ble.connected.pop(self.conn_handle, None)
+        ble.irq_handler(2, (self.conn_handle, 0, bytes(6)))
+
+    def congest(self, start, end):
+        """Notifies to this central fail between start and end (seconds), as
+        if it can't keep up"""
+        self._congested.append((start * 1e6, end * 1e6))
+
+    def is_congested(self, now_us):
+        return any(a <= now_us < b for a, b in self._congested)
+
+
+class _EspStream:
+    """sys.stdin/sys.stdout on the ESP, .buffer being the raw bytes"""
+    def __init__(self, esp):
+        self.buffer = self
+        self.esp = esp
+
+    def read(self, n):
+        return self.esp.serial_read(n)
+
+    def write(self, data):
+        if self.esp.baud == self.esp.hub_baud:
+            self.esp.tx += data if not isinstance(data, str) \
+                else data.encode()
+        return len(data)
+
+
+class Esp:
+    """The ESP on the end of the Backpack cable, running commands like its
+    REPL would. Its socket and network modules are the stand-ins, and
+    esp_send.py etc. are loaded from path (the program's folder and its UDP
+    folder) or from files saved with Backpack.load().
+
+    A program can also write to the cable itself (hub.port.F.write/read).
+    Lines it types go to the REPL, and a command that keeps reading the 
+    serial port through sys.stdin (like esp_agent.serve) runs in a thread of 
+    its own that takes turns with the hub: it runs while the hub waits for it 
+    after a write and stops when it runs out of bytes to read, so only one of 
+    them ever moves the clock."""
+    def __init__(self, world):
+        self.world = world
+        self.path = []
+        self.files = {}
+        self.modules = {}
+        self.namespace = {"__builtins__": self._builtins()}
+        self.sys = types.ModuleType("sys")
+        self.sys.stdin = self.sys.stdout = _EspStream(self)
+        self.rx = bytearray()       # hub -> ESP
+        self.tx = bytearray()       # ESP -> hub
+        # Each end's baud rate, bytes only get through if they're the same
+        self.baud = self.hub_baud = 115200
+        self._line = bytearray()
+        self._thread = None
+        self._esp_turn = threading.Semaphore(0)
+        self._hub_turn = threading.Semaphore(0)
+        self._error = None
+
+    def _builtins(self):
+        import builtins
+        b = dict(vars(builtins))
+        real_import = builtins.__import__
+
+        def esp_import(name, globals=None, locals=None, fromlist=(), level=0):
+            module = self.import_module(name)
+            if module is not None:
+                return module
+            return real_import(name, globals, locals, fromlist, level)
+        b["__import__"] = esp_import
+        b["open"] = self._open
+        return b
+
+    def _open(self, name, mode="r"):
+        """open() on the ESP, its files are the ones in files"""
+        if "r" in mode:
+            if name not in self.files:
+                raise OSError(errno.ENOENT, "no such file: " + name)
+            return io.StringIO(self.files[name])
+        files = self.files
+
+        class EspFile(io.StringIO):
+            def close(self):
+                files[name] = self.getvalue()
+                super().close()
+        return EspFile()
+
+    def import_module(self, name):
+        if name in self.modules:
+            return self.modules[name]
+        if name == "socket":
+            import esp_socket
+            return esp_socket
+        if name == "network":
+            import network
+            return network
+        if name == "sys":
+            return self.sys
+        source = self.files.get(name + ".py")
+        filename = name + ".py"
+        if source is None:
+            for folder in self.path:
+                path = os.path.join(folder, name + ".py")
+                if os.path.exists(path):
+                    with open(path) as f:
+                        source = f.read()
+                    filename = path
+                    break
+        if source is None:
+            return None
+        module = types.ModuleType(name)
+        module.__dict__["__builtins__"] = self._builtins()
+        module.__file__ = filename
+        self.modules[name] = module
+        exec(compile(source, filename, "exec"), module.__dict__)
+        return module
+
+    def runs(self, globals):
+        """Whether code with these globals is the ESP's (typed at its REPL or
+        in a module it imported) rather than the hub's"""
+        return globals is self.namespace or any(
+            module.__dict__ is globals for module in self.modules.values())
+
+    def run(self, command):
+        """Runs one line like the REPL and returns what it printed, a
+        traceback too if it raised"""
+        out = io.StringIO()
+        with redirect_stdout(out):
+            try:
+                try:
+                    value = eval(compile(command, "<esp>", "eval"),
+                                 self.namespace)
+                    if value is not None:
+                        print(repr(value))
+                except SyntaxError:
+                    exec(compile(command, "<esp>", "exec"), self.namespace)
+            except Exception as e:
+                print("Traceback (most recent call last):")
+                print("{}: {}".format(type(e).__name__, e))
+        return out.getvalue()
+
+    # The cable, byte by byte
+
+    def _serial_time(self, n):
+        self.world.counts["serial_bytes"] += n
+        self.world.clock.advance_to(self.world.clock.now_us + n *
+                                    COSTS["serial_byte"] * 115200 /
+                                    self.hub_baud)
+
+    def serial_write(self, data):
+        """The hub writes data to the cable"""
+        self._serial_time(len(data))
+        if self.baud != self.hub_baud:
+            return
+        if self._thread is not None:
+            self.rx += data
+            self._hand_over()
+            return
+        # The REPL echoes what it's typed and runs each line
+        self.tx += data
+        for c in bytes(data):
+            if c in b"\r\n":
+                if self._line:
+                    line = self._line.decode()
+                    self._line = bytearray()
+                    self._start(line)
+            else:
+                self._line.append(c)
+
+    def serial_read(self, n):
+        """The ESP reads n bytes from the cable, waiting its turn until the
+        hub has written them"""
+        while len(self.rx) < n:
+            self._hub_turn.release()
+            self._esp_turn.acquire()
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def hub_read(self, n):
+        """The hub reads up to n bytes that have come back over the cable"""
+        data = bytes(self.tx[:n])
+        del self.tx[:n]
+        self._serial_time(len(data))
+        return data
+
+    def _start(self, line):
+        def repl():
+            try:
+                try:
+                    value = eval(compile(line, "<esp>", "eval"),
+                                 self.namespace)
+                    if value is not None:
+                        self.tx += (repr(value) + "\r\n").encode()
+                except SyntaxError:
+                    exec(compile(line, "<esp>", "exec"), self.namespace)
+            except Exception as e:
+                self.tx += "Traceback (most recent call last):\r\n{}: {}\r\n" \
+                    .format(type(e).__name__, e).encode()
+            except BaseException as e:
+                self._error = e
+            self.tx += b">>> "
+            self._thread = None
+            self._hub_turn.release()
+        self.world.clock.charge("serial_ask")
+        self._thread = threading.Thread(target=repl, daemon=True)
+        self._thread.start()
+        self._wait()
+
+    def _hand_over(self):
+        self._esp_turn.release()
+        self._wait()
+
+    def _wait(self):
+        self._hub_turn.acquire()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class Wifi:
+    """The access point the ESP connects to"""
+    def __init__(self):
+        self.ssid = "Tufts_Wireless"
+        self.bssid = b"\x00\x11\x22\x33\x44\x55"
+        self.channel = 6
+        # Seconds from connect() until associated, then until DHCP gives it an
+        # address (not needed with a static one), and to scan for the access
+        # point (not needed if connect() is told its bssid and the channel
+        # is set to its)
+        self.associate_s = 1.2
+        self.dhcp_s = 0.8
+        self.scan_s = 1.5
+        self.ip = "10.245.81.17"
+        self.up = True
+
+
+class World:
+    def __init__(self):
+        self.clock = Clock()
+        self.uid = b"\x12\x34\x56\x78\x9a\xbc"
+        self.motors = {}
+        self.forces = {}
+        self.colors = {}
+        self.pitch = _zero
+        self.roll = _zero
+        self.yaw = _zero
+        self.accel = lambda t: (0, 0, 0)
+        self.gestures = []
+        self.buttons = {"left": [], "right": [], "center": []}
+        self.centrals = []
+        self.ble = None
+        self.esp = Esp(self)
+        self.wifi = Wifi()
+        self.udp_sent = []
+        self.udp_inbox = deque()
+        self.log = []
+        self.counts = {"writes": 0, "udp_received": 0, "asks": 0,
+                       "serial_bytes": 0, "udp_dropped": 0}
+
+    # Time, in seconds for scenarios
+
+    def t(self):
+        return self.clock.now_us / 1e6
+
+    # Sensors
+
+    def motor(self, port, angle=None):
+        """The motor on a port, optionally setting angle(t)"""
+        state = self.motors.setdefault(port, MotorState())
+        if angle is not None:
+            state.angle = angle
+        return state
+
+    def force(self, port, percent=None):
+        """Force sensor on a port, percent(t) from 0 to 100"""
+        if percent is not None:
+            self.forces[port] = percent
+        return self.forces.get(port, _zero)
+
+    def color(self, port, reflected=None):
+        """Color sensor on a port, reflected(t) from 0 to 100"""
+        if reflected is not None:
+            self.colors[port] = reflected
+        return self.colors.get(port, _zero)
+
+    def press(self, button, start, end):
+        """Holds a hub button ("left", "right", "center") from start to end"""
+        self.buttons[button].append((start * 1e6, end * 1e6))
+        self.buttons[button].sort()
+
+    def gesture(self, at, name):
+        self.gestures.append((at * 1e6, name))
+        self.gestures.sort()
+
+    def is_pressed(self, button):
+        now = self.clock.now_us
+        return any(a <= now < b for a, b in self.buttons[button])
+
+    # BLE
+
+    def add_central(self, connect_at=0.5, subscribe=True, mtu=247,
+                    subscribe_after=0.005):
+        """subscribe_after is how many seconds after connecting it turns on
+        notifications, a real one finds the services first"""
+        central = Central(self, len(self.centrals) + 1, connect_at,
+                          subscribe, mtu, subscribe_after)
+        self.centrals.append(central)
+        return central
+
+    # The network behind the ESP
+
+    def udp_arrive(self, at, data, addr=("10.247.98.69", 21024)):
+        """A datagram reaches the ESP at time at"""
+        self.clock.schedule(at * 1e6, self._udp_arrive, bytes(data), addr)
+
+    def _udp_arrive(self, data, addr):
+        self.udp_inbox.append((data, addr))
+        self.counts["udp_received"] += 1
+
+    def udp_every(self, period, data, start=0.0, end=None,
+                  addr=("10.247.98.69", 21024)):
+        """A datagram data(t) reaches the ESP every period seconds"""
+        self.every(period, lambda t: self._udp_arrive(bytes(data(t)), addr),
+                   start, end)
+
+    def every(self, period, fn, start=0.0, end=None):
+        """Calls fn(t) every period seconds from start to end"""
+        def tick():
+            t = self.t()
+            if end is not None and t > end:
+                return
+            fn(t)
+            self.clock.schedule(self.clock.now_us + period * 1e6, tick)
+        self.clock.schedule(start * 1e6, tick)
+
+    # What happened
+
+    def record(self, what, *args):
+        self.log.append((self.clock.now_us, what, args))
+
+    def report(self):
+        seconds = self.clock.now_us / 1e6 or 1e-9
+        report = {
+            "virtual_s": self.clock.now_us / 1e6,
+            "sleeps": self.clock.sleeps,
+            "sleeps_per_s": self.clock.sleeps / seconds,
+            "busy_fraction": self.clock.busy_us / (seconds * 1e6),
+            "centrals": [],
+            "udp_sent": len(self.udp_sent),
+            "udp_sent_bytes": sum(len(d) for _, _, d in self.udp_sent),
+            "udp_sent_per_s": len(self.udp_sent) / seconds,
+        }
+        report.update(self.counts)
+        kinds = {}
+        for _, what, _ in self.log:
+            kinds[what] = kinds.get(what, 0) + 1
+        report["log"] = kinds
+        try:
+            from mr_frames import decode_all
+        except ImportError:
+            decode_all = None
+        for central in self.centrals:
+            frames = 0
+            if decode_all is not None:
+                for _, _, data in central.notifies:
+                    try:
+                        frames += len(decode_all(data))
+                    except ValueError:
+                        pass
+            n = len(central.notifies)
+            size = sum(len(d) for _, _, d in central.notifies)
+            report["centrals"].append({
+                "conn_handle": central.conn_handle,
+                "notifies": n,
+                "bytes": size,
+                "frames": frames,
+                "notifies_per_s": n / seconds,
+                "bytes_per_s": size / seconds,
+                "failed": central.failed,
+            })
+        return report
+
+
+def default_scenario(world):
+    """Something for every sensor to do and MR connected, for when no
+    scenario is given"""
+    for port in "ABCDEF":
+        world.motor(port, lambda t: 180 + 90 * math.sin(t))
+        world.force(port, lambda t: max(0, int(100 * math.sin(t * 2))))
+        world.color(port, lambda t: 60 if t % 4 > 3 else 10)
+    world.pitch = lambda t: int(30 * math.sin(t))
+    world.roll = lambda t: int(20 * math.cos(t * 0.7))
+    world.accel = lambda t: (int(600 * math.sin(t * 8)),
+                             int(400 * math.cos(t * 8)), 980)
+    for k in range(100):
+        world.press("left", 1.0 + 4 * k, 1.5 + 4 * k)
+    for k in range(100):
+        world.gesture(6.0 + 7 * k, "tapped")
+    world.add_central(connect_at=0.5)
+    world.udp_every(0.02, lambda t: b"1")
+
+
+# The one world every stand-in module shares
+world = World()
+clock = world.clock
+
+
+def gc_module():
+    """A stand-in for the gc module, the real one plus MicroPython's
+    mem_free()/mem_alloc(). The hub's heap isn't simulated, so they just say
+    the same thing every time (run.py --alloc measures memory instead)."""
+    import gc as real
+    module = types.ModuleType("gc")
+    module.__dict__.update(vars(real))
+    module.mem_free = lambda: HEAP_FREE
+    module.mem_alloc = lambda: HEAP_ALLOC
+    return module
+
+
+def time_module():
+    """A stand-in for the time module, the real one plus MicroPython's extras,
+    all on the virtual clock"""
+    import time as real
+    import utime
+    module = types.ModuleType("time")
+    module.__dict__.update(vars(real))
+    for name in ("sleep", "sleep_ms", "sleep_us", "ticks_ms", "ticks_us",
+                 "ticks_cpu", "ticks_add", "ticks_diff", "time", "time_ns"):
+        setattr(module, name, getattr(utime, name))
+    return module
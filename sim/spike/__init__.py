@@ -0,0 +1,227 @@
+"""Stand-in for the SPIKE Prime app's spike module, reading the sensors from
+simworld"""
+
+from simworld import world, clock, SimulationDone
+
+
+class Motor:
+    def __init__(self, port):
+        self.port = port
+        self._state = world.motor(port)
+        self._stop_action = "coast"
+
+    def _angle(self):
+        state = self._state
+        return int(state.angle(world.t())) + state.base
+
+    def get_degrees_counted(self):
+        clock.charge("sensor")
+        return self._angle() - self._state.counted_offset
+
+    def set_degrees_counted(self, degrees_counted):
+        clock.charge("motor")
+        self._state.counted_offset = self._angle() - degrees_counted
+
+    def get_position(self):
+        clock.charge("sensor")
+        return self._angle() % 360
+
+    def get_speed(self):
+        clock.charge("sensor")
+        return self._state.speed
+
+    def set_stop_action(self, action):
+        self._stop_action = action
+
+    def start(self, speed=None):
+        clock.charge("motor")
+        self._state.speed = speed or 0
+        world.record("motor", self.port, "start", speed)
+
+    def stop(self):
+        clock.charge("motor")
+        self._state.speed = 0
+        world.record("motor", self.port, "stop")
+
+    def run_to_position(self, degrees, direction="shortest path", speed=None):
+        # The hub waits until the motor gets there, call it half a second
+        world.record("motor", self.port, "run_to_position", degrees)
+        clock.sleep_us(500000)
+        self._state.base += degrees - self._angle() % 360
+
+    def run_for_degrees(self, degrees, speed=None):
+        world.record("motor", self.port, "run_for_degrees", degrees)
+        clock.sleep_us(abs(degrees) * 1000)
+
+    def run_for_seconds(self, seconds, speed=None):
+        world.record("motor", self.port, "run_for_seconds", seconds)
+        clock.sleep_us(seconds * 1e6)
+
+    def start_at_power(self, power):
+        self.start(power)
+
+
+class ForceSensor:
+    def __init__(self, port):
+        self.port = port
+
+    def get_force_percentage(self):
+        clock.charge("sensor")
+        return int(world.force(self.port)(world.t()))
+
+    def get_force_newton(self):
+        return self.get_force_percentage() / 10
+
+    def is_pressed(self):
+        return self.get_force_percentage() > 0
+
+
+class ColorSensor:
+    def __init__(self, port):
+        self.port = port
+
+    def get_reflected_light(self):
+        clock.charge("sensor")
+        return int(world.color(self.port)(world.t()))
+
+    def get_color(self):
+        clock.charge("sensor")
+        return None
+
+
+class Button:
+    def __init__(self, name):
+        self.name = name
+
+    def is_pressed(self):
+        clock.charge("sensor")
+        return world.is_pressed(self.name)
+
+    def wait_until_pressed(self):
+        while not world.is_pressed(self.name):
+            starts = [a for a, _ in world.buttons[self.name]
+                      if a > clock.now_us]
+            if not starts:
+                raise SimulationDone("waiting forever for the {} button"
+                                     .format(self.name))
+            clock.advance_to(min(starts))
+
+    def wait_until_released(self):
+        while world.is_pressed(self.name):
+            clock.sleep_us(10000)
+
+    def was_pressed(self):
+        return self.is_pressed()
+
+
+class LightMatrix:
+    def show_image(self, image, brightness=100):
+        clock.charge("display")
+        world.record("display", "show_image", image, brightness)
+
+    def set_pixel(self, x, y, brightness=100):
+        clock.charge("display")
+        world.record("display", "set_pixel", x, y, brightness)
+
+    def write(self, text):
+        clock.charge("display")
+        world.record("display", "write", text)
+
+    def off(self):
+        clock.charge("display")
+        world.record("display", "off")
+
+
+class Speaker:
+    def beep(self, note=60, seconds=0.2, volume=100):
+        world.record("beep", note, seconds)
+        clock.sleep_us(seconds * 1e6)
+
+    def start_beep(self, note=60, volume=100):
+        clock.charge("sound")
+        world.record("beep", note, None)
+
+    def stop(self):
+        clock.charge("sound")
+
+
+class StatusLight:
+    def on(self, color="white"):
+        clock.charge("display")
+
+    def off(self):
+        clock.charge("display")
+
+
+class MotionSensor:
+    def __init__(self):
+        self._last_gesture = 0
+
+    def get_pitch_angle(self):
+        clock.charge("sensor")
+        return int(world.pitch(world.t()))
+
+    def get_roll_angle(self):
+        clock.charge("sensor")
+        return int(world.roll(world.t()))
+
+    def get_yaw_angle(self):
+        clock.charge("sensor")
+        return int(world.yaw(world.t()))
+
+    def get_gesture(self):
+        """The newest gesture since the last call, or None"""
+        clock.charge("sensor")
+        now = clock.now_us
+        gesture = None
+        for at, name in world.gestures:
+            if self._last_gesture < at <= now:
+                gesture = name
+        self._last_gesture = now
+        return gesture
+
+
+class PrimeHub:
+    def __init__(self):
+        self.light_matrix = LightMatrix()
+        self.speaker = Speaker()
+        self.status_light = StatusLight()
+        self.motion_sensor = MotionSensor()
+        self.left_button = Button("left")
+        self.right_button = Button("right")
+        # Some programs use the underscored names the app has underneath
+        self._light_matrix = self.light_matrix
+        self._speaker = self.speaker
+        self._left_button = self.left_button
+        self._right_button = self.right_button
+
+
+class App:
+    def play_sound(self, name, volume=100):
+        world.record("sound", name)
+
+    def start_sound(self, name, volume=100):
+        world.record("sound", name)
+
+
+class DistanceSensor:
+    def __init__(self, port):
+        self.port = port
+
+    def get_distance_cm(self):
+        clock.charge("sensor")
+        return None
+
+
+class MotorPair:
+    def __init__(self, left, right):
+        self.left = Motor(left)
+        self.right = Motor(right)
+
+    def start(self, steering=0, speed=None):
+        self.left.start(speed)
+        self.right.start(speed)
+
+    def stop(self):
+        self.left.stop()
+        self.right.stop()
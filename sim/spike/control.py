@@ -0,0 +1,30 @@
+"""Stand-in for spike.control"""
+
+from simworld import clock
+
+
+def wait_for_seconds(seconds):
+    clock.sleep_us(seconds * 1e6)
+
+
+def wait_until(get_value_function, operator_function=None, target_value=True):
+    # The app polls, so does this
+    while True:
+        value = get_value_function()
+        if operator_function is None:
+            if value == target_value:
+                return
+        elif operator_function(value, target_value):
+            return
+        clock.sleep_us(10000)
+
+
+class Timer:
+    def __init__(self):
+        self._start = clock.now_us
+
+    def reset(self):
+        self._start = clock.now_us
+
+    def now(self):
+        return (clock.now_us - self._start) // 1000000
@@ -0,0 +1,148 @@
+"""Stand-in for MicroPython's uasyncio, running tasks on the virtual clock.
+Only what the programs use: run, create_task, sleep, sleep_ms, Event and
+ThreadSafeFlag."""
+
+import heapq
+from collections import deque
+
+from simworld import clock, SimulationDone
+
+
+class _Request:
+    """What a task awaits, handed to the loop once. Like MicroPython's own
+    sleep_ms it's its own iterator, so awaiting it doesn't make a generator
+    that run.py --per-pass would count against the program."""
+    def __init__(self, kind, arg):
+        self.kind = kind
+        self.arg = arg
+        self.handed = False
+
+    def __await__(self):
+        return self
+
+    def __next__(self):
+        if self.handed:
+            raise StopIteration
+        self.handed = True
+        return self
+
+    def send(self, value):
+        return self.__next__()
+
+
+def sleep(seconds):
+    return _Request("sleep", int(seconds * 1e6))
+
+
+def sleep_ms(ms):
+    return _Request("sleep", int(ms * 1000))
+
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.joiners = []
+
+    def __await__(self):
+        if not self.done:
+            yield _Request("join", self)
+        return self.result
+
+
+class Event:
+    def __init__(self):
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        # May be called from a BLE IRQ while the clock is moving on
+        self._flag = True
+        for task in self._waiters:
+            _loop.ready.append(task)
+        self._waiters = []
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        if not self._flag:
+            await _Request("wait", self)
+        return True
+
+
+class ThreadSafeFlag(Event):
+    async def wait(self):
+        if not self._flag:
+            await _Request("wait", self)
+        self._flag = False
+
+
+class _Loop:
+    def __init__(self):
+        self.ready = deque()
+        self.sleeping = []
+        self._seq = 0
+
+    def _wake_sleepers(self):
+        while self.sleeping and self.sleeping[0][0] <= clock.now_us:
+            self.ready.append(heapq.heappop(self.sleeping)[2])
+
+    def run_until(self, main):
+        while not main.done:
+            if not self.ready:
+                if self.sleeping:
+                    target = self.sleeping[0][0]
+                else:
+                    target = clock.next_event_us()
+                    if target is None:
+                        raise SimulationDone(
+                            "every task is waiting on something that won't "
+                            "happen")
+                clock.advance_to(target, until=lambda: bool(self.ready))
+                self._wake_sleepers()
+                continue
+            self._step(self.ready.popleft())
+        return main.result
+
+    def _step(self, task):
+        try:
+            request = task.coro.send(None)
+        except StopIteration as e:
+            task.done = True
+            task.result = e.value
+            self.ready.extend(task.joiners)
+            return
+        if request.kind == "sleep":
+            self._seq += 1
+            clock.sleeps += 1
+            heapq.heappush(self.sleeping,
+                           (clock.now_us + request.arg, self._seq, task))
+        elif request.kind == "wait":
+            request.arg._waiters.append(task)
+        elif request.kind == "join":
+            if request.arg.done:
+                self.ready.append(task)
+            else:
+                request.arg.joiners.append(task)
+
+
+_loop = _Loop()
+
+
+def create_task(coro):
+    task = Task(coro)
+    _loop.ready.append(task)
+    return task
+
+
+def run(coro):
+    return _loop.run_until(create_task(coro))
+
+
+def get_event_loop():
+    return _loop
@@ -0,0 +1,48 @@
+"""Stand-in for MicroPython's utime, on the simulator's virtual clock"""
+
+from simworld import clock, TICKS_PERIOD
+
+# Seconds since 1/1/2000 when the simulated hub starts, like a hub whose RTC
+# was never set
+_EPOCH = 0
+
+
+def sleep(seconds):
+    clock.sleep_us(seconds * 1e6)
+
+
+def sleep_ms(ms):
+    clock.sleep_us(ms * 1000)
+
+
+def sleep_us(us):
+    clock.sleep_us(us)
+
+
+def ticks_us():
+    return clock.ticks_us()
+
+
+def ticks_ms():
+    return clock.ticks_ms()
+
+
+def ticks_cpu():
+    return clock.ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % TICKS_PERIOD
+
+
+def ticks_diff(end, start):
+    return ((end - start + TICKS_PERIOD // 2) % TICKS_PERIOD) \
+        - TICKS_PERIOD // 2
+
+
+def time():
+    return _EPOCH + clock.now_us // 1000000
+
+
+def time_ns():
+    return _EPOCH * 10 ** 9 + clock.now_us * 1000